@@ -0,0 +1,150 @@
+import numpy as np
+import tensorflow as tf
+from emb_cnn import GetWelch, MagnitudeSpectrogram, temporal_mean, model_emb_cnn, mixupLoss
+from mixup_layer import MixupLayer
+from feature_exchange import AugLayer
+from subcluster_adacos import SCAdaCos, AdaProj
+from scoring import length_norm, build_references, SectionScorer
+
+# realistic default shapes: 12 s clips at 16 kHz, 512-dimensional embeddings (256 fft + 256 spectrogram), 32 subclusters
+DEFAULTS = {'batch_size': 32, 'raw_dim': 192000, 'emb_dim': 512, 'num_classes': 128, 'n_subclusters': 32,
+            'n_sections': 16, 'n_train_per_section': 1000, 'n_queries_per_section': 200, 'n_target_per_section': 10}
+
+
+def _one_hot(rng, n, num_classes):
+    return tf.constant(np.eye(num_classes, dtype=np.float32)[rng.integers(0, num_classes, n)])
+
+
+def _layer_fns(layer, inputs, watched, training=True):
+    # compiled forward pass and forward plus backward pass with respect to the watched inputs and trainable weights
+    @tf.function
+    def forward():
+        return layer(inputs, training=training)
+
+    @tf.function
+    def forward_backward():
+        with tf.GradientTape() as tape:
+            tape.watch(watched)
+            outputs = tf.nest.flatten(layer(inputs, training=training))
+            loss = tf.add_n([tf.reduce_sum(output) for output in outputs])
+        return tape.gradient(loss, watched + layer.trainable_weights)
+
+    return {'forward': forward, 'forward_backward': forward_backward}
+
+
+def get_welch(config, rng):
+    x = tf.constant(rng.standard_normal((config['batch_size'], config['raw_dim'])).astype(np.float32))
+    return _layer_fns(GetWelch(), x, [x]), config['batch_size']
+
+
+def magnitude_spectrogram(config, rng):
+    x = tf.constant(rng.standard_normal((config['batch_size'], config['raw_dim'])).astype(np.float32))
+    return _layer_fns(MagnitudeSpectrogram(16000, 1024, 512), x, [x]), config['batch_size']
+
+
+def temporal_mean_cmn(config, rng):
+    n_frames = 1 + (config['raw_dim'] - 1024) // 512
+    spec = tf.constant(np.abs(rng.standard_normal((config['batch_size'], n_frames, 513, 1))).astype(np.float32))
+    layer = tf.keras.layers.Lambda(lambda x: x - temporal_mean(x, keepdims=True))
+    return _layer_fns(layer, spec, [spec]), config['batch_size']
+
+
+def mixup_layer(config, rng):
+    x = tf.constant(rng.standard_normal((config['batch_size'], config['raw_dim'], 1)).astype(np.float32))
+    y = _one_hot(rng, config['batch_size'], config['num_classes'])
+    return _layer_fns(MixupLayer(prob=0.5), [x, y], [x]), config['batch_size']
+
+
+def aug_layer(config, rng):
+    emb_dim = config['emb_dim'] // 2
+    emb_mel = tf.constant(rng.standard_normal((config['batch_size'], emb_dim)).astype(np.float32))
+    emb_fft = tf.constant(rng.standard_normal((config['batch_size'], emb_dim)).astype(np.float32))
+    y = _one_hot(rng, config['batch_size'], config['num_classes'])
+    return _layer_fns(AugLayer(prob=0.5), [emb_mel, emb_fft, y], [emb_mel, emb_fft]), config['batch_size']
+
+
+def _head(layer_class, num_classes, config, rng, **kwargs):
+    x = tf.constant(rng.standard_normal((config['batch_size'], config['emb_dim'])).astype(np.float32))
+    y = _one_hot(rng, config['batch_size'], num_classes)
+    layer = layer_class(n_classes=num_classes, n_subclusters=config['n_subclusters'], trainable=False, **kwargs)
+    return _layer_fns(layer, [x, y, y], [x]), config['batch_size']
+
+
+def scadacos(config, rng):
+    return _head(SCAdaCos, config['num_classes'], config, rng)
+
+
+def adaproj(config, rng):
+    return _head(AdaProj, config['num_classes'], config, rng)
+
+
+def adaproj_ssl(config, rng):
+    # the self-supervised head has three times as many classes
+    return _head(AdaProj, config['num_classes'] * 3, config, rng)
+
+
+def adaproj_efficient(config, rng):
+    return _head(AdaProj, config['num_classes'], config, rng, memory_efficient=True)
+
+
+def adaproj_ssl_efficient(config, rng):
+    return _head(AdaProj, config['num_classes'] * 3, config, rng, memory_efficient=True)
+
+
+def adaproj_ssl_interval(config, rng):
+    # scale s updated every 10th step only
+    return _head(AdaProj, config['num_classes'] * 3, config, rng, memory_efficient=True, s_update_interval=10)
+
+
+def train_step(config, rng, clip_size=None):
+    # one optimizer step of the complete model, runs under the mixed precision policy of the benchmark run
+    # clip_size trains the variable length model on a batch of clips with clip_size samples
+    data_input, label_input, loss_output, loss_output_ssl = model_emb_cnn(
+        config['num_classes'], config['raw_dim'], config['n_subclusters'], memory_efficient_proj=True,
+        variable_length=clip_size is not None)
+    model = tf.keras.Model(inputs=[data_input, label_input], outputs=[loss_output, loss_output_ssl])
+    model.compile(loss=[mixupLoss, mixupLoss], optimizer=tf.keras.optimizers.Adam(), loss_weights=[1, 1])
+    x = rng.standard_normal((config['batch_size'], clip_size or config['raw_dim'], 1)).astype(np.float32)
+    if clip_size is not None:
+        x = [x, np.full(config['batch_size'], clip_size, dtype=np.int32)]
+    y = np.eye(config['num_classes'], dtype=np.float32)[rng.integers(0, config['num_classes'], config['batch_size'])]
+    # the targets are not used by mixupLoss
+    targets = [np.zeros((config['batch_size'], config['num_classes'])), np.zeros((config['batch_size'], config['num_classes'] * 3))]
+    return {'forward_backward': lambda: model.train_on_batch([x, y], targets)}, config['batch_size']
+
+
+def train_step_half_length(config, rng):
+    # clips of half the maximum length, stored and batched without padding
+    return train_step(config, rng, clip_size=config['raw_dim'] // 2)
+
+
+def length_norm_case(config, rng):
+    n = config['n_sections'] * config['n_train_per_section']
+    embs = rng.standard_normal((n, config['emb_dim'])).astype(np.float32)
+    return {'forward': lambda: length_norm(embs)}, n
+
+
+def cosine_scoring(config, rng):
+    # distances of the queries of all sections to their target embeddings and source centroids
+    n_sections, emb_dim = config['n_sections'], config['emb_dim']
+    train_labels = np.repeat(np.arange(n_sections), config['n_train_per_section'])
+    source_train = np.ones(len(train_labels), dtype=bool)
+    for lab in range(n_sections):
+        source_train[lab * config['n_train_per_section']:lab * config['n_train_per_section'] +
+                     config['n_target_per_section']] = False
+    x_train = length_norm(rng.standard_normal((len(train_labels), emb_dim)).astype(np.float32))
+    query_labels = np.repeat(np.arange(n_sections), config['n_queries_per_section'])
+    queries = length_norm(rng.standard_normal((len(query_labels), emb_dim)).astype(np.float32))
+    centroids = {str(lab): length_norm(rng.standard_normal((config['n_subclusters'], emb_dim)))
+                 for lab in range(n_sections)}
+    scorer = SectionScorer({'train': train_labels, 'test': query_labels})
+    references = build_references(x_train, scorer.groups['train'], source_train, centroids)
+    return {'forward': lambda: scorer.score({'train': x_train, 'test': queries}, references)}, \
+        len(train_labels) + len(query_labels)
+
+
+CASES = {'get_welch': get_welch, 'magnitude_spectrogram': magnitude_spectrogram, 'temporal_mean': temporal_mean_cmn,
+         'mixup_layer': mixup_layer, 'aug_layer': aug_layer, 'scadacos': scadacos, 'adaproj': adaproj,
+         'adaproj_ssl': adaproj_ssl, 'adaproj_efficient': adaproj_efficient,
+         'adaproj_ssl_efficient': adaproj_ssl_efficient, 'adaproj_ssl_interval': adaproj_ssl_interval,
+         'train_step': train_step, 'train_step_half_length': train_step_half_length, 'length_norm': length_norm_case, 'cosine_scoring': cosine_scoring}
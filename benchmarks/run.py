@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_case(name, config, repeats, warmup, seed=0, mixed_precision=None):
+    """
+    Runs a single benchmark case in the current process and returns timings per pass, throughput and peak memory.
+    Each case is run in a fresh process by main() so that peak memory is not shared between cases.
+    """
+    import tensorflow as tf
+    from benchmarks.cases import CASES
+    from instrumentation import peak_rss_mb
+    baseline_rss = peak_rss_mb()
+    tf.keras.utils.set_random_seed(seed)
+    tf.keras.mixed_precision.set_global_policy(mixed_precision or 'float32')
+    fns, n_items = CASES[name](config, np.random.default_rng(seed))
+    results = {'n_items': n_items, 'baseline_rss_mb': baseline_rss}
+    for pass_name, fn in fns.items():
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        results[pass_name] = {'median_s': float(np.median(times)), 'min_s': float(np.min(times)),
+                              'mean_s': float(np.mean(times)), 'std_s': float(np.std(times)),
+                              'items_per_s': float(n_items / np.median(times))}
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # relative change of the median time and peak memory, a case is a regression if it got slower than the tolerance
+    # or failed in this run
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]
+        if 'error' in result or 'error' in old:
+            print(name + ': failed in ' + ('this run' if 'error' in result else 'the baseline') + ', not compared')
+            if 'error' in result:
+                regressions.append(name)
+            continue
+        for pass_name in ['forward', 'forward_backward']:
+            if pass_name in result and pass_name in old:
+                ratio = result[pass_name]['median_s'] / old[pass_name]['median_s']
+                flag = ''
+                if ratio > 1 + tolerance:
+                    flag = ' REGRESSION'
+                    regressions.append(name + '/' + pass_name)
+                print(name + '/' + pass_name + ': ' + str(np.round(old[pass_name]['median_s'] * 1000, 2)) + ' ms -> '
+                      + str(np.round(result[pass_name]['median_s'] * 1000, 2)) + ' ms (x' + str(np.round(ratio, 3))
+                      + ')' + flag)
+        print(name + '/peak_rss: ' + str(np.round(old['peak_rss_mb'], 1)) + ' MB -> '
+              + str(np.round(result['peak_rss_mb'], 1)) + ' MB')
+    return regressions
+
+
+def main():
+    from benchmarks.cases import CASES, DEFAULTS
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the custom layers and scoring kernels, '
+                                                 'run from the repository root: python -m benchmarks.run')
+    parser.add_argument('--cases', nargs='+', default=list(CASES.keys()), choices=list(CASES.keys()))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown when comparing')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mixed-precision', default=None, choices=['mixed_bfloat16', 'mixed_float16'],
+                        help='Keras mixed precision policy of the layers, default float32')
+    for key, value in DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=int, default=value)
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    config = {key: getattr(args, key) for key in DEFAULTS}
+
+    if args.run_case is not None:
+        print(json.dumps(run_case(args.run_case, config, args.repeats, args.warmup, args.seed, args.mixed_precision)))
+        return
+
+    import tensorflow as tf
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                        'tensorflow': tf.__version__, 'numpy': np.__version__, 'machine': platform.machine(),
+                        'cpu_count': os.cpu_count(), 'config': config, 'repeats': args.repeats,
+                        'mixed_precision': args.mixed_precision},
+               'results': {}}
+    for name in args.cases:
+        command = [sys.executable, '-m', 'benchmarks.run', '--run-case', name, '--repeats', str(args.repeats),
+                   '--warmup', str(args.warmup), '--seed', str(args.seed)]
+        if args.mixed_precision is not None:
+            command += ['--mixed-precision', args.mixed_precision]
+        for key, value in config.items():
+            command += ['--' + key.replace('_', '-'), str(value)]
+        process = subprocess.run(command, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        if process.returncode != 0:
+            print(name + ': failed')
+            results['results'][name] = {'error': process.returncode}
+            continue
+        results['results'][name] = json.loads(process.stdout.decode().strip().split('\n')[-1])
+        summary = ', '.join(pass_name + ' ' + str(np.round(results['results'][name][pass_name]['median_s'] * 1000, 2))
+                            + ' ms' for pass_name in ['forward', 'forward_backward']
+                            if pass_name in results['results'][name])
+        print(name + ': ' + summary + ', peak rss ' + str(np.round(results['results'][name]['peak_rss_mb'], 1)) + ' MB')
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            sys.exit('regressions: ' + ', '.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
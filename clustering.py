@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+
+
+def fit_section(x, n_clusters, use_minibatch=False, minibatch_size=1024, init=None):
+    # without init and mini-batches this is exactly the original KMeans(n_clusters=n_clusters, random_state=0)
+    if use_minibatch:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=0, batch_size=minibatch_size,
+                                 **({'init': init, 'n_init': 1} if init is not None else {}))
+    elif init is not None:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=0, init=init, n_init=1)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=0)
+    return kmeans.fit(x)
+
+
+class SectionClusterer():
+    """
+    Clusters the source domain embeddings of all sections with one KMeans per section, fitted concurrently in n_jobs
+    threads. Sections with more than minibatch_threshold embeddings use MiniBatchKMeans instead.
+    Centroids and per-section timings are cached in cache_dir, which should be specific to the member and its weights.
+    A cache written with different settings is used to warm-start the fits.
+    """
+
+    def __init__(self, n_clusters, n_jobs=1, minibatch_threshold=None, minibatch_size=1024, warm_start=True):
+        self.n_clusters = n_clusters
+        self.n_jobs = n_jobs
+        self.minibatch_threshold = minibatch_threshold
+        self.minibatch_size = minibatch_size
+        self.warm_start = warm_start
+        self.timings = {}
+
+    def settings(self):
+        return {'n_clusters': self.n_clusters, 'minibatch_threshold': self.minibatch_threshold,
+                'minibatch_size': self.minibatch_size}
+
+    def read_cache(self, cache_dir):
+        if cache_dir is None or not os.path.isfile(os.path.join(cache_dir, 'centroids.json')):
+            return None, None
+        with open(os.path.join(cache_dir, 'centroids.json'), 'r') as f:
+            info = json.load(f)
+        return info, dict(np.load(os.path.join(cache_dir, 'centroids.npz')))
+
+    def clear_cache(self, cache_dir):
+        # removes the cached centroids, e.g. when the embeddings they were fitted on changed
+        for name in ['centroids.json', 'centroids.npz']:
+            if os.path.isfile(os.path.join(cache_dir, name)):
+                os.remove(os.path.join(cache_dir, name))
+
+    def write_cache(self, cache_dir, centroids):
+        # the json file is written last and marks the cache as complete
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, 'centroids')
+        np.savez(path + '.part.npz', **centroids)
+        os.replace(path + '.part.npz', path + '.npz')
+        with open(path + '.json.part', 'w') as f:
+            json.dump({'settings': self.settings(), 'timings': self.timings}, f, indent=2)
+        os.replace(path + '.json.part', path + '.json')
+
+    def fit(self, x_ln, groups, source, cache_dir=None):
+        """
+        Returns a dict with the centroids of the source domain embeddings of each section, keyed by str(label).
+        groups maps each section label to its row indices in x_ln and source is a boolean mask of the source rows.
+        """
+        info, cached = self.read_cache(cache_dir)
+        if info is not None and info['settings'] == self.settings():
+            self.timings = info['timings']
+            return cached
+        inits = {}
+        if self.warm_start and cached is not None:
+            inits = {lab: c for lab, c in cached.items() if c.shape == (self.n_clusters, x_ln.shape[1])}
+
+        def fit_one(item):
+            lab, rows = item
+            x = np.asarray(x_ln)[rows[source[rows]]]
+            use_minibatch = self.minibatch_threshold is not None and len(x) > self.minibatch_threshold
+            start = time.perf_counter()
+            kmeans = fit_section(x, self.n_clusters, use_minibatch, self.minibatch_size, inits.get(str(lab)))
+            timing = {'n_samples': len(x), 'seconds': time.perf_counter() - start, 'n_iter': int(kmeans.n_iter_),
+                      'minibatch': use_minibatch, 'warm_start': str(lab) in inits}
+            return str(lab), kmeans.cluster_centers_, timing
+
+        # share the cores between the concurrent fits instead of oversubscribing them
+        n_jobs = max(1, min(self.n_jobs, len(groups)))
+        if n_jobs > 1:
+            with threadpool_limits(limits=max(1, (os.cpu_count() or 1) // n_jobs)):
+                with ThreadPoolExecutor(n_jobs) as executor:
+                    results = list(executor.map(fit_one, groups.items()))
+        else:
+            results = [fit_one(item) for item in groups.items()]
+        centroids = {lab: c for lab, c, _ in results}
+        self.timings = {lab: timing for lab, _, timing in results}
+        if cache_dir is not None:
+            self.write_cache(cache_dir, centroids)
+        return centroids
+
+    def summary(self):
+        if len(self.timings) == 0:
+            return 'no sections clustered'
+        slowest = max(self.timings, key=lambda lab: self.timings[lab]['seconds'])
+        return ('clustered ' + str(len(self.timings)) + ' sections, total fit time '
+                + str(np.round(sum(t['seconds'] for t in self.timings.values()), 2)) + 's, slowest section '
+                + slowest + ': ' + str(np.round(self.timings[slowest]['seconds'], 2)) + 's')
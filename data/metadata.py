@@ -0,0 +1,142 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from data.data_manager import path_to_dict
+
+METADATA_VERSION = 1
+# keys of path_to_dict that are not attributes of the recording
+NON_ATTRIBUTE_KEYS = ['section', 'source', 'normal', 'anomaly']
+
+
+def fix_robotic_arm_name(file_name):
+    # some RoboticArm training files lack the separator of the background attribute, only the parsed name is fixed,
+    # the files themselves are not renamed
+    if len(file_name.split('_')) < 9:
+        return file_name.split('weight')[0] + 'weight_' + file_name.split('weight')[1].split('_')[0] + '_Bckg_' + \
+            file_name.split('Bckg')[1]
+    return file_name
+
+
+def parse_file(file):
+    """
+    Metadata of a clip stored as <root>/<machine>/<stage>/section_<section>_<domain>_<stage>_<normal|anomaly>_<id>_
+    <attributes>.wav, clips of the evaluation dataset (section_<section>_<id>.wav) have no domain, condition and
+    attributes.
+    """
+    path = Path(file.replace('\\', '/'))
+    machine, stage, file_name = path.parent.parent.name, path.parent.name, path.name
+    if machine == 'RoboticArm' and stage == 'train':
+        file_name = fix_robotic_arm_name(file_name)
+    parts = file_name.split('.wav')[0].split('_')
+    labeled = len(parts) > 4 and parts[2] in ['source', 'target']
+    metadata = {'file': file, 'machine': machine, 'section': parts[1], 'section_id': machine + '_' + parts[1],
+                'domain': parts[2] if labeled else None, 'source': labeled and parts[2] == 'source',
+                'normal': parts[4] == 'normal' if labeled else None,
+                'attributes': '_'.join(parts[6:]) if labeled else ''}
+    if labeled:
+        for key, value in path_to_dict(Path(file_name)).items():
+            if key not in NON_ATTRIBUTE_KEYS:
+                metadata['attribute_' + key] = value
+    return metadata
+
+
+def build_table(files):
+    # one row per clip, row is the index of the clip in the waveform store
+    table = pd.DataFrame([parse_file(file) for file in files])
+    table.insert(0, 'row', np.arange(len(files)))
+    return table
+
+
+def encode_labels(tables, columns):
+    """
+    Encodes each unique combination of the values of columns over all tables as a label, in sorted order.
+    Returns the labels of each table and the number of labels.
+    """
+    combined = pd.concat([table[columns] for table in tables], ignore_index=True)
+    labels = combined.groupby(columns, sort=True, dropna=False).ngroup().to_numpy()
+    return np.split(labels, np.cumsum([len(table) for table in tables])[:-1]), int(labels.max()) + 1
+
+
+def balanced_sample_weights(source, class_labels, section_labels):
+    """
+    Weights of the source domain clips: the number of source domain clips of the other classes, normalized to sum to
+    one within each section. All weights are scaled to a mean of one over the source domain clips, clips of the target
+    domain have weight one before scaling.
+    """
+    weights = np.ones(source.shape[0])
+    class_counts = pd.Series(class_labels[source]).groupby(class_labels[source]).transform('size').to_numpy()
+    weights[source] = np.sum(source) - class_counts
+    source_weights = pd.Series(weights[source])
+    weights[source] = source_weights / source_weights.groupby(section_labels[source]).transform('sum').to_numpy()
+    return weights / np.mean(weights[source])
+
+
+class MetadataStore():
+    """
+    Metadata tables of the dataset splits, built once from the file lists of the waveform stores and cached as Parquet
+    (or as pickle if no Parquet engine is installed). Files appended to a waveform store are appended to its table,
+    the table is only built again if other files change.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def paths(self, split):
+        return (os.path.join(self.store_dir, split + '_metadata.parquet'),
+                os.path.join(self.store_dir, split + '_metadata.pkl'),
+                os.path.join(self.store_dir, split + '_metadata.json'))
+
+    def key(self, files):
+        return hashlib.sha1(json.dumps(list(files)).encode('utf-8')).hexdigest()
+
+    def read(self, split):
+        # key and table of the cached table, None and None if there is none of the current version
+        parquet_path, pickle_path, manifest_path = self.paths(split)
+        if not os.path.isfile(manifest_path):
+            return None, None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != METADATA_VERSION:
+            return None, None
+        if manifest['format'] == 'parquet':
+            return manifest['key'], pd.read_parquet(parquet_path)
+        with open(pickle_path, 'rb') as f:
+            return manifest['key'], pickle.load(f)
+
+    def write(self, split, key, table):
+        parquet_path, pickle_path, manifest_path = self.paths(split)
+        os.makedirs(self.store_dir, exist_ok=True)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+        try:
+            table.to_parquet(parquet_path + '.part')
+            os.replace(parquet_path + '.part', parquet_path)
+            table_format = 'parquet'
+        except ImportError:
+            with open(pickle_path + '.part', 'wb') as f:
+                pickle.dump(table, f)
+            os.replace(pickle_path + '.part', pickle_path)
+            table_format = 'pickle'
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump({'key': key, 'format': table_format, 'version': METADATA_VERSION}, f)
+        os.replace(manifest_path + '.part', manifest_path)
+
+    def load(self, split, files):
+        files = list(files)
+        key = self.key(files)
+        cached_key, table = self.read(split)
+        if cached_key == key:
+            return table
+        if table is not None and len(files) > len(table) and table['file'].tolist() == files[:len(table)]:
+            # only the new files are parsed, the rows of the cached table stay the same
+            new_table = build_table(files[len(table):])
+            new_table['row'] += len(table)
+            table = pd.concat([table, new_table], ignore_index=True)
+        else:
+            table = build_table(files)
+        self.write(split, key, table)
+        return table
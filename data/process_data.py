@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import soundfile as sf
+import librosa
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tqdm import tqdm
+
+PCM_SCALE = 32768
+
+
+def adjust_size(wav, new_size):
+    new_wav = librosa.util.pad_center(wav, size=new_size)
+    return new_wav
+
+
+def list_wav_files(dicts, stage):
+    # same order as iterating over os.listdir for all categories and files
+    # erroneous RoboticArm file names are not renamed, data.metadata parses them with the fixed names
+    files = []
+    for dict in dicts:
+        for category in os.listdir(dict):
+            for file in os.listdir(dict + category + '/' + stage):
+                if file.endswith('.wav'):
+                    files.append(dict + category + '/' + stage + '/' + file)
+    return files
+
+
+def to_storage_dtype(wav, dtype):
+    # int16 keeps 16-bit PCM samples exactly, sf.read decodes them to multiples of 1 / PCM_SCALE
+    if np.dtype(dtype) == np.int16:
+        return np.clip(np.round(wav * PCM_SCALE), -PCM_SCALE, PCM_SCALE - 1).astype(np.int16)
+    return wav.astype(dtype)
+
+
+def load_wav(file_path, max_size, pad=True):
+    wav, fs = sf.read(file_path)
+    raw = librosa.core.to_mono(wav.transpose()).transpose()
+    if not pad:
+        return raw[:max_size]
+    return adjust_size(raw, max_size)
+
+
+def clip_lengths(files, max_size):
+    # number of samples of each clip without decoding it, clips longer than max_size are truncated
+    return np.array([min(sf.info(file).frames, max_size) for file in files], dtype=np.int64)
+
+
+def _load_into_memmap(args):
+    # worker for process pools, each process opens the memmap on its own
+    mmap_path, k, file_path, max_size = args
+    out = np.load(mmap_path, mmap_mode='r+')
+    out[k, :, 0] = to_storage_dtype(load_wav(file_path, max_size), out.dtype)
+    out.flush()
+    return k
+
+
+def load_wavs(files, max_size, n_workers=8, mmap_path=None, use_processes=False, dtype='float32'):
+    """
+    Decode wav files in parallel into a preallocated array of shape (n_files, max_size, 1) with dtype float32, float16
+    or int16 (PCM samples, divide by PCM_SCALE to get float32 samples).
+    If mmap_path is given, the clips are written directly into a .npy memmap stored at that path.
+    """
+    shape = (len(files), max_size, 1)
+    if mmap_path is not None:
+        # decode into a temporary file so that an interrupted run does not leave an incomplete cache behind
+        part_path = mmap_path + '.part'
+        out = np.lib.format.open_memmap(part_path, mode='w+', dtype=dtype, shape=shape)
+    elif use_processes:
+        raise ValueError('use_processes requires mmap_path to share the output array')
+    else:
+        out = np.empty(shape, dtype=dtype)
+
+    if use_processes:
+        out.flush()
+        with ProcessPoolExecutor(n_workers) as executor:
+            jobs = [(part_path, k, file_path, max_size) for k, file_path in enumerate(files)]
+            for _ in tqdm(executor.map(_load_into_memmap, jobs, chunksize=16), total=len(files)):
+                pass
+    else:
+        def load_into_array(k):
+            out[k, :, 0] = to_storage_dtype(load_wav(files[k], max_size), dtype)
+
+        # soundfile releases the GIL while decoding so threads scale well
+        with ThreadPoolExecutor(n_workers) as executor:
+            for _ in tqdm(executor.map(load_into_array, range(len(files))), total=len(files)):
+                pass
+
+    if mmap_path is not None:
+        out.flush()
+        del out
+        os.replace(part_path, mmap_path)
+        out = np.load(mmap_path, mmap_mode='r')
+    return out
+
+
+def offsets_path(samples_path):
+    return samples_path[:-len('_samples.npy')] + '_offsets.npy'
+
+
+def load_wavs_ragged(files, max_size, path, n_workers=8, dtype='float32'):
+    """
+    Decode wav files in parallel without padding them into a flat .npy memmap (dtype as in load_wavs) of all samples
+    stored at path, clip k is samples[offsets[k]:offsets[k+1]]. Returns the samples and the offsets, which are stored
+    next to the samples with the suffix _offsets.npy instead of _samples.npy.
+    """
+    offsets = np.concatenate([[0], np.cumsum(clip_lengths(files, max_size))])
+    part_path = path + '.part'
+    out = np.lib.format.open_memmap(part_path, mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+
+    def load_into_array(k):
+        out[offsets[k]:offsets[k + 1]] = to_storage_dtype(load_wav(files[k], max_size, pad=False), dtype)
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        for _ in tqdm(executor.map(load_into_array, range(len(files))), total=len(files)):
+            pass
+
+    out.flush()
+    del out
+    np.save(offsets_path(path), offsets)
+    os.replace(part_path, path)
+    return np.load(path, mmap_mode='r'), offsets
@@ -0,0 +1,275 @@
+import os
+import json
+import numpy as np
+from data.process_data import load_wavs, load_wavs_ragged, offsets_path
+
+CACHE_VERSION = 1
+DTYPES = ['float32', 'float16', 'int16']
+
+
+def machine_of(file_path):
+    # files are stored as <root>/<machine>/<stage>/<file>.wav
+    return file_path.replace('\\', '/').split('/')[-3]
+
+
+def file_stats(files):
+    stats = [os.stat(file) for file in files]
+    return [s.st_size for s in stats], [s.st_mtime_ns for s in stats]
+
+
+class ShardedWaveforms():
+    """
+    Read-only view on per-machine waveform shards that behaves like a single array of shape (n_files, max_size, 1).
+    Indexing only reads the requested rows from the memory-mapped shards.
+    """
+
+    def __init__(self, paths, files=None, machines=None):
+        self.paths = list(paths)
+        self.files = list(files) if files is not None else None
+        self.machines = list(machines) if machines is not None else None
+        self._open()
+
+    def _open(self):
+        self.shards = [np.load(path, mmap_mode='r') for path in self.paths]
+        self.offsets = np.cumsum([0] + [shard.shape[0] for shard in self.shards])
+
+    def __getstate__(self):
+        # only pass the paths to other processes, they open the memmaps on their own
+        return {'paths': self.paths, 'files': self.files, 'machines': self.machines}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),) + self.shards[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self.shards[0].dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def machine(self, name):
+        return self.shards[self.machines.index(name)]
+
+    def gather(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((rows.shape[0],) + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        for k in np.unique(shard_ids):
+            pos = np.flatnonzero(shard_ids == k)
+            local = rows[pos] - self.offsets[k]
+            # read rows in ascending order to keep disk access sequential
+            order = np.argsort(local, kind='stable')
+            out[pos[order]] = self.shards[k][local[order]]
+        return out
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            k = np.searchsorted(self.offsets, idx, side='right') - 1
+            return np.asarray(self.shards[k][idx - self.offsets[k]])
+        if isinstance(idx, slice):
+            return self.gather(np.arange(len(self))[idx])
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return self.gather(idx)
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate(self.shards, axis=0)
+        return out if dtype is None else out.astype(dtype)
+
+
+class RaggedWaveforms():
+    """
+    Read-only view on per-machine shards of unpadded clips of different lengths (flat samples and offsets per shard).
+    Behaves like ShardedWaveforms with shape (n_files, None, 1): indexing with rows returns the clips zero-padded at
+    the end to the longest of them, lengths holds the number of samples of each clip.
+    """
+
+    def __init__(self, paths, max_size, files=None, machines=None):
+        self.paths = list(paths)
+        self.max_size = max_size
+        self.files = list(files) if files is not None else None
+        self.machines = list(machines) if machines is not None else None
+        self._open()
+
+    def _open(self):
+        self.shards = [np.load(path, mmap_mode='r') for path in self.paths]
+        self.clip_offsets = [np.load(offsets_path(path)) for path in self.paths]
+        self.offsets = np.cumsum([0] + [clip_offsets.shape[0] - 1 for clip_offsets in self.clip_offsets])
+        self.lengths = np.concatenate([np.diff(clip_offsets) for clip_offsets in self.clip_offsets])
+
+    def __getstate__(self):
+        return {'paths': self.paths, 'max_size': self.max_size, 'files': self.files, 'machines': self.machines}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]), None, 1)
+
+    @property
+    def dtype(self):
+        return self.shards[0].dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def clip(self, idx):
+        k = np.searchsorted(self.offsets, idx, side='right') - 1
+        local = idx - self.offsets[k]
+        return self.shards[k][self.clip_offsets[k][local]:self.clip_offsets[k][local + 1]]
+
+    def gather(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.zeros((rows.shape[0], int(np.max(self.lengths[rows], initial=0)), 1), dtype=self.dtype)
+        # read clips in ascending order to keep disk access sequential
+        for pos in np.argsort(rows, kind='stable'):
+            clip = self.clip(rows[pos])
+            out[pos, :clip.shape[0], 0] = clip
+        return out
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            return np.asarray(self.clip(idx))[:, None]
+        if isinstance(idx, slice):
+            return self.gather(np.arange(len(self))[idx])
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return self.gather(idx)
+
+
+class WaveformCache():
+    """
+    Waveform cache with one .npy shard and one manifest per machine type and split. A shard is only decoded again if
+    its manifest (files, file sizes, modification times, max_size, sample rate) does not match the files on disk.
+    ragged=True stores the clips unpadded (truncated to max_size) instead of center-padded to max_size.
+    dtype='int16' stores the clips as 16-bit PCM samples and dtype='float16' as half precision floats, both are
+    converted to float32 per batch by the input pipeline.
+    """
+
+    def __init__(self, cache_dir, max_size, sample_rate, n_workers=8, ragged=False, dtype='float32'):
+        if dtype not in DTYPES:
+            raise ValueError('unsupported waveform dtype ' + str(dtype))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.sample_rate = sample_rate
+        self.n_workers = n_workers
+        self.ragged = ragged
+        self.dtype = dtype
+
+    def split_dir(self, split):
+        # caches of different storage formats are kept side by side
+        return os.path.join(self.cache_dir, split + ('_ragged' if self.ragged else '') +
+                            ('_' + self.dtype if self.dtype != 'float32' else ''))
+
+    def shard_path(self, split, machine):
+        return os.path.join(self.split_dir(split), machine + ('_samples.npy' if self.ragged else '_raw.npy'))
+
+    def manifest_path(self, split, machine):
+        return os.path.join(self.split_dir(split), machine + '_manifest.json')
+
+    def build_manifest(self, files):
+        sizes, mtimes = file_stats(files)
+        return {
+            'version': CACHE_VERSION,
+            'sample_rate': self.sample_rate,
+            'max_size': self.max_size,
+            'dtype': self.dtype,
+            'files': list(files),
+            'sizes': sizes,
+            'mtimes': mtimes
+        }
+
+    def read_manifest(self, split, machine):
+        manifest_path = self.manifest_path(split, machine)
+        if not os.path.isfile(manifest_path) or not os.path.isfile(self.shard_path(split, machine)):
+            return None
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def write_manifest(self, split, machine, manifest):
+        manifest_path = self.manifest_path(split, machine)
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.part', manifest_path)
+
+    def is_valid(self, cached, manifest):
+        # the cached file order stays authoritative as long as the same files are cached
+        if cached is None:
+            return False
+        for key in ['version', 'sample_rate', 'max_size']:
+            if cached.get(key) != manifest[key]:
+                return False
+        if cached.get('dtype', 'float32') != manifest['dtype']:
+            return False
+        cached_stats = dict(zip(cached['files'], zip(cached['sizes'], cached['mtimes'])))
+        stats = dict(zip(manifest['files'], zip(manifest['sizes'], manifest['mtimes'])))
+        return cached_stats == stats
+
+    def load_machine(self, split, machine, files):
+        os.makedirs(self.split_dir(split), exist_ok=True)
+        manifest = self.build_manifest(files)
+        cached = self.read_manifest(split, machine)
+        if self.is_valid(cached, manifest):
+            return cached['files']
+        print('Decoding ' + split + ' data of ' + machine)
+        # remove the manifest first so that an interrupted rebuild is never considered valid
+        if os.path.isfile(self.manifest_path(split, machine)):
+            os.remove(self.manifest_path(split, machine))
+        if self.ragged:
+            load_wavs_ragged(files, self.max_size, self.shard_path(split, machine), n_workers=self.n_workers,
+                             dtype=self.dtype)
+        else:
+            load_wavs(files, self.max_size, n_workers=self.n_workers, mmap_path=self.shard_path(split, machine),
+                      dtype=self.dtype)
+        self.write_manifest(split, machine, manifest)
+        return manifest['files']
+
+    def load(self, split, files):
+        machines = []
+        files_per_machine = {}
+        for file in files:
+            machine = machine_of(file)
+            if machine not in files_per_machine:
+                machines.append(machine)
+                files_per_machine[machine] = []
+            files_per_machine[machine].append(file)
+        cached_files = []
+        for machine in machines:
+            cached_files += self.load_machine(split, machine, files_per_machine[machine])
+        return self.waveforms([self.shard_path(split, machine) for machine in machines], cached_files, machines)
+
+    def load_cached(self, split, machines=None):
+        # open existing shards without checking the files on disk, e.g. to load a single machine type
+        split_dir = self.split_dir(split)
+        if machines is None:
+            machines = sorted(f[:-len('_manifest.json')] for f in os.listdir(split_dir) if f.endswith('_manifest.json'))
+        files = []
+        for machine in machines:
+            files += self.read_manifest(split, machine)['files']
+        return self.waveforms([self.shard_path(split, machine) for machine in machines], files, machines)
+
+    def waveforms(self, paths, files, machines):
+        if self.ragged:
+            return RaggedWaveforms(paths, self.max_size, files=files, machines=machines)
+        return ShardedWaveforms(paths, files=files, machines=machines)
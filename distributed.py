@@ -0,0 +1,130 @@
+import os
+import json
+import socket
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+STRATEGIES = ['mirrored', 'multi_worker']
+_strategy = None
+
+
+def configure_local_replicas(n_replicas):
+    # split the CPU into n_replicas logical devices, must be called before tensorflow runs its first operation
+    cpus = tf.config.list_physical_devices('CPU')
+    tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration()] * n_replicas)
+
+
+def get_strategy(config):
+    """
+    Distribution strategy of config['strategy'], created once per process:
+    'mirrored' synchronously trains config['n_replicas'] replicas on the logical CPU devices of this process,
+    'multi_worker' trains one replica per worker process described by the TF_CONFIG environment variable.
+    Returns None for training on a single replica.
+    """
+    global _strategy
+    if config.get('strategy') is None:
+        return None
+    if config['strategy'] not in STRATEGIES:
+        raise ValueError('unknown strategy ' + str(config['strategy']))
+    if _strategy is None:
+        if config['strategy'] == 'mirrored':
+            devices = [device.name for device in tf.config.list_logical_devices('CPU')][:config.get('n_replicas', 2)]
+            _strategy = tf.distribute.MirroredStrategy(devices)
+        else:
+            _strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    return _strategy
+
+
+def distribute_dataset(strategy, make_dataset, n_rows, batch_size):
+    """
+    make_dataset(shard) builds the dataset of shard = (number of workers, worker index), or of all n_rows rows for
+    shard=None. Under a multi-worker strategy, each worker builds the pipeline of its own shard, batched per replica
+    (one replica per worker), and the number of steps per epoch is returned with the dataset, otherwise the dataset of
+    all rows and None.
+    """
+    if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return make_dataset(None), None
+    dataset = strategy.distribute_datasets_from_function(
+        lambda context: make_dataset((context.num_input_pipelines, context.input_pipeline_id)))
+    # same as in make_train_dataset: n_rows // n_workers rows per worker in batches of batch_size // n_workers
+    n_workers = strategy.cluster_resolver.cluster_spec().num_tasks('worker')
+    return dataset, int(np.ceil((n_rows // n_workers) / max(1, batch_size // n_workers)))
+
+
+def is_chief(strategy):
+    if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return True
+    return strategy.cluster_resolver.task_id == 0
+
+
+def local_tf_configs(n_workers):
+    # TF_CONFIG of n_workers worker processes on this machine, each listening on a free port
+    ports = []
+    for _ in range(n_workers):
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            ports.append(s.getsockname()[1])
+    workers = ['localhost:' + str(port) for port in ports]
+    return [json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}})
+            for index in range(n_workers)]
+
+
+def _synthetic_config(n_train, raw_dim, num_classes, epochs, batch_size, data_dir):
+    # tone of a class specific frequency in noise, stored as memmap so that the worker processes can share it
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, num_classes, n_train)
+    t = np.arange(raw_dim) / 16000
+    waveforms = np.lib.format.open_memmap(os.path.join(data_dir, 'train.npy'), mode='w+', dtype=np.float32,
+                                          shape=(n_train, raw_dim, 1))
+    waveforms[:, :, 0] = 0.1 * np.sin(2 * np.pi * (200 + 150 * labels[:, None]) * t) + \
+        0.05 * rng.standard_normal((n_train, raw_dim))
+    waveforms.flush()
+    waveforms = np.load(os.path.join(data_dir, 'train.npy'), mmap_mode='r')
+    return {'train_raw': waveforms, 'train_rows': np.arange(n_train), 'train_labels': labels,
+            'sample_weights': np.ones(n_train), 'eval_raw': waveforms, 'eval_rows': np.arange(n_train),
+            'eval_labels': labels, 'num_classes': num_classes, 'n_subclusters': 4, 'epochs': epochs,
+            'batch_size': batch_size, 'batch_size_test': batch_size, 'checkpoint_dir': None, 'verbose': 2,
+            'memory_efficient_proj': True}
+
+
+def parity(n_workers, n_train, raw_dim, num_classes, epochs, batch_size, tolerance):
+    """
+    Trains the same member on synthetic data in a single process and with n_workers local worker processes and
+    compares the final training losses. Replicas draw different mixup decisions than a single process, so the
+    losses are only expected to agree within tolerance (relative), not exactly.
+    """
+    from ensemble_runner import train_ensemble_parallel, train_ensemble_distributed
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = _synthetic_config(n_train, raw_dim, num_classes, epochs, batch_size, tmp_dir)
+        histories = {}
+        for name, n in [('single', 1), ('distributed', n_workers)]:
+            run_config = dict(config, history_path=os.path.join(tmp_dir, name + '_history.json'))
+            weight_paths = [[os.path.join(tmp_dir, name + '.h5')]]
+            if n == 1:
+                train_ensemble_parallel(weight_paths, run_config, 1)
+            else:
+                train_ensemble_distributed(weight_paths, run_config, n)
+            with open(run_config['history_path'], 'r') as f:
+                histories[name] = json.load(f)['loss']
+            print(name + ' training loss per epoch: ' + str(np.round(histories[name], 4)))
+    difference = abs(histories['distributed'][-1] - histories['single'][-1]) / histories['single'][-1]
+    print('relative difference of the final loss: ' + str(np.round(difference, 4)))
+    return difference <= tolerance
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convergence parity of multi-worker and single-process training '
+                                                 'on synthetic data')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--n-train', type=int, default=256)
+    parser.add_argument('--raw-dim', type=int, default=32000)
+    parser.add_argument('--num-classes', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    if not parity(args.workers, args.n_train, args.raw_dim, args.num_classes, args.epochs, args.batch_size,
+                  args.tolerance):
+        raise SystemExit('distributed training does not converge like single-process training')
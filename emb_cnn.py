@@ -0,0 +1,383 @@
+import tensorflow as tf
+from mixup_layer import MixupLayer
+from feature_exchange import AugLayer
+from subcluster_adacos import SCAdaCos, AdaProj
+
+
+def temporal_mean(spec, keepdims=False):
+    # take average over time but do not consider zeros resulting from padding waveform
+    # spec is a magnitude, frames without positive values are all zero and are divided by one instead of an epsilon
+    # that cannot be represented in float16
+    norm = tf.where(spec>0, tf.ones_like(spec), tf.zeros_like(spec))
+    norm = tf.maximum(tf.reduce_sum(norm, axis=2, keepdims=True), 1)
+    return tf.reduce_sum(spec/norm, axis=1, keepdims=keepdims)
+
+
+def masked_temporal_mean(spec, n_frames, keepdims=False):
+    # temporal_mean of the first n_frames frames of each spectrogram, the remaining frames belong to padding
+    mask = tf.sequence_mask(n_frames, tf.shape(spec)[1], dtype=spec.dtype)[:, :, None, None]
+    return temporal_mean(spec*mask, keepdims=keepdims)
+
+
+def count_frames(lengths, frame_length=1024, frame_step=512):
+    # number of STFT frames (without padding at the end) of clips with the given numbers of samples, at least one
+    return 1 + tf.maximum(lengths - frame_length, 0) // frame_step
+
+
+def pooled_frames(n_frames):
+    # number of time steps left of n_frames frames after the strided convolutions and poolings of embedding_backbone
+    n = (n_frames + 1) // 2
+    n = tf.maximum((n - 3) // 2 + 1, 1)
+    for _ in range(3):
+        n = (n + 1) // 2
+    return n
+
+
+def pad_to_size(x, size):
+    # zero-pad (or cut) clips at the end to size samples, the magnitude of the FFT of a zero-padded clip does not depend
+    # on where the clip is placed, so the FFT features are the same as for clips center-padded to size
+    x = tf.pad(x, [[0, 0], [0, tf.maximum(size - tf.shape(x)[1], 0)], [0, 0]])[:, :size]
+    return tf.reshape(x, [-1, size, 1])
+
+
+def pad_frames(x, max_frames, frame_length=1024, frame_step=512):
+    # zero-pad (or cut) clips at the end to a number of STFT frames equal to max_frames modulo 64, the strided layers of
+    # the backbone then pad their inputs like for clips with max_frames frames and sample the same time steps
+    # at least 5 frames are needed for the pooling of the first block, the channel axis is dropped
+    min_frames = max_frames % 64 + (64 if max_frames % 64 < 5 else 0)
+    n_frames = count_frames(tf.shape(x)[1], frame_length, frame_step)
+    n_frames = tf.maximum(max_frames + 64 * ((n_frames - max_frames + 63) // 64), min_frames)
+    size = frame_length + (n_frames - 1) * frame_step
+    return tf.pad(x[:, :, 0], [[0, 0], [0, tf.maximum(size - tf.shape(x)[1], 0)]])[:, :size]
+
+
+def masked_normalization(inputs):
+    # CMN-like normalization with the mean over the frames of the clips, padded frames are set to zero
+    x, n_frames = inputs
+    mask = tf.sequence_mask(n_frames, tf.shape(x)[1], dtype=x.dtype)[:, :, None, None]
+    return (x - masked_temporal_mean(x, n_frames, keepdims=True)) * mask
+
+
+def masked_max_over_time(inputs):
+    # maximum over the time steps of the clips, time steps that only belong to padding are ignored
+    x, n_frames = inputs
+    mask = tf.sequence_mask(pooled_frames(n_frames), tf.shape(x)[1])[:, :, None, None]
+    return tf.reduce_max(tf.where(mask, x, tf.cast(x.dtype.min, x.dtype)), axis=1, keepdims=True)
+
+
+class GetWelch(tf.keras.layers.Layer):
+    def __init__(self, nperseg=4096, noverlap=2048, **kwargs):
+        super(GetWelch, self).__init__(**kwargs)
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+
+    def build(self, input_shape):
+        super(GetWelch, self).build(input_shape)
+
+    def call(self, waveform):
+        # Compute the spectrogram
+        stfts = tf.signal.stft(waveform, frame_length=self.nperseg, frame_step=self.nperseg - self.noverlap, fft_length=self.nperseg)
+        spectrograms = tf.abs(stfts)
+
+        # Power spectrogram
+        Sxx = tf.square(spectrograms)
+
+        # Average over time
+        Sxx = temporal_mean(Sxx)
+
+        # Logarithmic scaling
+        EPS = 1e-16
+        Sxx = tf.math.log(Sxx + EPS)
+
+        return Sxx#tf.squeeze(Sxx, axis=0)
+
+    def get_config(self):
+        config = {
+            'nperseg': self.nperseg,
+            'noverlap': self.noverlap
+        }
+        config.update(super(GetWelch, self).get_config())
+        return config
+
+
+class MagnitudeSpectrogram(tf.keras.layers.Layer):
+    """
+    Compute magnitude spectrograms.
+    https://towardsdatascience.com/how-to-easily-process-audio-on-your-gpu-with-tensorflow-2d9d91360f06
+    """
+
+    def __init__(self, sample_rate, fft_size, hop_size, **kwargs):
+        super(MagnitudeSpectrogram, self).__init__(**kwargs)
+        self.sample_rate = sample_rate
+        self.fft_size = fft_size
+        self.hop_size = hop_size
+
+    def build(self, input_shape):
+        super(MagnitudeSpectrogram, self).build(input_shape)
+
+    def call(self, waveforms):
+        spectrograms = tf.signal.stft(waveforms,
+                                      frame_length=self.fft_size,
+                                      frame_step=self.hop_size,
+                                      pad_end=False)
+        magnitude_spectrograms = tf.abs(spectrograms)
+        magnitude_spectrograms = tf.expand_dims(magnitude_spectrograms, 3)
+        return magnitude_spectrograms
+
+    def get_config(self):
+        config = {
+            'fft_size': self.fft_size,
+            'hop_size': self.hop_size,
+            'sample_rate': self.sample_rate
+        }
+        config.update(super(MagnitudeSpectrogram, self).get_config())
+        return config
+
+def mixupLoss(y_true, y_pred):
+    target = y_pred[:, :, 1]  # mixed-up labels
+    output = y_pred[:, :, 0]  # mixed-up predictions
+    return tf.keras.losses.categorical_crossentropy(target, output)
+
+
+def fft_features(x):
+    #return tf.math.abs(tf.signal.fft(tf.complex(x[:, :, 0], tf.zeros_like(x[:, :, 0]))))[:, :int(raw_dim / 2)]
+    return tf.math.abs(tf.signal.fft(tf.complex(x[:, :, 0], tf.zeros_like(x[:, :, 0]))))[:, :8000]  # should one use a zero filter here too?
+
+
+def frontend(x, raw_dim, lengths=None):
+    # parameter-free feature extraction, its outputs can be computed once per clip and cached for inference
+    # the frontend always runs in float32, also under a mixed precision policy
+    # with lengths, x holds clips padded to the longest clip of the batch and the numbers of frames are returned as well
+    if lengths is not None:
+        x_fft = tf.keras.layers.Lambda(pad_to_size, arguments={'size': raw_dim}, dtype='float32')(x)
+        x_fft = tf.keras.layers.Lambda(fft_features, name='fft_features', dtype='float32')(x_fft)
+        x_spec = tf.keras.layers.Lambda(pad_frames, arguments={'max_frames': 1 + (raw_dim - 1024) // 512},
+                                        dtype='float32')(x)
+        x_spec = MagnitudeSpectrogram(16000, 1024, 512, name='magnitude_spectrogram', dtype='float32')(x_spec)
+        n_frames = tf.keras.layers.Lambda(count_frames, name='n_frames')(lengths)
+        return x_fft, x_spec, n_frames
+    x_fft = tf.keras.layers.Lambda(fft_features, name='fft_features', dtype='float32')(x)
+    #x = tf.keras.layers.Reshape((raw_dim,), dtype='float32')(x)
+    #x = GetWelch(dtype='float32')(x)
+    x_spec = tf.keras.layers.Reshape((raw_dim,), dtype='float32')(x)
+    x_spec = MagnitudeSpectrogram(16000, 1024, 512, name='magnitude_spectrogram', dtype='float32')(x_spec)
+    return x_fft, x_spec
+
+
+def frontend_model(raw_dim, variable_length=False):
+    # variable_length takes [clips padded to the longest clip of the batch, lengths of the clips] like model_emb_cnn
+    if variable_length:
+        data_input = [tf.keras.layers.Input(shape=(None, 1), dtype='float32'),
+                      tf.keras.layers.Input(shape=(), dtype='int32')]
+        return tf.keras.Model(data_input, list(frontend(data_input[0], raw_dim, lengths=data_input[1])),
+                              name='frontend')
+    data_input = tf.keras.layers.Input(shape=(raw_dim, 1), dtype='float32')
+    x_fft, x_spec = frontend(data_input, raw_dim)
+    return tf.keras.Model(data_input, [x_fft, x_spec], name='frontend')
+
+
+def embedding_backbone(fft_dim, spec_shape, use_bias=False, variable_length=False):
+    # variable_length takes spectrograms with any number of frames and the numbers of frames of the clips as third input
+    fft_input = tf.keras.layers.Input(shape=(fft_dim,), dtype='float32')
+    spec_input = tf.keras.layers.Input(shape=spec_shape, dtype='float32')
+    inputs = [fft_input, spec_input]
+    if variable_length:
+        frames_input = tf.keras.layers.Input(shape=(), dtype='int32')
+        inputs.append(frames_input)
+    l2_weight_decay = tf.keras.regularizers.l2(1e-5)
+
+    # FFT
+    x = tf.keras.layers.Reshape((-1,1))(fft_input)
+    x = tf.keras.layers.Conv1D(128, 256, strides=64, activation='linear', padding='same',
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.Conv1D(128, 64, strides=32, activation='linear', padding='same',
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.Conv1D(128, 16, strides=4, activation='linear', padding='same',
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.ReLU()(x)
+
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.ReLU()(x)
+
+    emb_fft = tf.keras.layers.Dense(256, name='emb_fft', kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+
+    # magnitude
+    x = spec_input
+
+    if variable_length:
+        x = tf.keras.layers.Lambda(masked_normalization, dtype='float32')([x, frames_input])
+    else:
+        x = tf.keras.layers.Lambda(lambda x: x-temporal_mean(x, keepdims=True), dtype='float32')(x) # CMN-like normalization
+    x = tf.keras.layers.BatchNormalization(axis=-2)(x)
+
+    # first block
+    x = tf.keras.layers.Conv2D(16, 7, strides=2, activation='linear', padding='same',
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.ReLU()(x)
+    x = tf.keras.layers.MaxPooling2D(3, strides=2)(x)
+
+    # second block
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.Add()([x, xr])
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.Add()([x, xr])
+
+    # third block
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(32, 3, strides=(2, 2), activation='linear', padding='same',
+                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
+    x = tf.keras.layers.Conv2D(kernel_size=1, filters=32, strides=1, padding="same",
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.Add()([x, xr])
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.Add()([x, xr])
+
+    # fourth block
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(64, 3, strides=(2, 2), activation='linear', padding='same',
+                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
+    x = tf.keras.layers.Conv2D(kernel_size=1, filters=64, strides=1, padding="same",
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.Add()([x, xr])
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.Add()([x, xr])
+
+    # fifth block
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(128, 3, strides=(2, 2), activation='linear', padding='same',
+                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
+    x = tf.keras.layers.Conv2D(kernel_size=1, filters=128, strides=1, padding="same",
+                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
+    x = tf.keras.layers.Add()([x, xr])
+    x = tf.keras.layers.BatchNormalization()(x)
+    xr = tf.keras.layers.ReLU()(x)
+    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    xr = tf.keras.layers.BatchNormalization()(xr)
+    xr = tf.keras.layers.ReLU()(xr)
+    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
+                                use_bias=use_bias)(xr)
+    x = tf.keras.layers.Add()([x, xr])
+
+    if variable_length:
+        # same as the pooling below for clips of max_size samples
+        x = tf.keras.layers.Lambda(masked_max_over_time)([x, frames_input])
+    else:
+        x = tf.keras.layers.MaxPooling2D((18, 1), padding='same')(x)
+    x = tf.keras.layers.Flatten(name='flat')(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    emb_mel = tf.keras.layers.Dense(256, kernel_regularizer=l2_weight_decay, name='emb_mel', use_bias=use_bias)(x)
+
+    return tf.keras.Model(inputs, [emb_fft, emb_mel], name='embedding_backbone')
+
+
+def model_emb_cnn(num_classes, raw_dim, n_subclusters, use_bias=False, memory_efficient_proj=False, s_update_interval=1,
+                  variable_length=False):
+    # variable_length takes [clips padded to the longest clip of the batch, lengths of the clips] as data input,
+    # raw_dim is then only the FFT size, clips must not be longer than raw_dim
+    label_input = tf.keras.layers.Input(shape=(num_classes,), dtype='float32')
+    y = label_input
+    # under a mixed precision policy, only the backbone runs in float16/bfloat16, the layers with dtype='float32' keep
+    # mixup, the frontend, the normalization and the classification heads with their angles and scale updates in float32
+    if variable_length:
+        data_input = [tf.keras.layers.Input(shape=(None, 1), dtype='float32'),
+                      tf.keras.layers.Input(shape=(), dtype='int32')]
+        x_mix, y_mix, lengths_mix = MixupLayer(prob=0.5, dtype='float32')([data_input[0], y, data_input[1]])
+        features = frontend(x_mix, raw_dim, lengths=lengths_mix)
+    else:
+        data_input = tf.keras.layers.Input(shape=(raw_dim, 1), dtype='float32')
+        x_mix, y_mix = MixupLayer(prob=0.5, dtype='float32')([data_input, y])
+        features = frontend(x_mix, raw_dim)
+
+    backbone = embedding_backbone(features[0].shape[-1], tuple(features[1].shape[1:]), use_bias=use_bias,
+                                  variable_length=variable_length)
+    emb_fft, emb_mel = backbone(list(features))
+
+    emb_mel_ssl, emb_fft_ssl, y_ssl = AugLayer(prob=0.5, dtype='float32')([emb_mel,emb_fft,y_mix])
+    # prepare output
+    x = tf.keras.layers.Concatenate(axis=-1, name='emb', dtype='float32')([emb_fft, emb_mel])
+    x_ssl = tf.keras.layers.Concatenate(axis=-1, dtype='float32')([emb_fft_ssl, emb_mel_ssl])
+
+    output_ssl = AdaProj(n_classes=num_classes*3, n_subclusters=n_subclusters, trainable=False,
+                         memory_efficient=memory_efficient_proj, s_update_interval=s_update_interval,
+                         dtype='float32')([x_ssl, y_ssl, label_input])  # compare with trainable equals True
+    output = AdaProj(n_classes=num_classes, n_subclusters=n_subclusters, trainable=False,
+                     memory_efficient=memory_efficient_proj, s_update_interval=s_update_interval,
+                     dtype='float32')([x, y_mix, label_input])
+
+    loss_output = tf.keras.layers.Lambda(lambda x: tf.stack(x, axis=-1), dtype='float32')([output, y_mix])
+    loss_output_ssl = tf.keras.layers.Lambda(lambda x: tf.stack(x, axis=-1), dtype='float32')([output_ssl, y_ssl])
+
+    return data_input, label_input, loss_output, loss_output_ssl
+
+
+def emb_model_from_features(model):
+    # inference model starting from cached frontend features, shares all weights with the trained model
+    backbone = model.get_layer('embedding_backbone')
+    emb = tf.keras.layers.Concatenate(axis=-1, dtype='float32')(backbone.outputs)
+    return tf.keras.Model(backbone.inputs, emb)
+
+
+custom_objects = {'MixupLayer': MixupLayer, 'mixupLoss': mixupLoss, 'SCAdaCos': SCAdaCos, 'AdaProj': AdaProj,
+                  'MagnitudeSpectrogram': MagnitudeSpectrogram, 'AugLayer': AugLayer, 'fft_features': fft_features,
+                  'pad_to_size': pad_to_size, 'pad_frames': pad_frames, 'count_frames': count_frames,
+                  'masked_normalization': masked_normalization, 'masked_max_over_time': masked_max_over_time}
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+SPLITS = ['train', 'eval', 'unknown', 'test']
+
+
+def weights_hash(weight_path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(weight_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()[:16]
+
+
+def stamps_hash(split_files, split_stamps):
+    # identifies the clips of all splits together with their sizes and modification times
+    sha1 = hashlib.sha1()
+    for split in SPLITS:
+        sha1.update(json.dumps([str(f) for f in split_files[split]]).encode('utf-8'))
+        sha1.update(np.ascontiguousarray(split_stamps[split], dtype=np.int64).tobytes())
+    return sha1.hexdigest()[:16]
+
+
+class EmbeddingStore():
+    """
+    Embeddings of each ensemble member stored as float32 .npy files together with the corresponding file names and
+    optionally their sizes and modification times when they were embedded.
+    Entries are keyed by member, hash of the weight file and dataset split and can be opened as memmaps, so that
+    scoring and evaluation do not need tensorflow.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def entry_dir(self, member, w_hash):
+        return os.path.join(self.store_dir, member, w_hash)
+
+    def paths(self, member, w_hash, split):
+        entry_dir = self.entry_dir(member, w_hash)
+        return os.path.join(entry_dir, split + '_embs.npy'), os.path.join(entry_dir, split + '_files.npy')
+
+    def stamps_path(self, member, w_hash, split):
+        return os.path.join(self.entry_dir(member, w_hash), split + '_stamps.npy')
+
+    def has(self, member, w_hash, splits=SPLITS):
+        return all(os.path.isfile(path) for split in splits for path in self.paths(member, w_hash, split))
+
+    def save(self, member, w_hash, split, embs, files, stamps=None):
+        # stamps: (size, modification time) of each file, as returned by data.waveform_cache.file_stats
+        if len(embs) != len(files):
+            raise ValueError('number of embeddings and files does not match')
+        os.makedirs(self.entry_dir(member, w_hash), exist_ok=True)
+        embs_path, files_path = self.paths(member, w_hash, split)
+        # embeddings are written last so that an entry is only complete after all files were written
+        np.save(files_path, np.array(files))
+        if stamps is not None:
+            np.save(self.stamps_path(member, w_hash, split), np.asarray(stamps, dtype=np.int64))
+        elif os.path.isfile(self.stamps_path(member, w_hash, split)):
+            os.remove(self.stamps_path(member, w_hash, split))
+        np.save(embs_path + '.part.npy', np.asarray(embs, dtype=np.float32))
+        os.replace(embs_path + '.part.npy', embs_path)
+
+    def load(self, member, w_hash, split, mmap_mode='r'):
+        embs_path, files_path = self.paths(member, w_hash, split)
+        return np.load(embs_path, mmap_mode=mmap_mode), np.load(files_path)
+
+    def reuse(self, member, w_hash, split, files, stamps):
+        """
+        Stored embeddings of files that were embedded with the same weights and have not changed since.
+        Returns the embeddings with one row per file (None if nothing is stored) and the indices of the files that are
+        new or changed and have to be embedded, their rows of the embeddings are left zero.
+        """
+        if not self.has(member, w_hash, [split]) or not os.path.isfile(self.stamps_path(member, w_hash, split)):
+            return None, np.arange(len(files))
+        stored, stored_files = self.load(member, w_hash, split)
+        stored_stamps = np.load(self.stamps_path(member, w_hash, split))
+        row_of = dict((f, k) for k, f in enumerate(stored_files))
+        rows = np.array([row_of.get(f, -1) for f in files], dtype=np.int64)
+        valid = rows >= 0
+        valid[valid] = np.all(stored_stamps[rows[valid]] == np.asarray(stamps, dtype=np.int64)[valid], axis=1)
+        embs = np.zeros((len(files), stored.shape[1]), dtype=np.float32)
+        embs[valid] = stored[rows[valid]]
+        return embs, np.flatnonzero(~valid)
+
+    def entries(self):
+        # all stored (member, weights hash) pairs
+        if not os.path.isdir(self.store_dir):
+            return []
+        return [(member, w_hash) for member in sorted(os.listdir(self.store_dir))
+                for w_hash in sorted(os.listdir(os.path.join(self.store_dir, member)))]
+
+    def find(self, w_hash):
+        # member whose embeddings were computed with the given weights, None if there is none
+        members = [member for member, stored_hash in self.entries() if stored_hash == w_hash]
+        return members[0] if len(members) > 0 else None
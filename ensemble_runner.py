@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import pickle
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+from emb_cnn import mixupLoss, model_emb_cnn
+from input_pipeline import make_train_dataset
+from instrumentation import ProfilerCallback
+from distributed import get_strategy, distribute_dataset, is_chief, local_tf_configs
+
+
+def build_model(config):
+    # mixed precision policy of the model, e.g. 'mixed_bfloat16', the numerically sensitive layers stay in float32
+    tf.keras.mixed_precision.set_global_policy(config.get('mixed_precision') or 'float32')
+    # the default strategy trains a single replica
+    with (get_strategy(config) or tf.distribute.get_strategy()).scope():
+        # clips of a ragged waveform store are padded to max_size for the FFT only
+        variable_length = config.get('variable_length', False)
+        raw_dim = config['train_raw'].max_size if variable_length else config['train_raw'].shape[1]
+        data_input, label_input, loss_output, loss_output_ssl = model_emb_cnn(num_classes=config['num_classes'],
+                                                                              raw_dim=raw_dim,
+                                                                              n_subclusters=config['n_subclusters'],
+                                                                              use_bias=False,
+                                                                              memory_efficient_proj=config.get('memory_efficient_proj', False),
+                                                                              s_update_interval=config.get('s_update_interval', 1),
+                                                                              variable_length=variable_length)
+        model = tf.keras.Model(inputs=[data_input, label_input], outputs=[loss_output, loss_output_ssl])
+        model.compile(loss=[mixupLoss, mixupLoss], optimizer=tf.keras.optimizers.Adam(), loss_weights=[1, 1])
+    return model
+
+
+def checkpoint_dir(config, weight_path):
+    # one directory with per-epoch checkpoints (weights, optimizer state and adaptive scales) per weight file
+    if config.get('checkpoint_dir') is None:
+        return None
+    return os.path.join(config['checkpoint_dir'], os.path.splitext(os.path.basename(weight_path))[0])
+
+
+def fit_model(model, config, seed=None, backup_dir=None, profile_dir=None):
+    # an interrupted fit resumes from the last completed epoch, the backup files are removed once training finished
+    callbacks = []
+    if backup_dir is not None:
+        callbacks.append(tf.keras.callbacks.BackupAndRestore(backup_dir))
+    # opt-in profiler trace of config['profile_steps'] = (first step, number of steps)
+    if profile_dir is not None and config.get('profile_steps') is not None:
+        callbacks.append(ProfilerCallback(profile_dir, *config['profile_steps']))
+    # each worker of a multi-worker strategy reads its own part of every (equally shuffled) epoch
+    strategy = get_strategy(config)
+    train_data, steps = distribute_dataset(strategy, lambda shard: make_train_dataset(
+        config['train_raw'], config['train_rows'], config['train_labels'], config['num_classes'], config['batch_size'],
+        sample_weights=config['sample_weights'], seed=seed, shard=shard), len(config['train_rows']), config['batch_size'])
+    validation_data, validation_steps = distribute_dataset(strategy, lambda shard: make_train_dataset(
+        config['eval_raw'], config['eval_rows'], config['eval_labels'], config['num_classes'], config['batch_size_test'],
+        shuffle=False, shard=shard), len(config['eval_rows']), config['batch_size_test'])
+    model.fit(
+        train_data,
+        steps_per_epoch=steps,
+        verbose=config.get('verbose', 1),
+        epochs=config['epochs'],
+        validation_data=validation_data,
+        validation_steps=validation_steps,
+        callbacks=callbacks
+        )
+    return model
+
+
+def split_cores(n_slots):
+    # partition the cores available to this process into disjoint sets, one per worker
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    return [[int(core) for core in chunk] for chunk in np.array_split(cores, n_slots) if len(chunk) > 0]
+
+
+def _train_members(jobs, cores, config):
+    # runs in a separate process, restrict it to its own cores and thread budget before tensorflow starts working
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, len(cores)))
+    # all workers of a multi-worker strategy use the same seeds and save the model together, only the weights of the
+    # chief are kept
+    chief = is_chief(get_strategy(config))
+    for k_ensemble, weight_paths in jobs:
+        seed = config.get('seed', 0) + int(k_ensemble)
+        tf.keras.utils.set_random_seed(seed)
+        model = build_model(config)
+        for k, weight_path in enumerate(weight_paths):
+            print('ensemble iteration: ' + str(k_ensemble+1) + ', aeon: ' + str(k+1) + ', cores: ' + str(cores))
+            fit_model(model, config, seed=seed, backup_dir=checkpoint_dir(config, weight_path))
+            if chief:
+                model.save(weight_path)
+                if config.get('history_path') is not None:
+                    with open(config['history_path'], 'w') as f:
+                        json.dump(model.history.history, f)
+            else:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    model.save(os.path.join(tmp_dir, os.path.basename(weight_path)))
+        tf.keras.backend.clear_session()
+
+
+def train_ensemble_parallel(weight_paths, config, n_parallel):
+    """
+    Train ensemble members concurrently in n_parallel worker processes with disjoint sets of cores.
+    weight_paths contains one list of weight files (one per aeon) for each ensemble member. Members whose final weight
+    file already exists are skipped. The waveform stores in config are shared read-only via their memmaps.
+    """
+    jobs = [(k_ensemble, paths) for k_ensemble, paths in enumerate(weight_paths) if not os.path.isfile(paths[-1])]
+    if len(jobs) == 0:
+        return
+    n_parallel = min(n_parallel, len(jobs))
+    core_slots = split_cores(n_parallel)
+    # workers are started as fresh interpreters running this file, main.py is a script and must not be re-imported
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        processes = []
+        for slot, cores in enumerate(core_slots):
+            job_path = os.path.join(tmp_dir, 'jobs_' + str(slot) + '.pkl')
+            with open(job_path, 'wb') as f:
+                pickle.dump({'jobs': jobs[slot::len(core_slots)], 'cores': cores, 'config': config}, f)
+            processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), job_path]))
+        failed = [slot for slot, process in enumerate(processes) if process.wait() != 0]
+    if len(failed) > 0:
+        raise RuntimeError('training failed in worker(s) ' + str(failed))
+
+
+def train_ensemble_distributed(weight_paths, config, n_workers):
+    """
+    Train the ensemble members one after another, each synchronously on n_workers local worker processes with
+    MultiWorkerMirroredStrategy and disjoint sets of cores. The global batch size stays config['batch_size'].
+    Members whose final weight file already exists are skipped.
+    """
+    jobs = [(k_ensemble, paths) for k_ensemble, paths in enumerate(weight_paths) if not os.path.isfile(paths[-1])]
+    if len(jobs) == 0:
+        return
+    config = dict(config, strategy='multi_worker')
+    core_slots = split_cores(n_workers)
+    if len(core_slots) < n_workers:
+        # fewer cores than workers, the workers share all cores
+        core_slots = [sum(core_slots, [])] * n_workers
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        processes = []
+        for slot, tf_config in enumerate(local_tf_configs(n_workers)):
+            job_path = os.path.join(tmp_dir, 'jobs_' + str(slot) + '.pkl')
+            with open(job_path, 'wb') as f:
+                pickle.dump({'jobs': jobs, 'cores': core_slots[slot], 'config': config}, f)
+            processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), job_path],
+                                              env=dict(os.environ, TF_CONFIG=tf_config)))
+        failed = [slot for slot, process in enumerate(processes) if process.wait() != 0]
+    if len(failed) > 0:
+        raise RuntimeError('distributed training failed in worker(s) ' + str(failed))
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as f:
+        job = pickle.load(f)
+    _train_members(job['jobs'], job['cores'], job['config'])
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import hmean
+from scoring import group_rows
+
+# order of the columns of final_results_dev and final_results_eval
+METRICS = ['auc_source', 'pauc_source', 'auc_target', 'pauc_target', 'auc', 'pauc']
+
+
+def roc_areas(scores, y_true, weights=None, max_fpr=0.1):
+    """
+    AUC and standardized partial AUC (McClish correction as in sklearn's roc_auc_score with max_fpr) of scores that are
+    already sorted in descending order. weights of shape (n_resamples, n) count how often each sample is drawn and
+    give one result per row, no weights give a single result. NaN is returned if one of the classes is missing.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    if weights is None:
+        weights = np.ones((1, len(scores)))
+    if len(scores) == 0:
+        return np.full(len(weights), np.nan), np.full(len(weights), np.nan)
+    # one ROC point for each distinct threshold, i.e. at the end of each group of tied scores
+    ends = np.append(np.flatnonzero(scores[1:] != scores[:-1]), len(scores) - 1)
+    tps = np.cumsum(weights * y_true, axis=-1)[:, ends]
+    fps = np.cumsum(weights * (1 - y_true), axis=-1)[:, ends]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tpr = np.concatenate([np.zeros((len(weights), 1)), tps / tps[:, -1:]], axis=1)
+        fpr = np.concatenate([np.zeros((len(weights), 1)), fps / fps[:, -1:]], axis=1)
+        x0, x1, y0, y1 = fpr[:, :-1], fpr[:, 1:], tpr[:, :-1], tpr[:, 1:]
+        auc = np.sum((x1 - x0) * (y0 + y1) / 2, axis=1)
+        # trapezoids clipped at max_fpr, the last one interpolated linearly
+        x_clip = np.minimum(x1, max_fpr)
+        y_clip = np.where(x1 > x_clip, y0 + (y1 - y0) * (x_clip - x0) / np.where(x1 > x0, x1 - x0, 1), y1)
+        partial_auc = np.sum(np.where(x0 < max_fpr, (x_clip - x0) * (y0 + y_clip) / 2, 0), axis=1)
+    min_area = 0.5 * max_fpr**2
+    max_area = max_fpr
+    p_auc = 0.5 * (1 + (partial_auc - min_area) / (max_area - min_area))
+    return auc, p_auc
+
+
+def section_metrics(scores, y_true, source, weights=None, max_fpr=0.1):
+    # scores are sorted once, the domain subsets keep this order and are evaluated by masking the sorted arrays
+    order = np.argsort(-scores, kind='stable')
+    scores, y_true, source = scores[order], y_true[order], source[order]
+    if weights is not None:
+        weights = weights[:, order]
+    metrics = {}
+    for name, mask in [('_source', source), ('_target', ~source), ('', np.ones(len(scores), dtype=bool))]:
+        metrics['auc' + name], metrics['pauc' + name] = roc_areas(
+            scores[mask], y_true[mask], None if weights is None else weights[:, mask], max_fpr)
+    return metrics
+
+
+def summarize(sections):
+    """
+    Harmonic means of the metrics of all sections of each machine type and of all sections (row 'all'), together with
+    the mean of AUC and pAUC.
+    """
+    rows = {machine: sections.loc[sections['machine'] == machine, METRICS]
+            for machine in sorted(sections['machine'].unique())}
+    rows['all'] = sections[METRICS]
+    summary = pd.DataFrame({name: hmean(values.to_numpy(), axis=0) for name, values in rows.items()},
+                           index=METRICS).transpose()
+    summary['auc_pauc_mean'] = (summary['auc'] + summary['pauc']) / 2
+    return summary
+
+
+def _bootstrap_weights(y_true, source, n_bootstrap, rng):
+    # resample within each combination of class and domain so that every resample contains all of them
+    weights = np.zeros((n_bootstrap, len(y_true)))
+    for cell in [(y_true == y) & (source == s) for y in [0, 1] for s in [False, True]]:
+        rows = np.flatnonzero(cell)
+        if len(rows) > 0:
+            weights[:, rows] = rng.multinomial(len(rows), np.full(len(rows), 1 / len(rows)), size=n_bootstrap)
+    return weights
+
+
+def evaluate(scores, y_true, source, section_ids, max_fpr=0.1, n_bootstrap=0, confidence=0.95, seed=0):
+    """
+    Evaluates anomaly scores (higher is more anomalous) of all sections at once. section_ids are strings of the form
+    machine_section, y_true is 1 for anomalous and 0 for normal samples and source marks samples of the source domain.
+    Returns a DataFrame with the metrics of each section and a DataFrame with their harmonic means, which contains
+    bootstrap confidence intervals (columns metric_low and metric_high) if n_bootstrap > 0.
+    """
+    scores, y_true, source = np.asarray(scores), np.asarray(y_true).astype(int), np.asarray(source).astype(bool)
+    groups = group_rows(np.asarray(section_ids))
+    sections = pd.DataFrame([{name: value[0] for name, value in
+                              section_metrics(scores[rows], y_true[rows], source[rows], max_fpr=max_fpr).items()}
+                             for rows in groups.values()], index=pd.Index(list(groups.keys()), name='section'))
+    sections['machine'] = [section.split('_')[0] for section in sections.index]
+    summary = summarize(sections)
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(seed)
+        # metrics of all resamples of each section, shape (n_sections, n_bootstrap) per metric
+        resampled = [section_metrics(scores[rows], y_true[rows], source[rows],
+                                     _bootstrap_weights(y_true[rows], source[rows], n_bootstrap, rng), max_fpr)
+                     for rows in groups.values()]
+        resampled = {name: np.stack([r[name] for r in resampled]) for name in METRICS}
+        machines = sections['machine'].to_numpy()
+        quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+        for name in METRICS:
+            for row in summary.index:
+                values = resampled[name] if row == 'all' else resampled[name][machines == row]
+                summary.loc[row, [name + '_low', name + '_high']] = np.quantile(hmean(values, axis=0), quantiles)
+    return sections, summary
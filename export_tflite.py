@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from emb_cnn import emb_model_from_features, custom_objects
+from feature_store import FeatureStore
+from input_pipeline import make_feature_dataset
+from embedding_store import EmbeddingStore, weights_hash
+from clustering import SectionClusterer
+from scoring import length_norm, build_references, SectionScorer
+from evaluation import evaluate, METRICS
+from scoring_service import section_of
+
+MODES = ['float32', 'float16', 'int8']
+
+
+def convert(emb_model, mode, calibration=None):
+    """
+    Converts the embedding model (cached frontend features -> embedding) into a TFLite flatbuffer.
+    float16 stores the weights as float16, int8 quantizes weights and activations after calibrating the activation
+    ranges on calibration, a pair of fft and spectrogram feature arrays of training clips. Operations without int8
+    kernels fall back to float32, inputs and outputs always stay float32.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(emb_model)
+    if mode == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        if calibration is None:
+            raise ValueError('int8 quantization needs calibration data')
+
+        # keyed by input name, the converted model does not keep the order of the Keras inputs
+        def representative_dataset():
+            for k in range(len(calibration[0])):
+                yield {emb_model.input_names[0]: np.asarray(calibration[0][k:k+1], dtype=np.float32),
+                       emb_model.input_names[1]: np.asarray(calibration[1][k:k+1], dtype=np.float32)}
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    elif mode != 'float32':
+        raise ValueError('unknown mode ' + mode)
+    return converter.convert()
+
+
+def export_member(weight_path, export_dir, modes, calibration=None):
+    # one artifact per member and mode, named after the weight file
+    model = tf.keras.models.load_model(weight_path, custom_objects=custom_objects)
+    emb_model = emb_model_from_features(model)
+    os.makedirs(export_dir, exist_ok=True)
+    paths = {}
+    for mode in modes:
+        paths[mode] = os.path.join(export_dir, os.path.splitext(os.path.basename(weight_path))[0] + '_' + mode + '.tflite')
+        with open(paths[mode], 'wb') as f:
+            f.write(convert(emb_model, mode, calibration))
+    return emb_model, paths
+
+
+class TFLiteEmbedder():
+    """
+    Computes embeddings from frontend features with an exported TFLite model, the same inputs as
+    emb_model_from_features.
+    """
+
+    def __init__(self, model_path, n_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=n_threads)
+        self.interpreter.allocate_tensors()
+        inputs = self.interpreter.get_input_details()
+        # the fft input is the one with rank 2, the spectrogram input has rank 4
+        self.fft_index = [d['index'] for d in inputs if len(d['shape']) == 2][0]
+        self.spec_index = [d['index'] for d in inputs if len(d['shape']) != 2][0]
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def resize(self, x_fft, x_spec):
+        if self.batch_size != x_fft.shape[0]:
+            self.interpreter.resize_tensor_input(self.fft_index, x_fft.shape)
+            self.interpreter.resize_tensor_input(self.spec_index, x_spec.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = x_fft.shape[0]
+
+    def predict(self, x_fft, x_spec, batch_size=32, rows=None):
+        # only the rows of the current batch are read from (memory-mapped) feature arrays
+        if rows is None:
+            rows = np.arange(len(x_fft))
+        embs = []
+        for start in range(0, len(rows), batch_size):
+            fft_batch = np.asarray(x_fft[rows[start:start + batch_size]], dtype=np.float32)
+            spec_batch = np.asarray(x_spec[rows[start:start + batch_size]], dtype=np.float32)
+            self.resize(fft_batch, spec_batch)
+            self.interpreter.set_tensor(self.fft_index, fft_batch)
+            self.interpreter.set_tensor(self.spec_index, spec_batch)
+            self.interpreter.invoke()
+            embs.append(self.interpreter.get_tensor(self.output_index).copy())
+        return np.concatenate(embs, axis=0)
+
+
+def dev_results(embs, files, sections, n_subclusters):
+    # development set results of a single member computed from its embeddings, as in main.py
+    labels = {split: np.array([sections.index(section_of(f)) for f in files[split]]) for split in embs}
+    source = {split: np.array([f.split('_')[3] == 'source' for f in files[split]]) for split in embs}
+    x_ln = {split: length_norm(embs[split]) for split in embs}
+    scorer = SectionScorer(labels)
+    centroids = SectionClusterer(n_subclusters).fit(x_ln['train'], scorer.groups['train'], source['train'])
+    dists = scorer.score(x_ln, build_references(x_ln['train'], scorer.groups['train'], source['train'], centroids))
+    # scores for the section of each clip are the minimum of the target and source distance
+    _, summary = evaluate(np.concatenate([np.min(dists['eval'], axis=1), np.min(dists['unknown'], axis=1)]),
+                          np.concatenate([np.zeros(len(files['eval'])), np.ones(len(files['unknown']))]),
+                          np.concatenate([source['eval'], source['unknown']]),
+                          np.concatenate([[section_of(f) for f in files['eval']],
+                                          [section_of(f) for f in files['unknown']]]))
+    return summary.loc['all', METRICS]
+
+
+def compare(weight_path, model_paths, embedding_store, feature_store, sections, batch_size=32, n_threads=None):
+    """
+    Compares exported models of a member with its Keras model on the development set: cosine drift of the embeddings,
+    change of the harmonic mean AUC and pAUC and throughput in clips per second of the embedding model.
+    Uses the Keras embeddings of the embedding store and the frontend features of the feature store written by main.py,
+    which are streamed from the store in batches.
+    """
+    w_hash = weights_hash(weight_path)
+    member = embedding_store.find(w_hash)
+    if member is None:
+        raise ValueError('no stored embeddings for ' + weight_path + ', run main.py first')
+    keras_embs, files, features = {}, {}, {}
+    for split, feature_split in [('train', 'train'), ('eval', 'eval'), ('unknown', 'eval')]:
+        keras_embs[split], files[split] = embedding_store.load(member, w_hash, split)
+        x_fft, x_spec, feature_files = feature_store.load_stored(feature_split)
+        row_of = dict((f, k) for k, f in enumerate(feature_files))
+        rows = np.array([row_of[f] for f in files[split]])
+        features[split] = (x_fft, x_spec, rows)
+    with open(os.path.join(embedding_store.entry_dir(member, w_hash), 'centroids.json'), 'r') as f:
+        n_subclusters = json.load(f)['settings']['n_clusters']
+
+    emb_model = emb_model_from_features(tf.keras.models.load_model(weight_path, custom_objects=custom_objects))
+    backends = {'keras': lambda x_fft, x_spec, rows: emb_model.predict(
+        make_feature_dataset((x_fft, x_spec), batch_size, rows=rows), verbose=0)}
+    for mode, model_path in model_paths.items():
+        backends[mode] = lambda x_fft, x_spec, rows, embedder=TFLiteEmbedder(model_path, n_threads): embedder.predict(
+            x_fft, x_spec, batch_size, rows)
+
+    keras_results = dev_results(keras_embs, files, sections, n_subclusters)
+    report = {}
+    for name, predict in backends.items():
+        embs = {}
+        start = time.perf_counter()
+        for split in ['eval', 'unknown']:
+            embs[split] = predict(*features[split])
+        n_clips = len(files['eval']) + len(files['unknown'])
+        throughput = n_clips / (time.perf_counter() - start)
+        embs['train'] = predict(*features['train'])
+        cos = np.concatenate([np.sum(length_norm(embs[split]) * length_norm(keras_embs[split]), axis=1)
+                              for split in embs])
+        results = dev_results(embs, files, sections, n_subclusters)
+        report[name] = {'mean_cosine_drift': float(np.mean(1 - cos)), 'max_cosine_drift': float(np.max(1 - cos)),
+                        'throughput': throughput,
+                        'results': results.to_dict(), 'change': (results - keras_results).to_dict()}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export the embedding models of the ensemble members to TFLite')
+    parser.add_argument('--weights', nargs='+', required=True)
+    parser.add_argument('--modes', nargs='+', default=['float16', 'int8'], choices=MODES)
+    parser.add_argument('--export-dir', default='./tflite_models')
+    parser.add_argument('--feature-store', default='./feature_store')
+    parser.add_argument('--embedding-store', default='./embedding_store')
+    parser.add_argument('--run-dir', default='./run_state')
+    parser.add_argument('--n-calibration', type=int, default=256, help='number of training clips for int8 calibration')
+    parser.add_argument('--compare', action='store_true', help='compare the exported models with the Keras models')
+    parser.add_argument('--n-threads', type=int, default=None)
+    args = parser.parse_args()
+
+    feature_store = FeatureStore(args.feature_store)
+    x_fft, x_spec, _ = feature_store.load_stored('train')
+    rows = np.sort(np.random.default_rng(0).permutation(len(x_fft))[:args.n_calibration])
+    calibration = (x_fft[rows], x_spec[rows])
+    with open(os.path.join(args.run_dir, 'sections.json'), 'r') as f:
+        sections = json.load(f)
+    reports = {}
+    for weight_path in args.weights:
+        _, model_paths = export_member(weight_path, args.export_dir, args.modes, calibration)
+        print('exported ' + ', '.join(model_paths.values()))
+        if args.compare:
+            reports[weight_path] = compare(weight_path, model_paths, EmbeddingStore(args.embedding_store),
+                                           feature_store, sections, n_threads=args.n_threads)
+            for name, report in reports[weight_path].items():
+                print(name + ': cosine drift ' + str(np.round(report['mean_cosine_drift'], 6)) + ' (max '
+                      + str(np.round(report['max_cosine_drift'], 6)) + '), AUC change '
+                      + str(np.round(report['change']['auc'] * 100, 2)) + ', pAUC change '
+                      + str(np.round(report['change']['pauc'] * 100, 2)) + ', '
+                      + str(np.round(report['throughput'], 1)) + ' clips/s')
+    if args.compare:
+        with open(os.path.join(args.export_dir, 'comparison.json'), 'w') as f:
+            json.dump(reports, f, indent=2)
@@ -1,6 +1,7 @@
 from tensorflow.keras import backend as K
 from tensorflow.keras import layers
 import tensorflow as tf
+from mixup_layer import replica_uniform
 
 class AugLayer(layers.Layer):
     def __init__(self, prob, **kwargs):
@@ -20,7 +21,7 @@ class AugLayer(layers.Layer):
         y_rev = tf.concat([tf.zeros_like(inputs[2]), 0.5 * inputs[2], 0.5 * tf.reverse(inputs[2], axis=[0])], axis=1)  # best?
 
         # apply mixup or not
-        dec = tf.dtypes.cast(tf.random.uniform(shape=[tf.shape(inputs[0])[0]]) < self.prob, tf.dtypes.float32)
+        dec = tf.dtypes.cast(replica_uniform(tf.shape(inputs[0])[0]) < self.prob, inputs[0].dtype)
         dec1 = tf.reshape(dec, [-1] + [1] * (len(inputs[0].shape) - 1))
         out1 = dec1 * X1 + (1 - dec1) * X1_rev
         dec2 = tf.reshape(dec, [-1] + [1] * (len(y.shape) - 1))
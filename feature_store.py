@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from emb_cnn import frontend_model
+from input_pipeline import make_predict_dataset
+
+
+def waveform_key(waveforms):
+    # identifies the content of a waveform store, changes whenever one of its shards is rebuilt
+    key = {
+        'files': waveforms.files,
+        'shape': list(waveforms.shape),
+        'shards': [[path, os.stat(path).st_mtime_ns] for path in waveforms.paths]
+    }
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+class FeatureStore():
+    """
+    Disk cache for the outputs of the parameter-free frontend (magnitude FFT slice and magnitude spectrogram) so that
+    they are computed only once per clip instead of once per clip and ensemble member.
+    """
+
+    def __init__(self, store_dir, batch_size=32):
+        self.store_dir = store_dir
+        self.batch_size = batch_size
+
+    def paths(self, split):
+        return (os.path.join(self.store_dir, split + '_fft.npy'),
+                os.path.join(self.store_dir, split + '_spec.npy'),
+                os.path.join(self.store_dir, split + '_features.json'))
+
+    def is_valid(self, split, key):
+        fft_path, spec_path, manifest_path = self.paths(split)
+        if not (os.path.isfile(fft_path) and os.path.isfile(spec_path) and os.path.isfile(manifest_path)):
+            return False
+        with open(manifest_path, 'r') as f:
+            return json.load(f)['key'] == key
+
+    def compute(self, split, waveforms, key):
+        os.makedirs(self.store_dir, exist_ok=True)
+        fft_path, spec_path, manifest_path = self.paths(split)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+        model = frontend_model(waveforms.shape[1])
+        fft_shape, spec_shape = [tuple(output.shape[1:]) for output in model.outputs]
+        fft_out = np.lib.format.open_memmap(fft_path + '.part', mode='w+', dtype=np.float32,
+                                            shape=(waveforms.shape[0],) + fft_shape)
+        spec_out = np.lib.format.open_memmap(spec_path + '.part', mode='w+', dtype=np.float32,
+                                             shape=(waveforms.shape[0],) + spec_shape)
+        k = 0
+        dataset = make_predict_dataset(waveforms, 1, self.batch_size)
+        for (x, _), in tqdm(dataset, total=int(np.ceil(waveforms.shape[0] / self.batch_size))):
+            x_fft, x_spec = model(x, training=False)
+            fft_out[k:k + x.shape[0]] = x_fft.numpy()
+            spec_out[k:k + x.shape[0]] = x_spec.numpy()
+            k += x.shape[0]
+        fft_out.flush()
+        spec_out.flush()
+        del fft_out, spec_out
+        os.replace(fft_path + '.part', fft_path)
+        os.replace(spec_path + '.part', spec_path)
+        with open(manifest_path, 'w') as f:
+            json.dump({'key': key, 'files': waveforms.files}, f)
+
+    def load(self, split, waveforms):
+        key = waveform_key(waveforms)
+        if not self.is_valid(split, key):
+            print('Computing frontend features for ' + split + ' data')
+            self.compute(split, waveforms, key)
+        fft_path, spec_path, _ = self.paths(split)
+        return np.load(fft_path, mmap_mode='r'), np.load(spec_path, mmap_mode='r')
+
+    def load_stored(self, split):
+        # features and file names as stored by main.py, without validating them against a waveform store
+        fft_path, spec_path, manifest_path = self.paths(split)
+        with open(manifest_path, 'r') as f:
+            files = json.load(f)['files']
+        return np.load(fft_path, mmap_mode='r'), np.load(spec_path, mmap_mode='r'), np.array(files)
@@ -0,0 +1,173 @@
+import os
+import json
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from data.data_manager import get_machine_manager
+from data.process_data import load_wav, load_wavs, load_wavs_ragged, to_storage_dtype
+from data.waveform_cache import CACHE_VERSION, WaveformCache, file_stats
+from data.metadata import MetadataStore
+
+INGEST_MANIFEST = 'ingest.json'
+
+
+def scan_machine(data_dir, machine, stage):
+    # wav files of one machine type with their sizes and modification times, named like in list_wav_files
+    files = sorted(data_dir + machine.name + '/' + stage + '/' + path.name
+                   for path in machine.reader.get_files_path(stage))
+    sizes, mtimes = file_stats(files)
+    return machine.name, files, sizes, mtimes
+
+
+def scan(data_dirs, stage, n_workers=8):
+    """
+    Lists the wav files of stage ('train' or 'test') of all machine types in data_dirs, the machine directories are
+    scanned concurrently. Returns (machine, files, sizes, modification times) per machine type in a stable order.
+    """
+    machines = [(data_dir, machine) for data_dir in data_dirs for machine in get_machine_manager(data_dir)]
+    with ThreadPoolExecutor(n_workers) as executor:
+        scanned = list(executor.map(lambda item: scan_machine(item[0], item[1], stage), machines))
+    return sorted(scanned, key=lambda machine_files: machine_files[0])
+
+
+class Ingestor():
+    """
+    Append-only waveform store of a dataset split in the format of a WaveformCache. Each ingest decodes only the new
+    recordings into new chunks (one per machine type) and appends them to the store, so the rows of all recordings that
+    were ingested before stay the same. Recordings that changed on disk are decoded again into their rows, recordings
+    that were removed keep their rows until the store is rebuilt but are dropped from the metadata table.
+    """
+
+    def __init__(self, waveform_cache, metadata_store=None, n_workers=8):
+        self.cache = waveform_cache
+        self.metadata_store = metadata_store
+        self.n_workers = n_workers
+
+    def manifest_path(self, split):
+        return os.path.join(self.cache.split_dir(split), INGEST_MANIFEST)
+
+    def chunk_path(self, split, index, machine):
+        suffix = '_samples.npy' if self.cache.ragged else '_raw.npy'
+        return os.path.join(self.cache.split_dir(split), 'chunk_' + str(index).zfill(5) + '_' + machine + suffix)
+
+    def empty_manifest(self):
+        return {'version': CACHE_VERSION, 'sample_rate': self.cache.sample_rate, 'max_size': self.cache.max_size,
+                'dtype': self.cache.dtype, 'ragged': self.cache.ragged, 'chunks': []}
+
+    def read_manifest(self, split):
+        manifest = self.empty_manifest()
+        if not os.path.isfile(self.manifest_path(split)):
+            return manifest
+        with open(self.manifest_path(split), 'r') as f:
+            cached = json.load(f)
+        # a store of another format is built again
+        if any(cached[key] != manifest[key] for key in manifest if key != 'chunks'):
+            return manifest
+        return cached
+
+    def write_manifest(self, split, manifest):
+        with open(self.manifest_path(split) + '.part', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path(split) + '.part', self.manifest_path(split))
+
+    def decode_chunk(self, path, files):
+        if self.cache.ragged:
+            load_wavs_ragged(files, self.cache.max_size, path, n_workers=self.n_workers, dtype=self.cache.dtype)
+        else:
+            load_wavs(files, self.cache.max_size, n_workers=self.n_workers, mmap_path=path, dtype=self.cache.dtype)
+
+    def update_row(self, path, local_row, file):
+        # decode a changed recording into its row, ragged clips only if their length did not change
+        if self.cache.ragged:
+            offsets = np.load(path[:-len('_samples.npy')] + '_offsets.npy')
+            wav = load_wav(file, self.cache.max_size, pad=False)
+            if wav.shape[0] != offsets[local_row + 1] - offsets[local_row]:
+                return False
+            samples = np.load(path, mmap_mode='r+')
+            samples[offsets[local_row]:offsets[local_row + 1]] = to_storage_dtype(wav, samples.dtype)
+        else:
+            samples = np.load(path, mmap_mode='r+')
+            samples[local_row, :, 0] = to_storage_dtype(load_wav(file, self.cache.max_size), samples.dtype)
+        samples.flush()
+        return True
+
+    def ingest(self, data_dirs, stage, split, rebuild=False):
+        """
+        Brings the store of split up to date with the wav files of stage in data_dirs and returns it together with the
+        metadata table of the recordings on disk (None without metadata store).
+        """
+        os.makedirs(self.cache.split_dir(split), exist_ok=True)
+        if rebuild:
+            # the per machine type shards of the WaveformCache in the same directory are kept
+            for name in os.listdir(self.cache.split_dir(split)):
+                if name == INGEST_MANIFEST or name.startswith('chunk_'):
+                    os.remove(os.path.join(self.cache.split_dir(split), name))
+        manifest = self.read_manifest(split)
+        cached = {}
+        for chunk in manifest['chunks']:
+            for local_row, (file, size, mtime) in enumerate(zip(chunk['files'], chunk['sizes'], chunk['mtimes'])):
+                cached[file] = (chunk, local_row, size, mtime)
+
+        scanned = scan(data_dirs, stage, n_workers=self.n_workers)
+        on_disk = set()
+        n_new, n_changed, n_stale = 0, 0, 0
+        for machine, files, sizes, mtimes in scanned:
+            on_disk.update(files)
+            new = [k for k, file in enumerate(files) if file not in cached]
+            for k, file in enumerate(files):
+                if file not in cached or cached[file][2:] == (sizes[k], mtimes[k]):
+                    continue
+                chunk, local_row = cached[file][:2]
+                if self.update_row(os.path.join(self.cache.split_dir(split), chunk['path']), local_row, file):
+                    chunk['sizes'][local_row], chunk['mtimes'][local_row] = sizes[k], mtimes[k]
+                    n_changed += 1
+                else:
+                    n_stale += 1
+            if len(new) == 0:
+                continue
+            print('Decoding ' + str(len(new)) + ' new ' + split + ' recordings of ' + machine)
+            path = self.chunk_path(split, len(manifest['chunks']), machine)
+            self.decode_chunk(path, [files[k] for k in new])
+            manifest['chunks'].append({'path': os.path.basename(path), 'machine': machine,
+                                       'files': [files[k] for k in new], 'sizes': [sizes[k] for k in new],
+                                       'mtimes': [mtimes[k] for k in new]})
+            n_new += len(new)
+        self.write_manifest(split, manifest)
+        n_removed = len(set(cached) - on_disk)
+        print(split + ': ' + str(n_new) + ' new, ' + str(n_changed) + ' changed recordings decoded')
+        if n_stale > 0 or n_removed > 0:
+            print(split + ': ' + str(n_stale) + ' recordings changed their length and ' + str(n_removed) +
+                  ' were removed, rebuild the store to update them and free their rows')
+
+        waveforms = self.cache.waveforms([os.path.join(self.cache.split_dir(split), chunk['path'])
+                                          for chunk in manifest['chunks']],
+                                         sum([chunk['files'] for chunk in manifest['chunks']], []),
+                                         [chunk['machine'] for chunk in manifest['chunks']])
+        metadata = None
+        if self.metadata_store is not None:
+            metadata = self.metadata_store.load(split, waveforms.files)
+            # rows of removed recordings are neither trained on nor scored
+            metadata = metadata[metadata['file'].isin(on_disk)].reset_index(drop=True)
+        return waveforms, metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='decode new recordings and append them to the waveform store and '
+                                                 'metadata of a dataset split')
+    parser.add_argument('--data', nargs='+', default=['./dev_data/'])
+    parser.add_argument('--stage', default='train', choices=['train', 'test'])
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--cache-dir', default='./waveform_cache')
+    parser.add_argument('--metadata-dir', default='./metadata')
+    parser.add_argument('--max-size', type=int, default=192000)
+    parser.add_argument('--sample-rate', type=int, default=16000)
+    parser.add_argument('--dtype', default='int16', choices=['float32', 'float16', 'int16'])
+    parser.add_argument('--ragged', action='store_true', help='store the recordings unpadded')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rebuild', action='store_true', help='decode all recordings again')
+    args = parser.parse_args()
+    cache = WaveformCache(args.cache_dir, args.max_size, args.sample_rate, n_workers=args.workers, ragged=args.ragged,
+                          dtype=args.dtype)
+    waveforms, _ = Ingestor(cache, MetadataStore(args.metadata_dir), n_workers=args.workers).ingest(
+        args.data, args.stage, args.split, rebuild=args.rebuild)
+    print(args.split + ': ' + str(len(waveforms)) + ' recordings')
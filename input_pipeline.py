@@ -0,0 +1,121 @@
+import numpy as np
+import tensorflow as tf
+from data.process_data import PCM_SCALE
+
+
+def _load_rows(waveforms, rows):
+    # only the rows of the current batch are read from the (memory-mapped) waveform store
+    return np.asarray(waveforms[rows], dtype=np.float32)
+
+
+def _load_stored_rows(waveforms, rows):
+    # rows of the current batch in the dtype of the store, converted to float32 in the graph
+    return np.asarray(waveforms[rows])
+
+
+def to_float32(x):
+    # waveforms stored as int16 hold PCM samples, float16 waveforms only need to be cast
+    if x.dtype == tf.int16:
+        return tf.cast(x, tf.float32) / PCM_SCALE
+    return tf.cast(x, tf.float32)
+
+
+def _waveform_batch(waveforms, rows):
+    # clips of a ragged store are padded to the longest clip of the batch and come with their lengths
+    x = tf.numpy_function(lambda r: _load_stored_rows(waveforms, r), [rows], tf.as_dtype(waveforms.dtype))
+    x = to_float32(x)
+    x.set_shape([None] + list(waveforms.shape[1:]))
+    if not hasattr(waveforms, 'lengths'):
+        return x
+    lengths = tf.gather(tf.constant(waveforms.lengths, dtype=tf.int32), rows)
+    return x, lengths
+
+
+def _bucket_batches(dataset, lengths, rows, batch_size, n_buckets):
+    # batches of clips of similar length, bucket boundaries are quantiles of the lengths of the streamed rows
+    boundaries = np.unique(np.quantile(lengths[rows], np.linspace(0, 1, n_buckets + 1)[1:-1]))
+    buckets = tf.constant(np.searchsorted(boundaries, lengths, side='right'), dtype=tf.int64)
+    return dataset.group_by_window(lambda row, *args: buckets[row], lambda key, window: window.batch(batch_size),
+                                   window_size=batch_size)
+
+
+def make_train_dataset(waveforms, rows, labels, num_classes, batch_size, sample_weights=None, shuffle=True, seed=None,
+                       shard=None, n_buckets=4):
+    """
+    Stream batches ((waveform, one-hot label), (one-hot label, one-hot label)[, sample weight]) for model.fit.
+    rows index into waveforms, labels and sample_weights are aligned with rows.
+    shard = (number of workers, worker index) streams only the rows of one worker of a multi-worker strategy in batches
+    of batch_size / number of workers, repeated indefinitely. All workers must use the same seed.
+    The waveforms of a ragged store are batched in n_buckets buckets of similar lengths and passed as (waveform,
+    length).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    if sample_weights is None:
+        dataset = tf.data.Dataset.from_tensor_slices((rows, labels))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((rows, labels, np.asarray(sample_weights, dtype=np.float32)))
+    if shuffle:
+        dataset = dataset.shuffle(rows.shape[0], seed=seed, reshuffle_each_iteration=True)
+    if shard is not None:
+        # all workers need the same number of batches, at most n_shards-1 rows of each epoch are left out
+        n_shards, index = shard
+        dataset = dataset.take(rows.shape[0] - rows.shape[0] % n_shards).shard(n_shards, index)
+        batch_size = max(1, batch_size // n_shards)
+    if hasattr(waveforms, 'lengths'):
+        dataset = _bucket_batches(dataset, waveforms.lengths, rows, batch_size, n_buckets)
+    else:
+        dataset = dataset.batch(batch_size)
+    if shard is not None:
+        # keras keeps iterating over a distributed dataset across epochs, the number of steps ends each epoch
+        dataset = dataset.repeat()
+
+    def load_batch(batch_rows, batch_labels, batch_weights=None):
+        x = _waveform_batch(waveforms, batch_rows)
+        y = tf.one_hot(batch_labels, num_classes, dtype=tf.float32)
+        if batch_weights is None:
+            return (x, y), (y, y)
+        return (x, y), (y, y), batch_weights
+
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_predict_dataset(waveforms, num_classes, batch_size, rows=None):
+    """
+    Stream batches (waveform, dummy label) in the given row order for model.predict. The waveforms of a ragged store
+    are passed as (waveform, length) and padded to the longest clip of each batch.
+    """
+    if rows is None:
+        rows = np.arange(waveforms.shape[0])
+    rows = np.asarray(rows, dtype=np.int64)
+    dataset = tf.data.Dataset.from_tensor_slices(rows).batch(batch_size)
+
+    def load_batch(batch_rows):
+        x = _waveform_batch(waveforms, batch_rows)
+        # wrap inputs in a tuple so that keras does not interpret the dummy labels as targets
+        return ((x, tf.zeros((tf.shape(batch_rows)[0], num_classes), dtype=tf.float32)),)
+
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_feature_dataset(features, batch_size, rows=None):
+    """
+    Stream batches of cached frontend features (magnitude FFT, magnitude spectrogram) for model.predict.
+    """
+    fft_features, spec_features = features
+    if rows is None:
+        rows = np.arange(fft_features.shape[0])
+    rows = np.asarray(rows, dtype=np.int64)
+    dataset = tf.data.Dataset.from_tensor_slices(rows).batch(batch_size)
+
+    def load_batch(batch_rows):
+        x_fft = tf.numpy_function(lambda r: _load_rows(fft_features, r), [batch_rows], tf.float32)
+        x_fft.set_shape([None] + list(fft_features.shape[1:]))
+        x_spec = tf.numpy_function(lambda r: _load_rows(spec_features, r), [batch_rows], tf.float32)
+        x_spec.set_shape([None] + list(spec_features.shape[1:]))
+        return ((x_fft, x_spec),)
+
+    dataset = dataset.map(load_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import pandas as pd
+import tensorflow as tf
+
+
+def peak_rss_mb():
+    # high-water mark of the resident set size of this process, ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class Span():
+    """
+    Measurements of a single named span. n_examples can also be set inside the span once the number of processed
+    examples is known.
+    """
+
+    def __init__(self, name, parent, depth, n_examples=None, args=None):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.n_examples = n_examples
+        self.args = args or {}
+        self.thread = threading.get_ident()
+        self.start = None
+        self.wall = None
+        self.cpu = None
+        self.peak_rss = None
+        self.peak_rss_increase = None
+
+    def record(self):
+        record = {'name': self.name, 'parent': self.parent, 'depth': self.depth, 'start_s': self.start,
+                  'wall_s': self.wall, 'cpu_s': self.cpu, 'peak_rss_mb': self.peak_rss,
+                  'peak_rss_increase_mb': self.peak_rss_increase, 'n_examples': self.n_examples,
+                  'examples_per_s': self.n_examples / self.wall if self.n_examples and self.wall > 0 else None}
+        record.update(self.args)
+        return record
+
+
+class Tracer():
+    """
+    Collects nested, named spans with wall time, process CPU time (all threads), the RSS high-water mark at the end of
+    the span and its increase during the span, and examples per second. Spans are written as a list of records
+    (save_json) or in the Chrome trace event format (save_chrome_trace, open in chrome://tracing or Perfetto).
+    A disabled tracer only runs the wrapped code.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, n_examples=None, **args):
+        stack = self.local.__dict__.setdefault('stack', [])
+        span = Span(name, stack[-1].name if len(stack) > 0 else None, len(stack), n_examples, args)
+        if not self.enabled:
+            yield span
+            return
+        stack.append(span)
+        rss_start = peak_rss_mb()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - start
+            span.cpu = time.process_time() - cpu_start
+            span.start = start - self.origin
+            span.peak_rss = peak_rss_mb()
+            span.peak_rss_increase = span.peak_rss - rss_start
+            stack.pop()
+            with self.lock:
+                self.spans.append(span)
+
+    def records(self):
+        with self.lock:
+            return sorted([span.record() for span in self.spans], key=lambda record: record['start_s'])
+
+    def summary(self):
+        columns = ['name', 'depth', 'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_increase_mb', 'examples_per_s']
+        records = self.records()
+        if len(records) == 0:
+            return pd.DataFrame(columns=columns)
+        summary = pd.DataFrame(records)[columns]
+        summary['name'] = ['  ' * depth + name for depth, name in zip(summary['depth'], summary['name'])]
+        return summary.drop(columns='depth')
+
+    def save_json(self, path):
+        with open(path + '.part', 'w') as f:
+            json.dump({'pid': os.getpid(), 'spans': self.records()}, f, indent=2)
+        os.replace(path + '.part', path)
+
+    def save_chrome_trace(self, path):
+        # complete events, timestamps and durations in microseconds
+        events = []
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            record = span.record()
+            events.append({'name': span.name, 'cat': span.parent or 'run', 'ph': 'X', 'ts': span.start * 1e6,
+                           'dur': span.wall * 1e6, 'pid': os.getpid(), 'tid': span.thread,
+                           'args': dict((key, value) for key, value in record.items()
+                                        if key not in ['name', 'start_s', 'wall_s'] and value is not None)})
+        with open(path + '.part', 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.replace(path + '.part', path)
+
+
+class ProfilerCallback(tf.keras.callbacks.Callback):
+    """
+    Captures a TensorFlow profiler trace of n_steps training steps starting at step start_step (counted over all
+    epochs) into log_dir, view it with the profile plugin of TensorBoard.
+    """
+
+    def __init__(self, log_dir, start_step=10, n_steps=10):
+        super().__init__()
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.stop_step = start_step + n_steps
+        self.step = 0
+        self.running = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.step == self.start_step and not self.running:
+            tf.profiler.experimental.start(self.log_dir)
+            self.running = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.running and self.step >= self.stop_step:
+            self.stop()
+
+    def on_train_end(self, logs=None):
+        if self.running:
+            self.stop()
+
+    def stop(self):
+        tf.profiler.experimental.stop()
+        self.running = False
@@ -2,281 +2,35 @@ import pandas as pd
 import numpy as np
 import keras
 import os
+import json
 import soundfile as sf
 import tensorflow as tf
 import librosa
 from sklearn.metrics import roc_auc_score
-from tqdm import tqdm
 from sklearn.preprocessing import LabelEncoder
 from mixup_layer import MixupLayer
 from feature_exchange import AugLayer
 from subcluster_adacos import SCAdaCos, AdaProj
 from scipy.stats import hmean
 from tensorflow.keras import backend as K
-from sklearn.cluster import KMeans
 from scipy.spatial.distance import cdist
-import tensorflow_probability as tfp
 from sklearn.utils import class_weight
-
-
-def adjust_size(wav, new_size):
-    reps = int(np.ceil(new_size/wav.shape[0]))
-    offset = np.random.randint(low=0, high=int(reps*wav.shape[0]-new_size+1))
-    new_wav = librosa.util.pad_center(wav, new_size)
-    return new_wav
-    
-    
-def temporal_mean(spec, keepdims=False):
-    # take average over time but do not consider zeros resulting from padding waveform
-    norm = tf.where(spec>0, tf.ones_like(spec), tf.zeros_like(spec))
-    norm = tf.reduce_sum(norm, axis=2, keepdims=True)+1e-16
-    return tf.reduce_sum(spec/norm, axis=1, keepdims=keepdims)
-
-
-class GetWelch(tf.keras.layers.Layer):
-    def __init__(self, nperseg=4096, noverlap=2048):
-        super(GetWelch, self).__init__()
-        self.nperseg = nperseg
-        self.noverlap = noverlap
-
-    def build(self, input_shape):
-        super(GetWelch, self).build(input_shape)
-
-    def call(self, waveform):
-        # Compute the spectrogram
-        stfts = tf.signal.stft(waveform, frame_length=self.nperseg, frame_step=self.nperseg - self.noverlap, fft_length=self.nperseg)
-        spectrograms = tf.abs(stfts)
-
-        # Power spectrogram
-        Sxx = tf.square(spectrograms)
-
-        # Average over time
-        Sxx = temporal_mean(Sxx)
-
-        # Logarithmic scaling
-        EPS = 1e-16
-        Sxx = tf.math.log(Sxx + EPS)
-
-        return Sxx#tf.squeeze(Sxx, axis=0)
-
-    def get_config(self):
-        config = {
-            'nperseg': self.nperseg,
-            'noverlap': self.noverlap
-        }
-        config.update(super(GetWelch, self).get_config())
-        return config
-
-
-class MagnitudeSpectrogram(tf.keras.layers.Layer):
-    """
-    Compute magnitude spectrograms.
-    https://towardsdatascience.com/how-to-easily-process-audio-on-your-gpu-with-tensorflow-2d9d91360f06
-    """
-
-    def __init__(self, sample_rate, fft_size, hop_size, **kwargs):
-        super(MagnitudeSpectrogram, self).__init__(**kwargs)
-        self.sample_rate = sample_rate
-        self.fft_size = fft_size
-        self.hop_size = hop_size
-
-    def build(self, input_shape):
-        super(MagnitudeSpectrogram, self).build(input_shape)
-
-    def call(self, waveforms):
-        spectrograms = tf.signal.stft(waveforms,
-                                      frame_length=self.fft_size,
-                                      frame_step=self.hop_size,
-                                      pad_end=False)
-        magnitude_spectrograms = tf.abs(spectrograms)
-        magnitude_spectrograms = tf.expand_dims(magnitude_spectrograms, 3)
-        return magnitude_spectrograms
-
-    def get_config(self):
-        config = {
-            'fft_size': self.fft_size,
-            'hop_size': self.hop_size,
-            'sample_rate': self.sample_rate
-        }
-        config.update(super(MagnitudeSpectrogram, self).get_config())
-        return config
-
-def mixupLoss(y_true, y_pred):
-    target = y_pred[:, :, 1]  # mixed-up labels
-    output = y_pred[:, :, 0]  # mixed-up predictions
-    return tf.keras.losses.categorical_crossentropy(target, output)
-
-
-def length_norm(mat):
-    norm_mat = []
-    for line in mat:
-        temp = line / np.math.sqrt(sum(np.power(line, 2)))
-        norm_mat.append(temp)
-    norm_mat = np.array(norm_mat)
-    return norm_mat
-
-
-def model_emb_cnn(num_classes, raw_dim, n_subclusters, use_bias=False):
-    data_input = tf.keras.layers.Input(shape=(raw_dim, 1), dtype='float32')
-    label_input = tf.keras.layers.Input(shape=(num_classes,), dtype='float32')
-    y = label_input
-    x = data_input
-    l2_weight_decay = tf.keras.regularizers.l2(1e-5)
-    x_mix = x
-    x_mix, y_mix = MixupLayer(prob=0.5)([x, y])
-
-    # FFT
-    #x = tf.keras.layers.Lambda(lambda x: tf.math.abs(tf.signal.fft(tf.complex(x[:, :, 0], tf.zeros_like(x[:, :, 0])))[:, :int(raw_dim / 2)]))(x_mix)
-    x = tf.keras.layers.Lambda(lambda x: tf.math.abs(tf.signal.fft(tf.complex(x[:, :, 0], tf.zeros_like(x[:, :, 0])))[:, :8000]))(x_mix)  # should one use a zero filter here too?
-    
-    #x = tf.keras.layers.Reshape((raw_dim,))(x_mix)
-    #x = GetWelch()(x)
-    x = tf.keras.layers.Reshape((-1,1))(x)
-    x = tf.keras.layers.Conv1D(128, 256, strides=64, activation='linear', padding='same',
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.Conv1D(128, 64, strides=32, activation='linear', padding='same',
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.Conv1D(128, 16, strides=4, activation='linear', padding='same',
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.ReLU()(x)
-
-    x = tf.keras.layers.Flatten()(x)
-    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.Dense(128, kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    x = tf.keras.layers.ReLU()(x)
-
-    emb_fft = tf.keras.layers.Dense(256, name='emb_fft', kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-
-    # magnitude
-    x = tf.keras.layers.Reshape((raw_dim,))(x_mix)
-    x = MagnitudeSpectrogram(16000, 1024, 512)(x)
-
-    x = tf.keras.layers.Lambda(lambda x: x-temporal_mean(x, keepdims=True))(x) # CMN-like normalization
-    x = tf.keras.layers.BatchNormalization(axis=-2)(x)
-
-    # first block
-    x = tf.keras.layers.Conv2D(16, 7, strides=2, activation='linear', padding='same',
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    x = tf.keras.layers.ReLU()(x)
-    x = tf.keras.layers.MaxPooling2D(3, strides=2)(x)
-
-    # second block
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.Add()([x, xr])
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.Conv2D(16, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.Add()([x, xr])
-
-    # third block
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(32, 3, strides=(2, 2), activation='linear', padding='same',
-                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
-    x = tf.keras.layers.Conv2D(kernel_size=1, filters=32, strides=1, padding="same",
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.Add()([x, xr])
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(32, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.Add()([x, xr])
-
-    # fourth block
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(64, 3, strides=(2, 2), activation='linear', padding='same',
-                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
-    x = tf.keras.layers.Conv2D(kernel_size=1, filters=64, strides=1, padding="same",
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.Add()([x, xr])
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(64, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.Add()([x, xr])
-
-    # fifth block
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(128, 3, strides=(2, 2), activation='linear', padding='same',
-                                kernel_regularizer=l2_weight_decay, use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
-    x = tf.keras.layers.Conv2D(kernel_size=1, filters=128, strides=1, padding="same",
-                               kernel_regularizer=l2_weight_decay, use_bias=use_bias)(x)
-    x = tf.keras.layers.Add()([x, xr])
-    x = tf.keras.layers.BatchNormalization()(x)
-    xr = tf.keras.layers.ReLU()(x)
-    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    xr = tf.keras.layers.BatchNormalization()(xr)
-    xr = tf.keras.layers.ReLU()(xr)
-    xr = tf.keras.layers.Conv2D(128, 3, activation='linear', padding='same', kernel_regularizer=l2_weight_decay,
-                                use_bias=use_bias)(xr)
-    x = tf.keras.layers.Add()([x, xr])
-
-    x = tf.keras.layers.MaxPooling2D((18, 1), padding='same')(x)
-    x = tf.keras.layers.Flatten(name='flat')(x)
-    x = tf.keras.layers.BatchNormalization()(x)
-    emb_mel = tf.keras.layers.Dense(256, kernel_regularizer=l2_weight_decay, name='emb_mel', use_bias=use_bias)(x)
-
-    emb_mel_ssl, emb_fft_ssl, y_ssl = AugLayer(prob=0.5)([emb_mel,emb_fft,y_mix])
-    # prepare output
-    x = tf.keras.layers.Concatenate(axis=-1)([emb_fft, emb_mel])
-    x_ssl = tf.keras.layers.Concatenate(axis=-1)([emb_fft_ssl, emb_mel_ssl])
-
-    output_ssl = AdaProj(n_classes=num_classes*3, n_subclusters=n_subclusters, trainable=False)([x_ssl, y_ssl, label_input])  # compare with trainable equals True
-    output = AdaProj(n_classes=num_classes, n_subclusters=n_subclusters, trainable=False)([x, y_mix, label_input])
-
-    loss_output = tf.keras.layers.Lambda(lambda x: tf.stack(x, axis=-1))([output, y_mix])
-    loss_output_ssl = tf.keras.layers.Lambda(lambda x: tf.stack(x, axis=-1))([output_ssl, y_ssl])
-
-    return data_input, label_input, loss_output, loss_output_ssl
+from data.process_data import list_wav_files
+from data.waveform_cache import WaveformCache, file_stats
+from data.metadata import MetadataStore, encode_labels, balanced_sample_weights
+from ingest import Ingestor
+from input_pipeline import make_predict_dataset, make_feature_dataset
+from emb_cnn import emb_model_from_features, custom_objects
+from feature_store import FeatureStore
+from ensemble_runner import build_model, fit_model, checkpoint_dir, train_ensemble_parallel, train_ensemble_distributed
+from run_manifest import RunManifest
+from embedding_store import EmbeddingStore, weights_hash, stamps_hash, SPLITS
+from scoring import length_norm, accumulate_scores, SectionScorer
+from reference_bank import ReferenceBank, BANK_DIR
+from clustering import SectionClusterer
+from evaluation import evaluate, METRICS
+from instrumentation import Tracer
+from distributed import configure_local_replicas
 
 
 ########################################################################################################################
@@ -285,149 +39,90 @@ def model_emb_cnn(num_classes, raw_dim, n_subclusters, use_bias=False):
 target_sr = 16000
 max_size = 192000  #288000 or 192000
 use_ensemble = True
+n_workers = 8  # number of parallel workers for decoding wav files
+waveform_dtype = 'int16'  # dtype of the cached waveforms: 'int16' (lossless for 16-bit PCM files), 'float16' or 'float32'
+incremental_ingest = True  # only decode new recordings and append them, rows of cached recordings stay the same
+variable_length = False  # store clips unpadded, train and embed on batches of similar length instead of max_size
+use_feature_store = True and not variable_length  # compute FFT and spectrogram once and cache them for inference
+n_parallel_members = 1  # number of ensemble members trained concurrently in separate processes
+run_dir = './run_state'  # checkpoints and accumulated scores for resuming a run
+embedding_store = EmbeddingStore('./embedding_store')  # embeddings per ensemble member, weights and split
+max_search_memory = 256 * 2**20  # memory ceiling in bytes for searching the closest target and source references
+n_search_threads = 1  # number of threads searching blocks of queries
+n_cluster_jobs = 1  # number of sections clustered concurrently
+minibatch_threshold = None  # sections with more source embeddings than this use MiniBatchKMeans, None to disable
+n_bootstrap = 0  # number of bootstrap resamples for confidence intervals of the development set results
+memory_efficient_proj = True  # AdaProj without the batch x dim x classes x subclusters projection, same outputs
+s_update_interval = 1  # training steps between updates of the adaptive scale s of the classification heads
+mixed_precision = None  # 'mixed_bfloat16' (CPUs with AVX512-BF16/AMX) or 'mixed_float16' (GPUs), None for float32
+distribute_strategy = None  # 'mirrored' (replicas in this process) or 'multi_worker' (local worker processes), None for one
+n_replicas = 2  # number of synchronously trained replicas of each member, the global batch size stays the same
+trace_run = True  # record wall and CPU time, peak memory and throughput of all stages in run_dir/trace.json
+profile_steps = None  # (first step, number of steps) of each trained member to capture with the TensorFlow profiler
+tracer = Tracer(enabled=trace_run)
+if distribute_strategy == 'mirrored':
+    configure_local_replicas(n_replicas)
 
 # load train data
 print('Loading train data')
 categories_dev = os.listdir("./dev_data")
 categories_eval = os.listdir("./eval_data")
 
-if os.path.isfile(str(target_sr) + '_train_raw.npy'):
-    train_raw = np.load(str(target_sr) + '_train_raw.npy')
-    train_ids = np.load('train_ids.npy')
-    train_files = np.load('train_files.npy')
-    train_atts = np.load('train_atts.npy')
-    train_domains = np.load('train_domains.npy')
-else:
-    train_raw = []
-    train_ids = []
-    train_files = []
-    train_atts = []
-    train_domains = []
-    dicts = ['./dev_data/']#['./dev_data/', './eval_data/']
-    eps = 1e-12
-    for dict in dicts:
-        for label, category in enumerate(os.listdir(dict)):
-            print(category)
-            if category=='RoboticArm':  # fix erroneous filenames
-                for count, file in tqdm(enumerate(os.listdir(dict + category + "/train")),
-                                    total=len(os.listdir(dict + category + "/train"))):
-                    if len(file.split('_'))<9:
-                        file_path = dict + category + "/train/" + file
-                        new_file_path = dict + category + "/train/" + file.split('weight')[0] + 'weight_' + file.split('weight')[1].split('_')[0] + '_Bckg_' + file.split('Bckg')[1] 
-                        os.rename(file_path, new_file_path)
-            for count, file in tqdm(enumerate(os.listdir(dict + category + "/train")),
-                                    total=len(os.listdir(dict + category + "/train"))):
-                if file.endswith('.wav'):
-                    file_path = dict + category + "/train/" + file
-                    wav, fs = sf.read(file_path)
-                    raw = librosa.core.to_mono(wav.transpose()).transpose()
-                    raw = adjust_size(raw, max_size)
-                    train_raw.append(raw)
-                    train_ids.append(category + '_' + file.split('_')[1])
-                    train_files.append(file_path)
-                    train_domains.append(file.split('_')[2])
-                    train_atts.append('_'.join(file.split('.wav')[0].split('_')[6:]))
-    # reshape arrays and store
-    train_ids = np.array(train_ids)
-    train_files = np.array(train_files)
-    train_raw = np.expand_dims(np.array(train_raw, dtype=np.float32), axis=-1)
-    train_atts = np.array(train_atts)
-    train_domains = np.array(train_domains)
-    np.save('train_ids.npy', train_ids)
-    np.save('train_files.npy', train_files)
-    np.save('train_atts.npy', train_atts)
-    np.save('train_domains.npy', train_domains)
-    np.save(str(target_sr) + '_train_raw.npy', train_raw)
+waveform_cache = WaveformCache('./waveform_cache', max_size, target_sr, n_workers=n_workers, ragged=variable_length,
+                               dtype=waveform_dtype)
+metadata_store = MetadataStore('./metadata')
+ingestor = Ingestor(waveform_cache, metadata_store, n_workers=n_workers)
+
+
+def load_split(split, data_dirs, stage):
+    # waveform store and metadata table of a dataset split, the 'row' column of the table indexes the store
+    files = list_wav_files(data_dirs, stage)
+    if incremental_ingest:
+        # the store keeps the order of ingestion, the table of the files on disk is sorted like the files of the store
+        # built in one pass
+        waveforms, table = ingestor.ingest(data_dirs, stage, split)
+        order = {file: k for k, file in enumerate(files)}
+        table = table.iloc[np.argsort([order[file] for file in table['file']], kind='stable')]
+        return waveforms, table.reset_index(drop=True)
+    waveforms = waveform_cache.load(split, files)
+    return waveforms, metadata_store.load(split, waveforms.files)
+
+
+dicts = ['./dev_data/']#['./dev_data/', './eval_data/']
+with tracer.span('decode_train') as span:
+    train_raw, train_meta = load_split('train', dicts, 'train')
+    span.n_examples = train_raw.shape[0]
+train_files = train_meta['file'].to_numpy(dtype=str)
+train_store_rows = train_meta['row'].to_numpy()
+train_ids = train_meta['section_id'].to_numpy()
+train_domains = train_meta['domain'].to_numpy()
 
 # load evaluation data
 print('Loading evaluation data')
-if os.path.isfile(str(target_sr) + '_eval_raw.npy'):
-    eval_raw = np.load(str(target_sr) + '_eval_raw.npy')
-    eval_ids = np.load('eval_ids.npy')
-    eval_normal = np.load('eval_normal.npy')
-    eval_files = np.load('eval_files.npy')
-    eval_atts = np.load('eval_atts.npy')
-    eval_domains = np.load('eval_domains.npy')
-else:
-    eval_raw = []
-    eval_ids = []
-    eval_normal = []
-    eval_files = []
-    eval_atts = []
-    eval_domains = []
-    eps = 1e-12
-    for label, category in enumerate(os.listdir("./dev_data/")):
-        print(category)
-        for count, file in tqdm(enumerate(os.listdir("./dev_data/" + category + "/test")),
-                                total=len(os.listdir("./dev_data/" + category + "/test"))):
-            if file.endswith('.wav'):
-                file_path = "./dev_data/" + category + "/test/" + file
-                wav, fs = sf.read(file_path)
-                raw = librosa.core.to_mono(wav.transpose()).transpose()
-                raw = adjust_size(raw, max_size) #288000 or 192000
-                eval_raw.append(raw)
-                eval_ids.append(category + '_' + file.split('_')[1])
-                eval_normal.append(file.split('_test_')[1].split('_')[0] == 'normal')
-                eval_files.append(file_path)
-                eval_domains.append(file.split('_')[2])
-                eval_atts.append('_'.join(file.split('.wav')[0].split('_')[6:]))
-    # reshape arrays and store
-    eval_ids = np.array(eval_ids)
-    eval_normal = np.array(eval_normal)
-    eval_files = np.array(eval_files)
-    eval_atts = np.array(eval_atts)
-    eval_domains = np.array(eval_domains)
-    eval_raw = np.expand_dims(np.array(eval_raw, dtype=np.float32), axis=-1)
-    np.save('eval_ids.npy', eval_ids)
-    np.save('eval_normal.npy', eval_normal)
-    np.save('eval_files.npy', eval_files)
-    np.save('eval_atts.npy', eval_atts)
-    np.save('eval_domains.npy', eval_domains)
-    np.save(str(target_sr) + '_eval_raw.npy', eval_raw)
+with tracer.span('decode_eval') as span:
+    eval_raw, eval_meta = load_split('eval', ['./dev_data/'], 'test')
+    span.n_examples = eval_raw.shape[0]
+eval_files = eval_meta['file'].to_numpy(dtype=str)
+eval_store_rows = eval_meta['row'].to_numpy()
+eval_ids = eval_meta['section_id'].to_numpy()
+eval_normal = eval_meta['normal'].to_numpy(dtype=bool)
+eval_domains = eval_meta['domain'].to_numpy()
 
 # load test data
 print('Loading test data')
-if os.path.isfile(str(target_sr) + '_test_raw.npy'):
-    test_raw = np.load(str(target_sr) + '_test_raw.npy')
-    test_ids = np.load('test_ids.npy')
-    test_files = np.load('test_files.npy')
-else:
-    test_raw = []
-    test_ids = []
-    test_files = []
-    eps = 1e-12
-    for label, category in enumerate(os.listdir("./eval_data/")):
-        print(category)
-        for count, file in tqdm(enumerate(os.listdir("./eval_data/" + category + "/test")),
-                                total=len(os.listdir("./eval_data/" + category + "/test"))):
-            if file.endswith('.wav'):
-                file_path = "./eval_data/" + category + "/test/" + file
-                wav, fs = sf.read(file_path)
-                raw = librosa.core.to_mono(wav.transpose()).transpose()
-                raw = adjust_size(raw, max_size) #288000 or 192000
-                test_raw.append(raw)
-                test_ids.append(category + '_' + file.split('_')[1])
-                test_files.append(file_path)
-    # reshape arrays and store
-    test_ids = np.array(test_ids)
-    test_files = np.array(test_files)
-    test_raw = np.expand_dims(np.array(test_raw, dtype=np.float32), axis=-1)
-    np.save('test_ids.npy', test_ids)
-    np.save('test_files.npy', test_files)
-    np.save(str(target_sr) + '_test_raw.npy', test_raw)
-
-
-# encode ids as labels
-le_4train = LabelEncoder()
-
-source_train = np.array([file.split('_')[3] == 'source' for file in train_files.tolist()])
-source_eval = np.array([file.split('_')[3] == 'source' for file in eval_files.tolist()])
-train_ids_4train = np.array(['###'.join([train_ids[k], train_atts[k], str(source_train[k])]) for k in np.arange(train_ids.shape[0])])
-eval_ids_4train = np.array(['###'.join([eval_ids[k], eval_atts[k], str(source_eval[k])]) for k in np.arange(eval_ids.shape[0])])
-le_4train.fit(np.concatenate([train_ids_4train, eval_ids_4train], axis=0))
-num_classes_4train = len(np.unique(np.concatenate([train_ids_4train, eval_ids_4train], axis=0)))
-train_labels_4train = le_4train.transform(train_ids_4train)
-eval_labels_4train = le_4train.transform(eval_ids_4train)
+with tracer.span('decode_test') as span:
+    test_raw, test_meta = load_split('test', ['./eval_data/'], 'test')
+    span.n_examples = test_raw.shape[0]
+test_files = test_meta['file'].to_numpy(dtype=str)
+test_store_rows = test_meta['row'].to_numpy()
+test_ids = test_meta['section_id'].to_numpy()
+
+
+# encode ids as labels, classes for training are sections combined with attributes and domain
+source_train = train_meta['source'].to_numpy()
+source_eval = eval_meta['source'].to_numpy()
+(train_labels_4train, eval_labels_4train), num_classes_4train = encode_labels([train_meta, eval_meta],
+                                                                             ['section_id', 'attributes', 'source'])
 
 le = LabelEncoder().fit(np.concatenate([train_ids, eval_ids, test_ids], axis=0))
 train_labels = le.transform(train_ids)
@@ -436,29 +131,19 @@ test_labels = le.transform(test_ids)
 all_labels = np.unique(np.concatenate([train_labels, eval_labels, test_labels], axis=0))
 num_classes = len(all_labels)
 
-# define sample weights
-sample_weights = np.ones(train_ids_4train.shape)
-for id_4train in np.unique(train_ids_4train[source_train]):
-    section = id_4train.split('###')[0]
-    domain = np.bool(id_4train.split('###')[-1])
-    sample_weights[train_ids_4train == id_4train] = np.sum((train_ids_4train != id_4train) * source_train)
-
-# normalize weights for each machine type
-for lab in np.unique(train_labels):
-    sample_weights[(train_labels==lab)*source_train] = sample_weights[(train_labels==lab)*source_train]/np.sum(sample_weights[(train_labels==lab)*source_train])
-
-# re-scale weights
-sample_weights /= np.mean(sample_weights[source_train])
+# define sample weights, balanced over the classes and normalized for each machine type
+sample_weights = balanced_sample_weights(source_train, train_labels_4train, train_labels)
 
 # distinguish between normal and anomalous samples on development set
-unknown_raw = eval_raw[~eval_normal]
+# rows of the waveform store are only indexed, the waveforms themselves are streamed during training and inference
+unknown_rows = eval_store_rows[~eval_normal]
 unknown_labels = eval_labels[~eval_normal]
 unknown_labels_4train = eval_labels_4train[~eval_normal]
 unknown_files = eval_files[~eval_normal]
 unknown_ids = eval_ids[~eval_normal]
 unknown_domains = eval_domains[~eval_normal]
 source_unknown = source_eval[~eval_normal]
-eval_raw = eval_raw[eval_normal]
+eval_rows = eval_store_rows[eval_normal]
 eval_labels = eval_labels[eval_normal]
 eval_labels_4train = eval_labels_4train[eval_normal]
 eval_files = eval_files[eval_normal]
@@ -466,6 +151,11 @@ eval_ids = eval_ids[eval_normal]
 eval_domains = eval_domains[eval_normal]
 source_eval = source_eval[eval_normal]
 
+# rows, sizes and modification times of the clips of each split, stored embeddings of changed clips are computed again
+split_files = {'train': train_files, 'eval': eval_files, 'unknown': unknown_files, 'test': test_files}
+split_rows = {'train': train_store_rows, 'eval': eval_rows, 'unknown': unknown_rows, 'test': test_store_rows}
+split_stamps = {split: np.stack(file_stats(files), axis=1) for split, files in split_files.items()}
+
 # training parameters
 batch_size = 32
 batch_size_test = 32
@@ -478,159 +168,193 @@ ensemble_size = 10
 final_results_dev = np.zeros((ensemble_size, 6))
 final_results_eval = np.zeros((ensemble_size, 6))
 
-pred_eval = np.zeros((eval_raw.shape[0], num_classes, 2))
-pred_unknown = np.zeros((unknown_raw.shape[0], num_classes, 2))
-pred_test = np.zeros((test_raw.shape[0], num_classes, 2))
+pred_eval = np.zeros((eval_rows.shape[0], num_classes, 2))
+pred_unknown = np.zeros((unknown_rows.shape[0], num_classes, 2))
+pred_test = np.zeros((test_files.shape[0], num_classes, 2))
 pred_train = np.zeros((train_labels.shape[0], num_classes, 2))
 
+# resume from the stored results of a previous run with the same hyperparameters
+run_manifest = RunManifest(run_dir, {'target_sr': target_sr, 'max_size': max_size, 'epochs': epochs, 'aeons': aeons,
+                                     'n_subclusters': n_subclusters},
+                           {'use_ensemble': use_ensemble, 'ensemble_size': ensemble_size})
+# section names of the labels, needed to score new clips with the scoring service
+with open(os.path.join(run_dir, 'sections.json'), 'w') as f:
+    json.dump(le.classes_.tolist(), f)
+# accumulated scores are stored with the stamps of the scored clips, all members score again if any clip changed
+scores_path = run_manifest.scores_path()
+data_hash = stamps_hash(split_files, split_stamps)
+scored_members = []
+if os.path.isfile(scores_path):
+    scores = np.load(scores_path)
+    if 'data_hash' in scores.files and str(scores['data_hash']) == data_hash:
+        scored_members = [str(member) for member in scores['scored_members']]
+        pred_train, pred_eval, pred_unknown, pred_test = scores['pred_train'], scores['pred_eval'], scores['pred_unknown'], scores['pred_test']
+        final_results_dev = scores['final_results_dev']
+    else:
+        print('Recordings changed since they were scored, scoring all members again')
+
+# the frontend has no weights, compute its features once for all ensemble members
+if use_feature_store:
+    with tracer.span('features', n_examples=train_raw.shape[0] + eval_raw.shape[0] + test_raw.shape[0]):
+        feature_store = FeatureStore('./feature_store', batch_size=batch_size_test)
+        train_features = feature_store.load('train', train_raw)
+        eval_features = feature_store.load('eval', eval_raw)
+        test_features = feature_store.load('test', test_raw)
+
+train_config = {
+    'train_raw': train_raw,
+    'train_rows': train_store_rows[source_train],
+    'train_labels': train_labels_4train[source_train],
+    'sample_weights': sample_weights[source_train],
+    'eval_raw': eval_raw,
+    'eval_rows': eval_rows,
+    'eval_labels': eval_labels_4train,
+    'num_classes': num_classes_4train,
+    'n_subclusters': n_subclusters,
+    'epochs': epochs,
+    'batch_size': batch_size,
+    'batch_size_test': batch_size_test,
+    'checkpoint_dir': run_manifest.checkpoint_dir(),
+    'profile_steps': profile_steps,
+    'memory_efficient_proj': memory_efficient_proj,
+    's_update_interval': s_update_interval,
+    'mixed_precision': mixed_precision,
+    'variable_length': variable_length,
+    # multi-worker training runs in worker processes started by train_ensemble_distributed
+    'strategy': distribute_strategy if distribute_strategy == 'mirrored' else None,
+    'n_replicas': n_replicas
+}
+weight_paths = [['wts_' + str(k+1) + 'k_' + str(target_sr) + '_' + str(k_ensemble+1) + '_final_only-dev.h5'
+                 for k in np.arange(aeons)] for k_ensemble in np.arange(ensemble_size)]
+if distribute_strategy == 'multi_worker':
+    with tracer.span('train_distributed', n_workers=n_replicas):
+        train_ensemble_distributed(weight_paths, train_config, n_replicas)
+elif n_parallel_members > 1:
+    with tracer.span('train_parallel', n_parallel=n_parallel_members):
+        train_ensemble_parallel(weight_paths, train_config, n_parallel_members)
+
+section_clusterer = SectionClusterer(n_subclusters, n_jobs=n_cluster_jobs, minibatch_threshold=minibatch_threshold)
+section_scorer = SectionScorer({'train': train_labels, 'eval': eval_labels, 'unknown': unknown_labels, 'test': test_labels})
+skipped_weight_paths = [weight_paths[k_ensemble][k] for k_ensemble in np.arange(ensemble_size) for k in np.arange(aeons)
+                        if 'member_' + str(k_ensemble+1) + '_aeon_' + str(k+1) in scored_members]
 for k_ensemble in np.arange(ensemble_size):
     # prepare scores and domain info
     y_train_cat = tf.keras.utils.to_categorical(train_labels, num_classes=num_classes)
     y_eval_cat = tf.keras.utils.to_categorical(eval_labels, num_classes=num_classes)
     y_unknown_cat = tf.keras.utils.to_categorical(unknown_labels, num_classes=num_classes)
 
-    y_train_cat_4train = tf.keras.utils.to_categorical(train_labels_4train, num_classes=num_classes_4train)
-    y_eval_cat_4train = tf.keras.utils.to_categorical(eval_labels_4train, num_classes=num_classes_4train)
-    y_unknown_cat_4train = tf.keras.utils.to_categorical(unknown_labels_4train, num_classes=num_classes_4train)
-
     # compile model
-    data_input, label_input, loss_output, loss_output_ssl = model_emb_cnn(num_classes=num_classes_4train,
-                                                             raw_dim=eval_raw.shape[1], n_subclusters=n_subclusters, use_bias=False)
-    model = tf.keras.Model(inputs=[data_input, label_input], outputs=[loss_output, loss_output_ssl])
-    model.compile(loss=[mixupLoss, mixupLoss], optimizer=tf.keras.optimizers.Adam() ,loss_weights=[1,1])
+    model = build_model(train_config)
     print(model.summary())
     for k in np.arange(aeons):
         print('ensemble iteration: ' + str(k_ensemble+1))
         print('aeon: ' + str(k+1))
-        # fit model
-        weight_path = 'wts_' + str(k+1) + 'k_' + str(target_sr) + '_' + str(k_ensemble+1) + '_final_only-dev.h5'
-        if not os.path.isfile(weight_path):
-            model.fit(
-                [train_raw[source_train], y_train_cat_4train[source_train]],
-                [y_train_cat_4train[source_train], y_train_cat_4train[source_train]],
-                verbose=1,
-                batch_size=batch_size, epochs=epochs,
-                validation_data=(
-                [eval_raw, y_eval_cat_4train], [y_eval_cat_4train, y_eval_cat_4train]),
-                sample_weight=sample_weights[source_train]
-                )
-            model.save(weight_path)
-            model.save(weight_path)
-        else:
-            model = tf.keras.models.load_model(weight_path,
-                                               custom_objects={'MixupLayer': MixupLayer, 'mixupLoss': mixupLoss,
-                                                               'SCAdaCos': SCAdaCos, 'AdaProj': AdaProj,
-                                                               'MagnitudeSpectrogram': MagnitudeSpectrogram, 'AugLayer': AugLayer})
-
-        # extract embeddings
-        emb_model = tf.keras.Model(model.input, model.layers[-6].output)
-        eval_embs = emb_model.predict([eval_raw, np.zeros((eval_raw.shape[0], num_classes_4train))], batch_size=batch_size)
-        train_embs = emb_model.predict([train_raw, np.zeros((train_raw.shape[0], num_classes_4train))], batch_size=batch_size)
-        unknown_embs = emb_model.predict([unknown_raw, np.zeros((unknown_raw.shape[0], num_classes_4train))], batch_size=batch_size)
-        test_embs = emb_model.predict([test_raw, np.zeros((test_raw.shape[0], num_classes_4train))], batch_size=batch_size)
-
-        # length normalization
-        x_train_ln = length_norm(train_embs)
-        x_eval_ln = length_norm(eval_embs)
-        x_test_ln = length_norm(test_embs)
-        x_unknown_ln = length_norm(unknown_embs)
-
-        for j, lab in tqdm(enumerate(all_labels)):
-            if np.sum(train_labels == lab)>0:
-                cat = le.inverse_transform([lab])[0]
-                kmeans = KMeans(n_clusters=n_subclusters, random_state=0).fit(x_train_ln[source_train*(train_labels == lab)])
-                means_source_ln = kmeans.cluster_centers_
-                means_target_ln = x_train_ln[~source_train * (train_labels == lab)]
-
-                # compute cosine distances
-                if use_ensemble:
-                    pred_train[train_labels == lab, j, 0] += np.min(2*(1-np.dot(x_train_ln[train_labels == lab], means_target_ln.transpose())), axis=-1)
-                    pred_train[train_labels == lab, j, 1] += np.min(2*(1-np.dot(x_train_ln[train_labels == lab], means_source_ln.transpose())), axis=-1)
+        member = 'member_' + str(k_ensemble+1) + '_aeon_' + str(k+1)
+        if member in scored_members:
+            print('already scored, skipping')
+            continue
+        with tracer.span(member):
+            # fit model
+            weight_path = weight_paths[k_ensemble][k]
+            with tracer.span('train') as span:
+                if not os.path.isfile(weight_path):
+                    if k > 0 and weight_paths[k_ensemble][k-1] in skipped_weight_paths:
+                        model = tf.keras.models.load_model(weight_paths[k_ensemble][k-1], custom_objects=custom_objects)
+                    fit_model(model, train_config, backup_dir=checkpoint_dir(train_config, weight_path),
+                              profile_dir=os.path.join(run_dir, 'profile', member))
+                    model.save(weight_path)
+                    span.n_examples = epochs * len(train_config['train_rows'])
+                else:
+                    model = tf.keras.models.load_model(weight_path, custom_objects=custom_objects)
+
+            # extract embeddings
+            w_hash = weights_hash(weight_path)
+            with tracer.span('embed', n_examples=len(train_files) + len(eval_files) + len(unknown_files) + len(test_files)):
+                # embeddings stored for the same weights are reused, only new and changed clips are embedded
+                embs, missing = {}, {}
+                for split in SPLITS:
+                    embs[split], missing[split] = embedding_store.reuse(member, w_hash, split, split_files[split],
+                                                                        split_stamps[split])
+                if len(missing['train']) > 0:
+                    # the cached centroids and the reference bank were computed from the previous training embeddings
+                    section_clusterer.clear_cache(embedding_store.entry_dir(member, w_hash))
+                    ReferenceBank(os.path.join(embedding_store.entry_dir(member, w_hash), BANK_DIR)).clear()
+                if use_feature_store:
+                    emb_model = emb_model_from_features(model)
+                    features = {'train': train_features, 'eval': eval_features, 'unknown': eval_features,
+                                'test': test_features}
                 else:
-                    pred_train[train_labels == lab, j, 0] = np.min(2*(1-np.dot(x_train_ln[train_labels == lab], means_target_ln.transpose())), axis=-1)
-                    pred_train[train_labels == lab, j, 1] = np.min(2*(1-np.dot(x_train_ln[train_labels == lab], means_source_ln.transpose())), axis=-1)
-                if np.sum(eval_labels == lab) > 0:
-                    if use_ensemble:
-                        pred_eval[eval_labels == lab, j,0] += np.min(2*(1-np.dot(x_eval_ln[eval_labels == lab], means_target_ln.transpose())),axis=-1)
-                        pred_eval[eval_labels == lab, j,1] += np.min(2*(1-np.dot(x_eval_ln[eval_labels == lab], means_source_ln.transpose())), axis=-1)
-                        pred_unknown[unknown_labels == lab, j,0] += np.min(2*(1-np.dot(x_unknown_ln[unknown_labels == lab], means_target_ln.transpose())), axis=-1)
-                        pred_unknown[unknown_labels == lab, j,1] += np.min(2*(1-np.dot(x_unknown_ln[unknown_labels == lab], means_source_ln.transpose())), axis=-1)
+                    emb_model = tf.keras.Model(model.input, model.get_layer('emb').output)
+                    waveforms = {'train': train_raw, 'eval': eval_raw, 'unknown': eval_raw, 'test': test_raw}
+                for split in SPLITS:
+                    if len(missing[split]) == 0:
+                        continue
+                    rows = split_rows[split][missing[split]]
+                    if use_feature_store:
+                        dataset = make_feature_dataset(features[split], batch_size, rows=rows)
                     else:
-                        pred_eval[eval_labels == lab, j,0] = np.min(2*(1-np.dot(x_eval_ln[eval_labels == lab], means_target_ln.transpose())),axis=-1)
-                        pred_eval[eval_labels == lab, j,1] = np.min(2*(1-np.dot(x_eval_ln[eval_labels == lab], means_source_ln.transpose())), axis=-1)
-                        pred_unknown[unknown_labels == lab, j,0] = np.min(2*(1-np.dot(x_unknown_ln[unknown_labels == lab], means_target_ln.transpose())), axis=-1)
-                        pred_unknown[unknown_labels == lab, j,1] = np.min(2*(1-np.dot(x_unknown_ln[unknown_labels == lab], means_source_ln.transpose())), axis=-1)
-                if np.sum(test_labels == lab) > 0:
-                    if use_ensemble:
-                        pred_test[test_labels == lab, j, 0] += np.min(2*(1-np.dot(x_test_ln[test_labels == lab], means_target_ln.transpose())), axis=-1)
-                        pred_test[test_labels == lab, j, 1] += np.min(2*(1-np.dot(x_test_ln[test_labels == lab], means_source_ln.transpose())), axis=-1)
+                        dataset = make_predict_dataset(waveforms[split], num_classes_4train, batch_size, rows=rows)
+                    with tracer.span('predict_' + split, n_examples=len(rows)):
+                        predicted = emb_model.predict(dataset)
+                    if embs[split] is None:
+                        embs[split] = predicted
                     else:
-                        pred_test[test_labels == lab, j, 0] = np.min(2*(1-np.dot(x_test_ln[test_labels == lab], means_target_ln.transpose())), axis=-1)
-                        pred_test[test_labels == lab, j, 1] = np.min(2*(1-np.dot(x_test_ln[test_labels == lab], means_source_ln.transpose())), axis=-1)
-
-        print('#######################################################################################################')
-        print('DEVELOPMENT SET')
-        print('#######################################################################################################')
-        aucs = []
-        p_aucs = []
-        aucs_source = []
-        p_aucs_source = []
-        aucs_target = []
-        p_aucs_target = []
-        for j, cat in enumerate(np.unique(eval_ids)):
-            y_pred = np.concatenate([np.min(pred_eval[eval_labels == le.transform([cat]), le.transform([cat])], axis=-1),
-                                     np.min(pred_unknown[unknown_labels == le.transform([cat]), le.transform([cat])], axis=-1)],
-                                     axis=0)
-            y_true = np.concatenate([np.zeros(np.sum(eval_labels == le.transform([cat]))),
-                                     np.ones(np.sum(unknown_labels == le.transform([cat])))], axis=0)
-            auc = roc_auc_score(y_true, y_pred)
-            aucs.append(auc)
-            p_auc = roc_auc_score(y_true, y_pred, max_fpr=0.1)
-            p_aucs.append(p_auc)
-            print('AUC for category ' + str(cat) + ': ' + str(np.round(auc * 100, 1)))
-            print('pAUC for category ' + str(cat) + ': ' + str(np.round(p_auc * 100, 1)))
-
-            source_all = np.concatenate([source_eval[eval_labels == le.transform([cat])],
-                                         source_unknown[unknown_labels == le.transform([cat])]], axis=0)
-            auc = roc_auc_score(y_true[source_all], y_pred[source_all])
-            p_auc = roc_auc_score(y_true[source_all], y_pred[source_all], max_fpr=0.1)
-            aucs_source.append(auc)
-            p_aucs_source.append(p_auc)
-            print('AUC for source domain of category ' + str(cat) + ': ' + str(np.round(auc * 100, 1)))
-            print('pAUC for source domain of category ' + str(cat) + ': ' + str(np.round(p_auc * 100, 1)))
-            auc = roc_auc_score(y_true[~source_all], y_pred[~source_all])
-            p_auc = roc_auc_score(y_true[~source_all], y_pred[~source_all], max_fpr=0.1)
-            aucs_target.append(auc)
-            p_aucs_target.append(p_auc)
-            print('AUC for target domain of category ' + str(cat) + ': ' + str(np.round(auc * 100, 1)))
-            print('pAUC for target domain of category ' + str(cat) + ': ' + str(np.round(p_auc * 100, 1)))
-        print('####################')
-        aucs = np.array(aucs)
-        p_aucs = np.array(p_aucs)
-        for cat in categories_dev:
-            mean_auc = hmean(aucs[np.array([eval_id.split('_')[0] for eval_id in np.unique(eval_ids)]) == cat])
-            print('mean AUC for category ' + str(cat) + ': ' + str(np.round(mean_auc * 100, 1)))
-            mean_p_auc = hmean(p_aucs[np.array([eval_id.split('_')[0] for eval_id in np.unique(eval_ids)]) == cat])
-            print('mean pAUC for category ' + str(cat) + ': ' + str(np.round(mean_p_auc * 100, 1)))
-        print('####################')
-        for cat in categories_dev:
-            mean_auc = hmean(aucs[np.array([eval_id.split('_')[0] for eval_id in np.unique(eval_ids)]) == cat])
-            mean_p_auc = hmean(p_aucs[np.array([eval_id.split('_')[0] for eval_id in np.unique(eval_ids)]) == cat])
-            print('mean of AUC and pAUC for category ' + str(cat) + ': ' + str(np.round((mean_p_auc + mean_auc) * 50, 1)))
-        print('####################')
-        mean_auc_source = hmean(aucs_source)
-        print('mean AUC for source domain: ' + str(np.round(mean_auc_source * 100, 1)))
-        mean_p_auc_source = hmean(p_aucs_source)
-        print('mean pAUC for source domain: ' + str(np.round(mean_p_auc_source * 100, 1)))
-        mean_auc_target = hmean(aucs_target)
-        print('mean AUC for target domain: ' + str(np.round(mean_auc_target * 100, 1)))
-        mean_p_auc_target = hmean(p_aucs_target)
-        print('mean pAUC for target domain: ' + str(np.round(mean_p_auc_target * 100, 1)))
-        mean_auc = hmean(aucs)
-        print('mean AUC: ' + str(np.round(mean_auc * 100, 1)))
-        mean_p_auc = hmean(p_aucs)
-        print('mean pAUC: ' + str(np.round(mean_p_auc * 100, 1)))
-        final_results_dev[k_ensemble] = np.array([mean_auc_source, mean_p_auc_source, mean_auc_target, mean_p_auc_target, mean_auc, mean_p_auc])
+                        embs[split][missing[split]] = predicted
+                    embedding_store.save(member, w_hash, split, embs[split], split_files[split], split_stamps[split])
+                train_embs, eval_embs, unknown_embs, test_embs = [embs[split] for split in SPLITS]
+
+            # length normalization
+            x_train_ln = length_norm(train_embs)
+            x_eval_ln = length_norm(eval_embs)
+            x_test_ln = length_norm(test_embs)
+            x_unknown_ln = length_norm(unknown_embs)
+
+            # cluster source domain embeddings of each section, cached with the embeddings of the current weights
+            with tracer.span('cluster', n_examples=int(np.sum(source_train))):
+                centroids = section_clusterer.fit(x_train_ln, section_scorer.groups['train'], source_train,
+                                                  cache_dir=embedding_store.entry_dir(member, w_hash))
+            print(section_clusterer.summary())
+
+            # compute cosine distances to the target domain embeddings and source domain centroids of each section,
+            # kept in the base layer of a reference bank, clips enrolled by the scoring service are not used
+            with tracer.span('score', n_examples=len(train_files) + len(eval_files) + len(unknown_files) + len(test_files)):
+                reference_bank = ReferenceBank(os.path.join(embedding_store.entry_dir(member, w_hash), BANK_DIR))
+                reference_bank.load_or_build(train_files, x_train_ln, section_scorer.groups['train'], source_train,
+                                             centroids)
+                references = reference_bank.references(max_memory=max_search_memory, n_threads=n_search_threads)
+                dists = section_scorer.score({'train': x_train_ln, 'eval': x_eval_ln, 'unknown': x_unknown_ln, 'test': x_test_ln},
+                                             references)
+                accumulate_scores(pred_train, train_labels, dists['train'], overwrite=not use_ensemble)
+                accumulate_scores(pred_eval, eval_labels, dists['eval'], overwrite=not use_ensemble)
+                accumulate_scores(pred_unknown, unknown_labels, dists['unknown'], overwrite=not use_ensemble)
+                accumulate_scores(pred_test, test_labels, dists['test'], overwrite=not use_ensemble)
+
+            # evaluate development set
+            with tracer.span('evaluate', n_examples=len(eval_files) + len(unknown_files)):
+                sections_dev, summary_dev = evaluate(
+                    np.concatenate([np.min(pred_eval[np.arange(len(eval_labels)), eval_labels], axis=-1),
+                                    np.min(pred_unknown[np.arange(len(unknown_labels)), unknown_labels], axis=-1)], axis=0),
+                    np.concatenate([np.zeros(len(eval_labels)), np.ones(len(unknown_labels))], axis=0),
+                    np.concatenate([source_eval, source_unknown], axis=0),
+                    np.concatenate([eval_ids, unknown_ids], axis=0), n_bootstrap=n_bootstrap)
+            with open(os.path.join(run_manifest.member_dir(member), 'results_dev.json'), 'w') as f:
+                json.dump({'sections': json.loads(sections_dev.to_json(orient='index')),
+                           'summary': json.loads(summary_dev.to_json(orient='index'))}, f, indent=2)
+            print('#######################################################################################################')
+            print('DEVELOPMENT SET')
+            print('#######################################################################################################')
+            print(np.round(sections_dev[METRICS] * 100, 1).to_string())
+            print(np.round(summary_dev * 100, 1).to_string())
+            final_results_dev[k_ensemble] = summary_dev.loc['all', METRICS].to_numpy()
+
+            # the scored members are stored with the accumulated scores so that no member is ever accumulated twice
+            scored_members.append(member)
+            np.savez(scores_path + '.part.npz', pred_train=pred_train, pred_eval=pred_eval, pred_unknown=pred_unknown,
+                     pred_test=pred_test, final_results_dev=final_results_dev, scored_members=np.array(scored_members),
+                     data_hash=np.array(data_hash))
+            os.replace(scores_path + '.part.npz', scores_path)
+        # the trace of the finished members survives an interrupted run
+        tracer.save_chrome_trace(os.path.join(run_dir, 'trace.json'))
 """
         # print results for eval set
         print('#######################################################################################################')
@@ -700,24 +424,25 @@ print('creating submission files')
 sub_path = './teams/submission/team_fkie'
 if not os.path.exists(sub_path):
     os.makedirs(sub_path)
-for j, cat in enumerate(np.unique(test_ids)):
-    # anomaly scores
-    file_idx = test_labels == le.transform([cat])
-    results_an = pd.DataFrame()
-    results_an['output1'], results_an['output2'] = [[f.split('/')[-1] for f in test_files[file_idx]],
-                                                    [str(s) for s in np.min(pred_test[file_idx, le.transform([cat])], axis=-1)]]
-    results_an.to_csv(sub_path + '/anomaly_score_' + cat.split('_')[0] + '_section_' + cat.split('_')[-1] + '_test.csv',
-                      encoding='utf-8', index=False, header=False)
-
-    # decision results
-    train_scores = np.min(pred_train[train_labels == le.transform([cat]), le.transform([cat])], axis=-1)
-    threshold = np.percentile(train_scores, q=90)
-    decisions = np.min(pred_test[file_idx, le.transform([cat])], axis=-1) > threshold
-    results_dec = pd.DataFrame()
-    results_dec['output1'], results_dec['output2'] = [[f.split('/')[-1] for f in test_files[file_idx]],
-                                                      [str(int(s)) for s in decisions]]
-    results_dec.to_csv(sub_path + '/decision_result_' + cat.split('_')[0] + '_section_' + cat.split('_')[-1] + '_test.csv',
-                       encoding='utf-8', index=False, header=False)
+with tracer.span('submission', n_examples=len(test_files)):
+    for j, cat in enumerate(np.unique(test_ids)):
+        # anomaly scores
+        file_idx = test_labels == le.transform([cat])
+        results_an = pd.DataFrame()
+        results_an['output1'], results_an['output2'] = [[f.split('/')[-1] for f in test_files[file_idx]],
+                                                        [str(s) for s in np.min(pred_test[file_idx, le.transform([cat])], axis=-1)]]
+        results_an.to_csv(sub_path + '/anomaly_score_' + cat.split('_')[0] + '_section_' + cat.split('_')[-1] + '_test.csv',
+                          encoding='utf-8', index=False, header=False)
+
+        # decision results
+        train_scores = np.min(pred_train[train_labels == le.transform([cat]), le.transform([cat])], axis=-1)
+        threshold = np.percentile(train_scores, q=90)
+        decisions = np.min(pred_test[file_idx, le.transform([cat])], axis=-1) > threshold
+        results_dec = pd.DataFrame()
+        results_dec['output1'], results_dec['output2'] = [[f.split('/')[-1] for f in test_files[file_idx]],
+                                                          [str(int(s)) for s in decisions]]
+        results_dec.to_csv(sub_path + '/decision_result_' + cat.split('_')[0] + '_section_' + cat.split('_')[-1] + '_test.csv',
+                           encoding='utf-8', index=False, header=False)
 
 print('####################')
 print('####################')
@@ -735,6 +460,10 @@ else:
     #print(np.round(np.mean(final_results_eval*100, axis=0), 1))
     #print(np.round(np.std(final_results_eval*100, axis=0), 1))
 
+print('####################')
+print(tracer.summary().round(2).to_string(index=False))
+tracer.save_json(os.path.join(run_dir, 'spans.json'))
+tracer.save_chrome_trace(os.path.join(run_dir, 'trace.json'))
 print('####################')
 print('>>>> finished! <<<<<')
 print('####################')
\ No newline at end of file
@@ -1,7 +1,16 @@
 from tensorflow.keras import backend as K
 from tensorflow.keras import layers
 import tensorflow as tf
-import tensorflow_probability as tfp
+
+
+def replica_uniform(n, dtype=tf.float32):
+    # n uniform random numbers that differ between the replicas of a distribution strategy: the workers of a
+    # multi-worker strategy run the same random ops with the same seeds, so each replica keeps the row of its replica id
+    ctx = tf.distribute.get_replica_context()
+    if ctx is None or ctx.num_replicas_in_sync == 1:
+        return tf.random.uniform(shape=[n], dtype=dtype)
+    return tf.random.uniform(shape=[ctx.num_replicas_in_sync, n], dtype=dtype)[ctx.replica_id_in_sync_group]
+
 
 class MixupLayer(layers.Layer):
     def __init__(self, prob, alpha=1, **kwargs):
@@ -17,7 +26,7 @@ class MixupLayer(layers.Layer):
         if self.alpha == 1:
             #dist = tfp.distributions.Beta(0.5, 0.5)
             #l = dist.sample([tf.shape(inputs[0])[0]])
-            l = tf.random.uniform(shape=[tf.shape(inputs[0])[0]])
+            l = replica_uniform(tf.shape(inputs[0])[0], dtype=inputs[0].dtype)
         X_l = tf.reshape(l, [-1]+[1]*(len(inputs[0].shape)-1))
         y_l = tf.reshape(l, [-1]+[1]*(len(inputs[1].shape)-1))
 
@@ -33,13 +42,18 @@ class MixupLayer(layers.Layer):
         #y = tf.math.maximum(y1 * y_l, y2 * (1 - y_l))
 
         # apply mixup or not
-        dec = tf.dtypes.cast(tf.random.uniform(shape=[tf.shape(inputs[0])[0]]) < self.prob, tf.dtypes.float32)
+        dec = tf.dtypes.cast(replica_uniform(tf.shape(inputs[0])[0]) < self.prob, inputs[0].dtype)
         dec1 = tf.reshape(dec, [-1] + [1] * (len(inputs[0].shape) - 1))
         out1 = dec1 * X + (1 - dec1) * inputs[0]
         dec2 = tf.reshape(dec, [-1] + [1] * (len(inputs[1].shape) - 1))
         out2 = dec2 * y + (1 - dec2) * inputs[1]
         outputs = [out1, out2]
 
+        # optional lengths of zero-padded clips, a mixed clip is as long as the longer of both clips
+        if len(inputs) > 2:
+            lengths = tf.maximum(inputs[2], tf.reverse(inputs[2], axis=[0]))
+            outputs.append(tf.where(dec > 0, lengths, inputs[2]))
+
         # pick output corresponding to training phase
         return K.in_train_phase(outputs, inputs, training=training)
 
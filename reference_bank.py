@@ -0,0 +1,241 @@
+import os
+import json
+import hashlib
+import numpy as np
+from reference_index import ReferenceIndex
+
+BANK_VERSION = 2
+BANK_MANIFEST = 'bank.json'
+ENROLLED_MANIFEST = 'enrolled.json'
+BANK_DIR = 'reference_bank'
+DOMAINS = ['target', 'source']
+
+
+def bank_key(train_files, centroids):
+    # identifies the training clips and the clustering the references of a bank were built from
+    sha1 = hashlib.sha1(json.dumps([str(f) for f in train_files]).encode('utf-8'))
+    for lab in sorted(centroids):
+        sha1.update(lab.encode('utf-8'))
+        sha1.update(np.ascontiguousarray(centroids[lab]).tobytes())
+    return sha1.hexdigest()
+
+
+def closest_centroids(x, centroids):
+    # index of the closest centroid in euclidean distance, as assigned by KMeans
+    sq_dists = np.sum(np.square(centroids), axis=1)[None] - 2 * np.dot(x, centroids.transpose())
+    return np.argmin(sq_dists, axis=1)
+
+
+def update_centroids(centroids, counts, x_ln):
+    # mini-batch k-means update, every centroid stays the mean of all source embeddings assigned to it
+    closest = closest_centroids(x_ln, centroids)
+    n_new = np.bincount(closest, minlength=len(centroids))
+    sums = np.zeros(centroids.shape)
+    np.add.at(sums, closest, x_ln)
+    updated = n_new > 0
+    counts = counts + n_new
+    centroids = np.array(centroids)
+    centroids[updated] += (sums[updated] - n_new[updated, None] * centroids[updated]) / counts[updated, None]
+    return centroids, counts
+
+
+def save_atomic(path, **arrays):
+    # a single array is saved as .npy, several as .npz
+    part = path[:-len('.npy')] + '.part' + path[-len('.npy'):]
+    if path.endswith('.npy'):
+        np.save(part, *arrays.values())
+    else:
+        np.savez(part, **arrays)
+    os.replace(part, path)
+
+
+class ReferenceBank():
+    """
+    Persistent per-section references of one ensemble member in two layers, keyed by str(label).
+    The base layer holds the references scored by main.py: the length normalized target domain training embeddings and
+    the source domain centroids with the number of embeddings each centroid is the mean of.
+    The enrolled layer holds normal clips enrolled by the scoring service without retraining and is ignored by main.py.
+    Target embeddings are appended to the targets, source embeddings move their closest centroids like a mini-batch
+    k-means update. Enrolled embeddings are written in chunks that are merged like the blocks of a ReferenceIndex, so
+    the number of files stays logarithmic and the amortized cost of an enrollment only depends on the number of new
+    clips. Enrolled clips are kept when the base layer is rebuilt, the enrolled source clips then move the new centroids.
+    """
+
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        self.key = None
+        self.dim = None
+        self.base_targets = {}
+        self.base_centroids = {}
+        self.base_counts = {}
+        # enrolled layer, read on demand
+        self.chunks = None
+        self.next_chunk = 0
+        self.enrolled_targets = {}
+        self.centroids = {}
+        self.counts = {}
+
+    def path(self, name):
+        return os.path.join(self.bank_dir, name)
+
+    @property
+    def sections(self):
+        return list(self.base_centroids.keys())
+
+    def build(self, key, x_ln, groups, source, centroids):
+        """
+        Builds the base layer: all target domain embeddings and the source domain centroids of each section. groups maps
+        each section label to its row indices in x_ln and source is a boolean mask of the source rows.
+        """
+        self.clear()
+        os.makedirs(self.bank_dir, exist_ok=True)
+        x_ln = np.asarray(x_ln)
+        self.key, self.dim = key, x_ln.shape[1]
+        self.base_targets, self.base_centroids, self.base_counts = {}, {}, {}
+        for lab, rows in groups.items():
+            lab = str(lab)
+            self.base_targets[lab] = np.asarray(x_ln[rows[~source[rows]]], dtype=np.float32)
+            self.base_centroids[lab] = np.array(centroids[lab])
+            self.base_counts[lab] = np.bincount(closest_centroids(x_ln[rows[source[rows]]], self.base_centroids[lab]),
+                                                minlength=len(self.base_centroids[lab])).astype(np.int64)
+            save_atomic(self.path('base_' + lab + '_target.npy'), targets=self.base_targets[lab])
+            save_atomic(self.path('base_' + lab + '_source.npz'), centroids=self.base_centroids[lab],
+                        counts=self.base_counts[lab])
+        # written last, the base layer is only complete after its targets and centroids were written
+        with open(self.path(BANK_MANIFEST) + '.part', 'w') as f:
+            json.dump({'version': BANK_VERSION, 'key': key, 'dim': self.dim, 'sections': self.sections}, f)
+        os.replace(self.path(BANK_MANIFEST) + '.part', self.path(BANK_MANIFEST))
+        self.chunks = None
+
+    def clear(self):
+        # removes the base layer, e.g. when the training embeddings it was built from changed
+        if os.path.isfile(self.path(BANK_MANIFEST)):
+            os.remove(self.path(BANK_MANIFEST))
+        if os.path.isdir(self.bank_dir):
+            for name in os.listdir(self.bank_dir):
+                if name.startswith('base_'):
+                    os.remove(self.path(name))
+
+    def read(self, key=None, enrolled=False):
+        # loads the base layer and optionally the enrolled layer, returns False if there is no base layer of the current
+        # version or it was built with another key
+        if not os.path.isfile(self.path(BANK_MANIFEST)):
+            return False
+        with open(self.path(BANK_MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != BANK_VERSION or (key is not None and manifest['key'] != key):
+            return False
+        self.key, self.dim = manifest['key'], manifest['dim']
+        self.base_targets, self.base_centroids, self.base_counts = {}, {}, {}
+        for lab in manifest['sections']:
+            self.base_targets[lab] = np.load(self.path('base_' + lab + '_target.npy'))
+            with np.load(self.path('base_' + lab + '_source.npz')) as source:
+                self.base_centroids[lab], self.base_counts[lab] = source['centroids'], source['counts']
+        self.chunks = None
+        if enrolled:
+            self.read_enrolled()
+        return True
+
+    def load_or_build(self, train_files, x_ln, groups, source, centroids):
+        # the base layer of the current training clips and clustering, built if there is none
+        key = bank_key(train_files, centroids)
+        if not self.read(key):
+            self.build(key, x_ln, groups, source, centroids)
+        return self
+
+    def read_enrolled(self):
+        manifest = {'base_key': None, 'next_chunk': 0, 'chunks': {}}
+        if os.path.isfile(self.path(ENROLLED_MANIFEST)):
+            with open(self.path(ENROLLED_MANIFEST), 'r') as f:
+                manifest = json.load(f)
+        self.next_chunk = manifest['next_chunk']
+        self.chunks = dict(manifest['chunks'])
+        self.enrolled_targets, self.centroids, self.counts = {}, {}, {}
+        for lab in self.sections:
+            self.chunks.setdefault(lab, {domain: [] for domain in DOMAINS})
+            self.enrolled_targets[lab] = [np.load(self.path(name)) for name, _ in self.chunks[lab]['target']]
+            if manifest['base_key'] == self.key and os.path.isfile(self.path('enrolled_' + lab + '_source.npz')):
+                with np.load(self.path('enrolled_' + lab + '_source.npz')) as source:
+                    self.centroids[lab], self.counts[lab] = source['centroids'], source['counts']
+                continue
+            # the base layer was rebuilt, the enrolled source clips move its new centroids
+            self.centroids[lab], self.counts[lab] = self.base_centroids[lab], self.base_counts[lab]
+            for name, _ in self.chunks[lab]['source']:
+                self.centroids[lab], self.counts[lab] = update_centroids(self.centroids[lab], self.counts[lab],
+                                                                         np.load(self.path(name)))
+            self.write_source(lab)
+        self.write_manifest()
+
+    def write_manifest(self):
+        # written last, enrolled clips are only part of the bank after their chunks and centroids were written
+        with open(self.path(ENROLLED_MANIFEST) + '.part', 'w') as f:
+            json.dump({'base_key': self.key, 'next_chunk': self.next_chunk, 'chunks': self.chunks}, f)
+        os.replace(self.path(ENROLLED_MANIFEST) + '.part', self.path(ENROLLED_MANIFEST))
+
+    def write_source(self, lab):
+        save_atomic(self.path('enrolled_' + lab + '_source.npz'), centroids=self.centroids[lab],
+                    counts=self.counts[lab])
+
+    def append_chunk(self, lab, domain, x_ln):
+        """
+        Writes x_ln as a new chunk of the enrolled embeddings of a section and domain, merged with the previous chunks
+        while it is at least as large. Returns the merged chunks, to be removed once the manifest no longer lists them.
+        """
+        chunks = self.chunks[lab][domain]
+        merged = []
+        while len(chunks) > 0 and len(x_ln) >= chunks[-1][1]:
+            name, _ = chunks.pop()
+            previous = self.enrolled_targets[lab].pop() if domain == 'target' else np.load(self.path(name))
+            x_ln = np.concatenate([previous, x_ln], axis=0)
+            merged.append(name)
+        name = 'enrolled_' + lab + '_' + domain + '_' + str(self.next_chunk).zfill(6) + '.npy'
+        self.next_chunk += 1
+        save_atomic(self.path(name), embs=x_ln)
+        chunks.append([name, len(x_ln)])
+        if domain == 'target':
+            self.enrolled_targets[lab].append(x_ln)
+        return merged
+
+    def enroll(self, lab, x_ln, source, index=None):
+        """
+        Adds the length normalized embeddings x_ln of new normal clips of section lab to the enrolled layer, source is a
+        boolean mask of the clips of the source domain. index, the ReferenceIndex of the section with both layers, is
+        updated in place if given.
+        """
+        lab = str(lab)
+        if lab not in self.base_centroids:
+            raise ValueError('unknown section ' + lab)
+        if self.chunks is None:
+            self.read_enrolled()
+        x_ln, source = np.asarray(x_ln, dtype=np.float32), np.asarray(source, dtype=bool)
+        merged = []
+        if np.any(~source):
+            merged += self.append_chunk(lab, 'target', x_ln[~source])
+            if index is not None:
+                index.append(x_ln[~source], 0)
+        if np.any(source):
+            merged += self.append_chunk(lab, 'source', x_ln[source])
+            self.centroids[lab], self.counts[lab] = update_centroids(self.centroids[lab], self.counts[lab], x_ln[source])
+            self.write_source(lab)
+            if index is not None:
+                index.replace(self.centroids[lab], 1)
+        self.write_manifest()
+        for name in merged:
+            os.remove(self.path(name))
+
+    def index(self, lab, max_memory=256 * 2**20, n_threads=1, enrolled=False):
+        lab = str(lab)
+        if not enrolled:
+            return ReferenceIndex([self.base_targets[lab], self.base_centroids[lab]], max_memory=max_memory,
+                                  n_threads=n_threads)
+        if self.chunks is None:
+            self.read_enrolled()
+        index = ReferenceIndex([self.base_targets[lab], self.centroids[lab]], max_memory=max_memory,
+                               n_threads=n_threads)
+        for targets in self.enrolled_targets[lab]:
+            index.append(targets, 0)
+        return index
+
+    def references(self, max_memory=256 * 2**20, n_threads=1, enrolled=False):
+        # references of all sections keyed by label, as returned by scoring.build_references for the base layer
+        return {int(lab): self.index(lab, max_memory, n_threads, enrolled) for lab in self.sections}
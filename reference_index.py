@@ -0,0 +1,113 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReferenceIndex():
+    """
+    Exact cosine similarity search over one or more sets of length normalized reference embeddings.
+    Queries and references are processed in tiles so that the dot products held in memory never exceed max_memory
+    bytes, independent of the number of queries and references. Query blocks can be searched by several threads.
+    References can be appended to a set without copying the references that are already indexed.
+    """
+
+    def __init__(self, refs, max_memory=256 * 2**20, n_threads=1, ref_block_size=8192):
+        self.single = isinstance(refs, np.ndarray)
+        if self.single:
+            refs = [refs]
+        # each set is kept as a list of blocks
+        self.blocks = [[np.ascontiguousarray(r)] for r in refs]
+        self.dtype = np.result_type(*refs)
+        self.max_memory = max_memory
+        self.n_threads = n_threads
+        self.ref_block_size = ref_block_size
+
+    @property
+    def n_segments(self):
+        return len(self.blocks)
+
+    def __len__(self):
+        return sum(len(block) for blocks in self.blocks for block in blocks)
+
+    def append(self, refs, segment=0):
+        # a new block is merged with the previous block of its set while it is at least as large, so that a set has at
+        # most logarithmically many blocks and every reference is copied at most logarithmically often
+        blocks = self.blocks[segment]
+        blocks.append(np.ascontiguousarray(refs))
+        while len(blocks) > 1 and len(blocks[-1]) >= len(blocks[-2]):
+            blocks[-2:] = [np.concatenate(blocks[-2:], axis=0)]
+        self.dtype = np.result_type(self.dtype, refs)
+
+    def replace(self, refs, segment):
+        self.blocks[segment] = [np.ascontiguousarray(refs)]
+        self.dtype = np.result_type(*[block for blocks in self.blocks for block in blocks])
+
+    def block_sizes(self, k):
+        # memory of one tile: dot products (query_block x ref_block) plus top-k candidates of all reference sets
+        itemsize = self.dtype.itemsize
+        budget = self.max_memory // self.n_threads
+        ref_block = int(max(1, min(len(self), self.ref_block_size, budget // (4 * itemsize))))
+        query_block = int(max(1, budget // (itemsize * ref_block + 32 * self.n_segments * k)))
+        return query_block, ref_block
+
+    def _search_block(self, queries, k, ref_block):
+        n_queries = queries.shape[0]
+        sims = np.full((n_queries, self.n_segments, k), -np.inf, dtype=np.result_type(queries, self.dtype))
+        idx = np.full((n_queries, self.n_segments, k), -1, dtype=np.int64)
+        rows = np.arange(n_queries)
+        for s, blocks in enumerate(self.blocks):
+            offset = 0
+            for refs in blocks:
+                for r0 in range(0, len(refs), ref_block):
+                    block = np.dot(queries, refs[r0:r0 + ref_block].transpose())
+                    lo = offset + r0
+                    if k == 1:
+                        j = np.argmax(block, axis=1)
+                        values = block[rows, j]
+                        better = values > sims[:, s, 0]
+                        sims[better, s, 0] = values[better]
+                        idx[better, s, 0] = lo + j[better]
+                    else:
+                        k_block = min(k, block.shape[1])
+                        part = np.argpartition(-block, k_block - 1, axis=1)[:, :k_block]
+                        cand_sims = np.concatenate([sims[:, s], np.take_along_axis(block, part, axis=1)], axis=1)
+                        cand_idx = np.concatenate([idx[:, s], lo + part], axis=1)
+                        best = np.argpartition(-cand_sims, k - 1, axis=1)[:, :k]
+                        sims[:, s] = np.take_along_axis(cand_sims, best, axis=1)
+                        idx[:, s] = np.take_along_axis(cand_idx, best, axis=1)
+                offset += len(refs)
+        if k > 1:
+            order = np.argsort(-sims, axis=-1, kind='stable')
+            sims = np.take_along_axis(sims, order, axis=-1)
+            idx = np.take_along_axis(idx, order, axis=-1)
+        return sims, idx
+
+    def search(self, queries, k=1):
+        """
+        Returns the k largest cosine similarities and the indices of the corresponding references within their set,
+        with shape (n_queries, k) for a single reference set and (n_queries, n_sets, k) otherwise.
+        Missing neighbours (empty sets or sets with fewer than k references) have similarity -inf and index -1.
+        """
+        queries = np.asarray(queries)
+        query_block, ref_block = self.block_sizes(k)
+        sims = np.empty((queries.shape[0], self.n_segments, k), dtype=np.result_type(queries, self.dtype))
+        idx = np.empty((queries.shape[0], self.n_segments, k), dtype=np.int64)
+
+        def search_block(start):
+            sims[start:start + query_block], idx[start:start + query_block] = self._search_block(
+                queries[start:start + query_block], k, ref_block)
+
+        starts = range(0, queries.shape[0], query_block)
+        if self.n_threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                list(executor.map(search_block, starts))
+        else:
+            for start in starts:
+                search_block(start)
+        if self.single:
+            return sims[:, 0], idx[:, 0]
+        return sims, idx
+
+    def min_distances(self, queries):
+        # cosine distance 2*(1-cos) to the closest reference of each set, inf for empty sets
+        sims, _ = self.search(queries, k=1)
+        return 2*(1-sims[..., 0])
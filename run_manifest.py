@@ -0,0 +1,64 @@
+import os
+import json
+import shutil
+
+SCORES = 'scores.npz'
+CHECKPOINTS = 'checkpoints'
+
+
+class RunManifest():
+    """
+    Hyperparameters of a run in run_dir. A restarted run resumes from the stored results themselves: the weight file of
+    each trained member, the per-epoch checkpoints of an interrupted fit, the embedding store with the centroids and
+    reference banks of each weight file and the accumulated scores of the scored members in scores.npz.
+    Embeddings and scores are keyed by the stamps of the clips, so added or changed recordings never remove results.
+    A change of the training hyperparameters removes the checkpoints and scores, of the scoring hyperparameters only the
+    scores.
+    """
+
+    def __init__(self, run_dir, train_config, score_config):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, 'manifest.json')
+        self.state = {'train': train_config, 'score': score_config}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            if state.get('train') != train_config:
+                print('Training configuration changed, removing checkpoints and scores in ' + run_dir)
+                self.remove(CHECKPOINTS)
+                self.remove_scores()
+            elif state.get('score') != score_config:
+                print('Scoring configuration changed, removing scores in ' + run_dir)
+                self.remove_scores()
+        os.makedirs(run_dir, exist_ok=True)
+        self.save()
+
+    def save(self):
+        with open(self.path + '.part', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.path + '.part', self.path)
+
+    def remove(self, name):
+        path = os.path.join(self.run_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    def remove_scores(self):
+        # accumulated scores and the development set results of each member
+        self.remove(SCORES)
+        for name in os.listdir(self.run_dir):
+            if name.startswith('member_'):
+                self.remove(name)
+
+    def scores_path(self):
+        return os.path.join(self.run_dir, SCORES)
+
+    def checkpoint_dir(self):
+        return os.path.join(self.run_dir, CHECKPOINTS)
+
+    def member_dir(self, member):
+        path = os.path.join(self.run_dir, member)
+        os.makedirs(path, exist_ok=True)
+        return path
@@ -0,0 +1,60 @@
+import numpy as np
+from reference_index import ReferenceIndex
+
+
+def length_norm(mat):
+    mat = np.asarray(mat)
+    return mat / np.sqrt(np.sum(np.square(mat), axis=1, keepdims=True))
+
+
+def group_rows(labels):
+    # row indices of each label computed with a single sort
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    uniq, starts = np.unique(labels[order], return_index=True)
+    return dict(zip(uniq.tolist(), np.split(order, starts[1:])))
+
+
+def build_references(x_train_ln, train_groups, source_train, centroids, max_memory=256 * 2**20, n_threads=1):
+    """
+    Target domain references are all target training embeddings, source domain references the cluster centroids.
+    Both sets of a section are searched by one memory bounded index, returning distances to the closest target and
+    source reference.
+    """
+    return {lab: ReferenceIndex([x_train_ln[rows[~source_train[rows]]], centroids[str(lab)]],
+                                max_memory=max_memory, n_threads=n_threads)
+            for lab, rows in train_groups.items()}
+
+
+def accumulate_scores(pred, labels, dists, overwrite=False):
+    # add distances to the column of the section of each row, rows of sections without references are left unchanged
+    rows = np.flatnonzero(~np.isnan(dists[:, 0]))
+    if overwrite:
+        pred[rows, labels[rows]] = dists[rows]
+    else:
+        pred[rows, labels[rows]] += dists[rows]
+
+
+class SectionScorer():
+    """
+    Scores the embeddings of all splits against per-section references in a single pass over the sections.
+    The row indices of each section are computed once when creating the scorer.
+    """
+
+    def __init__(self, labels):
+        self.splits = list(labels.keys())
+        self.groups = {split: group_rows(labels[split]) for split in self.splits}
+
+    def score(self, embs, references):
+        dists = {split: np.full((len(embs[split]), 2), np.nan) for split in self.splits}
+        empty = np.zeros(0, dtype=np.int64)
+        for lab, index in references.items():
+            rows = [self.groups[split].get(lab, empty) for split in self.splits]
+            if sum(len(r) for r in rows) == 0:
+                continue
+            queries = np.concatenate([np.asarray(embs[split])[r] for split, r in zip(self.splits, rows)], axis=0)
+            section_dists = index.min_distances(queries)
+            offsets = np.cumsum([0] + [len(r) for r in rows])
+            for k, split in enumerate(self.splits):
+                dists[split][rows[k]] = section_dists[offsets[k]:offsets[k+1]]
+        return dists
@@ -0,0 +1,311 @@
+import os
+import glob
+import json
+import time
+import asyncio
+import argparse
+import collections
+import numpy as np
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+from data.process_data import load_wav
+from emb_cnn import frontend_model, emb_model_from_features, custom_objects
+from embedding_store import EmbeddingStore, weights_hash
+from scoring import length_norm, group_rows
+from reference_bank import ReferenceBank, BANK_DIR, bank_key
+
+
+def section_of(path):
+    # same section ids as used for the labels in main.py
+    return path.split('/')[-3] + '_' + path.split('/')[-1].split('_')[1]
+
+
+def run_max_size(run_dir):
+    # clip length of the run of main.py, needed for models trained on variable length clips
+    path = os.path.join(run_dir, 'manifest.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)['train'].get('max_size')
+
+
+def pad_batch(waveforms):
+    # clips padded to the longest clip, together with their lengths
+    lengths = np.array([len(waveform) for waveform in waveforms])
+    x = np.zeros((len(waveforms), np.max(lengths), 1), dtype=np.float32)
+    for k, waveform in enumerate(waveforms):
+        x[k, :len(waveform), 0] = waveform
+    return x, lengths
+
+
+class EnsembleScorer():
+    """
+    Scores clips with all ensemble members that were trained and scored by main.py. Models, the per-section references
+    of the reference bank of each member and the decision thresholds are loaded once.
+    Anomaly scores are the minimum of the target and source distances summed over all members, as in the submission
+    files, and decisions use the 90th percentile of the scores of the training clips of each section as threshold.
+    New normal clips can be enrolled as references, the thresholds stay those of the training clips.
+    """
+
+    def __init__(self, weight_paths, embedding_store, sections, max_size=None, max_memory=256 * 2**20, n_threads=1):
+        self.sections = list(sections)
+        self.max_memory = max_memory
+        self.n_threads = n_threads
+        self.members = []
+        self.raw_dim, self.variable_length = None, None
+        train_files = None
+        for weight_path in weight_paths:
+            w_hash = weights_hash(weight_path)
+            member = embedding_store.find(w_hash)
+            if member is None:
+                raise ValueError('no stored embeddings for ' + weight_path + ', run main.py first')
+            model = tf.keras.models.load_model(weight_path, custom_objects=custom_objects)
+            emb_model = emb_model_from_features(model)
+            # models trained on variable length clips take the numbers of frames as third input of the backbone and
+            # have no fixed input length, the FFT size is the max_size of the run
+            variable_length = len(emb_model.inputs) == 3
+            raw_dim = max_size if variable_length else model.input[0].shape[1]
+            if raw_dim is None:
+                raise ValueError(weight_path + ' was trained on variable length clips, the max_size of the run is needed')
+            if self.raw_dim is not None and (raw_dim, variable_length) != (self.raw_dim, self.variable_length):
+                raise ValueError('members have different input sizes or were not all trained on clips of the same '
+                                 'length')
+            self.raw_dim, self.variable_length = raw_dim, variable_length
+            x_train, files = embedding_store.load(member, w_hash, 'train')
+            if train_files is None:
+                train_files = files
+                train_labels = np.array([self.sections.index(section_of(f)) for f in train_files])
+                train_groups = group_rows(train_labels)
+                train_dists = np.zeros((len(train_files), 2))
+            elif not np.array_equal(files, train_files):
+                raise ValueError('members were trained on different files')
+            centroids_path = os.path.join(embedding_store.entry_dir(member, w_hash), 'centroids.npz')
+            if not os.path.isfile(centroids_path):
+                raise ValueError('no stored centroids for ' + member)
+            bank = ReferenceBank(os.path.join(embedding_store.entry_dir(member, w_hash), BANK_DIR))
+            if not bank.read(bank_key(train_files, dict(np.load(centroids_path))), enrolled=True):
+                raise ValueError('no reference bank of the current centroids for ' + member + ', run main.py first')
+            x_train_ln = length_norm(x_train)
+            # scores of the training clips are accumulated exactly like pred_train in main.py, without enrolled clips
+            base_references = bank.references(max_memory=max_memory, n_threads=n_threads)
+            for lab, rows in train_groups.items():
+                train_dists[rows] += base_references[lab].min_distances(x_train_ln[rows])
+            references = bank.references(max_memory=max_memory, n_threads=n_threads, enrolled=True)
+            self.members.append((member, emb_model, bank, references))
+        # the frontend has no weights and is shared by all members
+        self.frontend = frontend_model(self.raw_dim, variable_length=self.variable_length)
+
+        train_scores = np.min(train_dists, axis=1)
+        self.thresholds = {lab: np.percentile(train_scores[rows], q=90) for lab, rows in train_groups.items()}
+
+    def label(self, section):
+        if section not in self.sections or self.sections.index(section) not in self.thresholds:
+            raise ValueError('unknown section ' + str(section))
+        return self.sections.index(section)
+
+    def features(self, x, lengths=None):
+        # clips of variable length models are padded to the longest clip of the batch, lengths default to full clips
+        if not self.variable_length:
+            return self.frontend(x, training=False)
+        if lengths is None:
+            lengths = np.full(x.shape[0], x.shape[1])
+        return self.frontend([x, np.asarray(lengths, dtype=np.int32)], training=False)
+
+    def embed(self, emb_model, x_fft, x_spec, n_frames=None):
+        if not self.variable_length:
+            return length_norm(emb_model.predict_on_batch([x_fft, x_spec]))
+        if n_frames is None:
+            n_frames = np.full(x_spec.shape[0], x_spec.shape[1])
+        return length_norm(emb_model.predict_on_batch([x_fft, x_spec, np.asarray(n_frames, dtype=np.int32)]))
+
+    def score(self, x, labels, lengths=None):
+        features = self.features(x, lengths)
+        return self.score_features(features[0], features[1], labels, *features[2:])
+
+    def enroll(self, x, labels, source, lengths=None):
+        # the new clips are appended to the indices of their sections
+        features = self.features(x, lengths)
+        groups = group_rows(labels)
+        for _, emb_model, bank, references in self.members:
+            embs = self.embed(emb_model, *features)
+            for lab, rows in groups.items():
+                bank.enroll(lab, embs[rows], source[rows], index=references[lab])
+
+    def score_features(self, x_fft, x_spec, labels, n_frames=None):
+        # n_frames only for variable length models, None for spectrograms of complete clips
+        dists = np.zeros((x_fft.shape[0], 2))
+        groups = group_rows(labels)
+        for _, emb_model, _, references in self.members:
+            embs = self.embed(emb_model, x_fft, x_spec, n_frames)
+            for lab, rows in groups.items():
+                dists[rows] += references[lab].min_distances(embs[rows])
+        scores = np.min(dists, axis=1)
+        thresholds = np.array([self.thresholds[lab] for lab in labels])
+        return scores, scores > thresholds, thresholds
+
+
+class ScoringService():
+    """
+    asyncio server scoring clips sent as JSON lines over TCP or a Unix socket. Requests are grouped into micro-batches
+    of at most max_batch_size clips, a batch is started at the latest max_delay seconds after its first clip arrived.
+    Requests: {"id": ..., "path": wav file, "section": optional, e.g. "fan_00"}, {"cmd": "stats"} or
+    {"cmd": "enroll", "id": ..., "path": wav file of a normal clip, "section": optional, "domain": "target" or "source"}.
+    """
+
+    def __init__(self, scorer, max_batch_size=32, max_delay=0.05, n_workers=4, stats_window=1000):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.decode_executor = ThreadPoolExecutor(n_workers)
+        # a single thread runs the models so that batches never compete for the cores
+        self.inference_executor = ThreadPoolExecutor(1)
+        self.queue = None
+        self.latencies = collections.deque(maxlen=stats_window)
+        self.batch_sizes = collections.deque(maxlen=stats_window)
+        self.inference_times = collections.deque(maxlen=stats_window)
+        self.n_requests = 0
+        self.n_errors = 0
+
+    async def submit(self, waveform, section):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self.queue.put((loop.time(), waveform, self.scorer.label(section), future))
+        return await future
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][0] + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    batch.append(self.queue.get_nowait() if timeout <= 0 else
+                                 await asyncio.wait_for(self.queue.get(), timeout))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            x, lengths = pad_batch([waveform for _, waveform, _, _ in batch])
+            labels = np.array([lab for _, _, lab, _ in batch])
+            start = time.perf_counter()
+            try:
+                scores, decisions, thresholds = await loop.run_in_executor(self.inference_executor, self.scorer.score,
+                                                                           x, labels, lengths)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.inference_times.append(time.perf_counter() - start)
+            self.batch_sizes.append(len(batch))
+            for k, (_, _, _, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((float(scores[k]), bool(decisions[k]), float(thresholds[k])))
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {'queue_depth': self.queue.qsize(), 'requests': self.n_requests, 'errors': self.n_errors,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.0,
+                'mean_inference_ms': float(np.mean(self.inference_times) * 1000) if len(self.inference_times) > 0 else 0.0,
+                'latency_ms': {str(q): float(np.percentile(latencies, q)) if len(latencies) > 0 else 0.0
+                               for q in [50, 95, 99]}}
+
+    def decode(self, path):
+        # clips of variable length models are not padded
+        return np.asarray(load_wav(path, self.scorer.raw_dim, pad=not self.scorer.variable_length), dtype=np.float32)
+
+    async def enroll(self, request):
+        # enrollments run on the inference thread between batches and take effect for all later batches
+        loop = asyncio.get_running_loop()
+        try:
+            section = request.get('section', section_of(request['path']) if 'path' in request else None)
+            label = self.scorer.label(section)
+            if request.get('domain', 'target') not in ['source', 'target']:
+                raise ValueError('unknown domain ' + str(request['domain']))
+            waveform = await loop.run_in_executor(self.decode_executor, self.decode, request['path'])
+            x, lengths = pad_batch([waveform])
+            await loop.run_in_executor(self.inference_executor, self.scorer.enroll, x, np.array([label]),
+                                       np.array([request.get('domain', 'target') == 'source']), lengths)
+        except Exception as e:
+            self.n_errors += 1
+            return {'id': request.get('id'), 'error': str(e)}
+        return {'id': request.get('id'), 'section': section, 'enrolled': request.get('domain', 'target')}
+
+    async def handle_request(self, request):
+        if request.get('cmd') == 'stats':
+            return self.stats()
+        if request.get('cmd') == 'enroll':
+            return await self.enroll(request)
+        start = time.perf_counter()
+        self.n_requests += 1
+        try:
+            section = request.get('section', section_of(request['path']) if 'path' in request else None)
+            waveform = await asyncio.get_running_loop().run_in_executor(self.decode_executor, self.decode,
+                                                                        request['path'])
+            score, decision, threshold = await self.submit(waveform, section)
+        except Exception as e:
+            self.n_errors += 1
+            return {'id': request.get('id'), 'error': str(e)}
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        return {'id': request.get('id'), 'section': section, 'score': score, 'decision': int(decision),
+                'threshold': threshold, 'latency_ms': latency * 1000}
+
+    async def handle_client(self, reader, writer):
+        # requests of one connection are processed concurrently, responses are written in order of completion
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(line):
+            try:
+                response = await self.handle_request(json.loads(line))
+            except json.JSONDecodeError as e:
+                response = {'error': 'invalid request: ' + str(e)}
+            async with lock:
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.create_task(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_socket=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batch_loop())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        print('scoring service listening on ' + (unix_socket if unix_socket is not None else host + ':' + str(port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='online anomaly scoring with the trained ensemble')
+    parser.add_argument('--weights', nargs='+', default=None, help='weight files of the members, default wts_*.h5')
+    parser.add_argument('--embedding-store', default='./embedding_store')
+    parser.add_argument('--run-dir', default='./run_state')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-delay-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    with open(os.path.join(args.run_dir, 'sections.json'), 'r') as f:
+        sections = json.load(f)
+    scorer = EnsembleScorer(args.weights or sorted(glob.glob('wts_*.h5')), EmbeddingStore(args.embedding_store),
+                            sections, max_size=run_max_size(args.run_dir))
+    service = ScoringService(scorer, max_batch_size=args.max_batch_size, max_delay=args.max_delay_ms / 1000)
+    asyncio.run(service.serve(args.host, args.port, args.unix_socket))
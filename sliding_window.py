@@ -0,0 +1,153 @@
+import os
+import json
+import glob
+import argparse
+import collections
+import numpy as np
+import soundfile as sf
+import librosa
+import tensorflow as tf
+from emb_cnn import fft_features, MagnitudeSpectrogram
+from embedding_store import EmbeddingStore
+from scoring_service import EnsembleScorer, run_max_size
+
+POOLING = {'none': lambda scores: scores[-1], 'max': np.max, 'mean': np.mean, 'median': np.median}
+
+
+class StreamScorer():
+    """
+    Scores a continuous waveform of a single section in overlapping windows of the model input size.
+    Windows start every hop samples and are embedded in batches of batch_size windows. Only the samples and
+    spectrogram frames of windows that are not scored yet are kept, so memory does not grow with the stream length.
+    If hop is a multiple of the STFT hop size (512), spectrogram frames are computed once for the stream and shared by
+    all overlapping windows instead of being recomputed for every window.
+    Window scores are pooled over the last pool_size windows with max, mean, median or none.
+    """
+
+    def __init__(self, scorer, section, hop=None, batch_size=8, reuse_frames=True, pooling='none', pool_size=1,
+                 fft_size=1024, stft_hop=512):
+        self.scorer = scorer
+        self.label = scorer.label(section)
+        self.window_size = scorer.raw_dim
+        # default: largest multiple of the STFT hop size that is at most half a window
+        self.hop = hop if hop is not None else max(stft_hop, (self.window_size // 2) // stft_hop * stft_hop)
+        self.batch_size = batch_size
+        self.fft_size = fft_size
+        self.stft_hop = stft_hop
+        self.reuse_frames = reuse_frames and self.hop % stft_hop == 0
+        self.n_frames = 1 + (self.window_size - fft_size) // stft_hop
+        self.spectrogram = MagnitudeSpectrogram(16000, fft_size, stft_hop)
+        self.pool = POOLING[pooling]
+        self.recent = collections.deque(maxlen=pool_size)
+        self.samples = np.zeros(0, dtype=np.float32)
+        self.offset = 0  # stream position of samples[0]
+        self.frames = np.zeros((0, fft_size // 2 + 1, 1), dtype=np.float32)
+        self.frame_offset = 0  # index of the first stored frame, frame k starts at sample k*stft_hop
+        self.next_window = 0  # stream position of the next window
+
+    def _update_frames(self):
+        # STFT frames of all complete frames of the buffered samples that were not computed yet
+        first = self.frame_offset + len(self.frames)
+        last = (self.offset + len(self.samples) - self.fft_size) // self.stft_hop
+        if last < first:
+            return
+        start = first * self.stft_hop - self.offset
+        segment = self.samples[start:start + (last - first) * self.stft_hop + self.fft_size]
+        new_frames = self.spectrogram(segment[np.newaxis])[0].numpy()
+        self.frames = np.concatenate([self.frames, new_frames], axis=0)
+
+    def _ready_windows(self):
+        starts = []
+        while self.next_window + self.window_size <= self.offset + len(self.samples) and len(starts) < self.batch_size:
+            starts.append(self.next_window)
+            self.next_window += self.hop
+        return starts
+
+    def _score_windows(self, starts):
+        x = np.stack([self.samples[s - self.offset:s - self.offset + self.window_size] for s in starts])[:, :, np.newaxis]
+        x_fft = fft_features(tf.constant(x)).numpy()
+        if self.reuse_frames:
+            x_spec = np.stack([self.frames[s // self.stft_hop - self.frame_offset:
+                                           s // self.stft_hop - self.frame_offset + self.n_frames] for s in starts])
+        else:
+            x_spec = self.spectrogram(x[:, :, 0]).numpy()
+        scores, decisions, thresholds = self.scorer.score_features(x_fft, x_spec, np.full(len(starts), self.label))
+        results = []
+        for k, start in enumerate(starts):
+            self.recent.append(scores[k])
+            results.append({'start': start, 'end': start + self.window_size, 'score': float(scores[k]),
+                            'pooled_score': float(self.pool(np.array(self.recent))),
+                            'decision': int(decisions[k]), 'threshold': float(thresholds[k])})
+        return results
+
+    def _drop_consumed(self):
+        # samples and frames before the next window are never needed again
+        n_samples = self.next_window - self.offset
+        if self.reuse_frames:
+            # keep the samples of frames that are not computed yet
+            n_samples = min(n_samples, (self.frame_offset + len(self.frames)) * self.stft_hop - self.offset)
+            n_frames = self.next_window // self.stft_hop - self.frame_offset
+            self.frames = self.frames[max(0, n_frames):]
+            self.frame_offset += max(0, n_frames)
+        n_samples = max(0, min(n_samples, len(self.samples)))
+        self.samples = self.samples[n_samples:]
+        self.offset += n_samples
+
+    def push(self, chunk):
+        """
+        Adds a chunk of samples of the stream and returns the results of all windows that are complete now.
+        """
+        self.samples = np.concatenate([self.samples, np.asarray(chunk, dtype=np.float32)])
+        results = []
+        while True:
+            if self.reuse_frames:
+                self._update_frames()
+            starts = self._ready_windows()
+            if len(starts) == 0:
+                break
+            results.extend(self._score_windows(starts))
+            self._drop_consumed()
+        self._drop_consumed()
+        return results
+
+    def score_stream(self, chunks):
+        for chunk in chunks:
+            for result in self.push(chunk):
+                yield result
+
+
+def read_blocks(wav_path, block_size):
+    # mono blocks of a long recording, only one block is kept in memory at a time
+    for block in sf.blocks(wav_path, blocksize=block_size, always_2d=True):
+        yield librosa.to_mono(block.transpose())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='score a long recording in overlapping windows')
+    parser.add_argument('--wav', required=True)
+    parser.add_argument('--section', required=True, help='section of the recording, e.g. fan_00')
+    parser.add_argument('--output', default=None, help='csv file for the window scores, default stdout')
+    parser.add_argument('--weights', nargs='+', default=None, help='weight files of the members, default wts_*.h5')
+    parser.add_argument('--embedding-store', default='./embedding_store')
+    parser.add_argument('--run-dir', default='./run_state')
+    parser.add_argument('--hop', type=int, default=None, help='samples between window starts')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--no-frame-reuse', action='store_true')
+    parser.add_argument('--pooling', default='none', choices=list(POOLING.keys()))
+    parser.add_argument('--pool-size', type=int, default=1)
+    parser.add_argument('--block-size', type=int, default=16000, help='samples read from the file at once')
+    args = parser.parse_args()
+
+    with open(os.path.join(args.run_dir, 'sections.json'), 'r') as f:
+        sections = json.load(f)
+    scorer = EnsembleScorer(args.weights or sorted(glob.glob('wts_*.h5')), EmbeddingStore(args.embedding_store),
+                            sections, max_size=run_max_size(args.run_dir))
+    stream_scorer = StreamScorer(scorer, args.section, hop=args.hop, batch_size=args.batch_size,
+                                 reuse_frames=not args.no_frame_reuse, pooling=args.pooling, pool_size=args.pool_size)
+    out = open(args.output, 'w') if args.output is not None else None
+    print('start,end,score,pooled_score,decision', file=out)
+    for result in stream_scorer.score_stream(read_blocks(args.wav, args.block_size)):
+        print(','.join(str(result[key]) for key in ['start', 'end', 'score', 'pooled_score', 'decision']), file=out,
+              flush=True)
+    if out is not None:
+        out.close()
@@ -0,0 +1,63 @@
+import os
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from data.process_data import list_wav_files
+from data.waveform_cache import WaveformCache
+from input_pipeline import make_predict_dataset
+from emb_cnn import model_emb_cnn, custom_objects
+
+
+def embedding_model(max_size, weight_path=None, num_classes=16, n_subclusters=16):
+    # trained model if weight_path is given, otherwise a randomly initialized one
+    if weight_path is not None:
+        model = tf.keras.models.load_model(weight_path, custom_objects=custom_objects)
+    else:
+        data_input, label_input, loss_output, loss_output_ssl = model_emb_cnn(num_classes, max_size, n_subclusters)
+        model = tf.keras.Model([data_input, label_input], [loss_output, loss_output_ssl])
+    return tf.keras.Model(model.input, model.get_layer('emb').output), model.input[1].shape[-1]
+
+
+def storage_parity(files, max_size, dtypes=('int16', 'float16'), weight_path=None, batch_size=32, tolerance=1e-3,
+                   cache_dir=None):
+    """
+    Caches the files as float32 and with each of the compact dtypes and compares the embeddings computed from the
+    caches. The largest relative difference (euclidean distance divided by the norm of the float32 embedding) must not
+    exceed tolerance. Returns True if all dtypes pass.
+    """
+    emb_model, num_classes = embedding_model(max_size, weight_path)
+    passed = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = cache_dir or tmp_dir
+        embs = {}
+        for dtype in ['float32'] + list(dtypes):
+            waveforms = WaveformCache(cache_dir, max_size, 16000, dtype=dtype).load('parity', files)
+            size = sum(os.path.getsize(path) for path in waveforms.paths)
+            embs[dtype] = emb_model.predict(make_predict_dataset(waveforms, num_classes, batch_size), verbose=0)
+            if dtype == 'float32':
+                print(dtype + ': ' + str(np.round(size / 2**20, 1)) + ' MB')
+                continue
+            difference = np.linalg.norm(embs[dtype] - embs['float32'], axis=1) / np.linalg.norm(embs['float32'], axis=1)
+            print(dtype + ': ' + str(np.round(size / 2**20, 1)) + ' MB, largest relative embedding difference '
+                  + str(np.max(difference)))
+            passed = passed and np.max(difference) <= tolerance
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare embeddings computed from compact waveform caches with the '
+                                                 'float32 cache')
+    parser.add_argument('--data', default='./dev_data/')
+    parser.add_argument('--stage', default='train')
+    parser.add_argument('--max-files', type=int, default=64)
+    parser.add_argument('--max-size', type=int, default=192000)
+    parser.add_argument('--weights', default=None, help='weight file of a trained model, default random weights')
+    parser.add_argument('--dtypes', nargs='+', default=['int16', 'float16'], choices=['int16', 'float16'])
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    files = list_wav_files([args.data], args.stage)
+    # files of all machine types
+    files = [files[k] for k in np.linspace(0, len(files) - 1, min(args.max_files, len(files))).astype(int)]
+    if not storage_parity(files, args.max_size, args.dtypes, args.weights, tolerance=args.tolerance):
+        raise SystemExit('embeddings of the compact waveform cache differ from the float32 cache')
@@ -1,14 +1,52 @@
 import math
 import tensorflow as tf
-import tensorflow_probability as tfp
 from tensorflow.keras import backend as K
 
 
+def median(x):
+    # same as tfp.stats.percentile(x, q=50) with its default 'nearest' interpolation without sorting all elements:
+    # the element at index round_half_even((n-1)/2) in ascending order is the (n-index)-th largest element
+    n = tf.shape(x)[0]
+    index = tf.cast(tf.round(tf.cast(n - 1, tf.float64) * 0.5), tf.int32)
+    return tf.math.top_k(x, k=n - index).values[-1]
+
+
+def target_angles(logits, y, n_subclusters):
+    # sum over classes and subclusters of y * theta for each example, the angles are only computed for classes with
+    # nonzero (mixed up) labels instead of all classes
+    indices = tf.where(tf.not_equal(y, 0))
+    logits = tf.gather_nd(tf.reshape(logits, (tf.shape(y)[0], tf.shape(y)[1], n_subclusters)), indices)
+    theta = tf.acos(K.clip(logits, -1.0 + K.epsilon(), 1.0 - K.epsilon()))
+    theta = tf.reduce_sum(theta, axis=-1) * tf.gather_nd(y, indices)
+    return tf.math.unsorted_segment_sum(theta, indices[:, 0], num_segments=tf.shape(y)[0])
+
+
+def all_gather(x):
+    # x of all replicas of a distribution strategy concatenated along the batch axis, the scale s is updated with
+    # statistics of the global batch so that all replicas assign the same value
+    ctx = tf.distribute.get_replica_context()
+    if ctx is None or ctx.num_replicas_in_sync == 1:
+        return x
+    return ctx.all_gather(x, axis=0)
+
+
+def update_scale(layer, new_s):
+    # s is updated in every training step or, if s_update_interval > 1, in every s_update_interval-th step
+    if layer.s_update_interval == 1:
+        layer.s.assign(new_s())
+    else:
+        update = tf.equal(layer.step % layer.s_update_interval, 0)
+        layer.s.assign(tf.cond(update, new_s, lambda: tf.identity(layer.s)))
+        layer.step.assign_add(1)
+
+
 class SCAdaCos(tf.keras.layers.Layer):
-    def __init__(self, n_classes=10, n_subclusters=1, trainable=False, regularizer=None, **kwargs):
+    def __init__(self, n_classes=10, n_subclusters=1, trainable=False, regularizer=None, s_update_interval=1,
+                 **kwargs):
         super(SCAdaCos, self).__init__(**kwargs)
         self.n_classes = n_classes
         self.n_subclusters = n_subclusters
+        self.s_update_interval = s_update_interval
         self.s_init = math.sqrt(2) * math.log(n_classes*n_subclusters - 1)
         self.regularizer = tf.keras.regularizers.get(regularizer)
         self.trainable = trainable
@@ -25,29 +63,32 @@ class SCAdaCos(tf.keras.layers.Layer):
                                   initializer=tf.keras.initializers.Constant(self.s_init),
                                   trainable=False,
                                   aggregation=tf.VariableAggregation.MEAN)
+        # the step counter is only needed (and stored with the weights) if s is not updated in every step
+        if self.s_update_interval > 1:
+            self.step = self.add_weight(name='step' + str(self.n_classes) + '_' + str(self.n_subclusters),
+                                        shape=(), dtype=tf.int64, initializer='zeros', trainable=False,
+                                        aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
 
     def call(self, inputs, training=None):
         x, y1, y2 = inputs
         y1_orig = y1
-        y1 = tf.repeat(y1, repeats=self.n_subclusters, axis=-1)
         # normalize feature
         x = tf.nn.l2_normalize(x, axis=1)
         # normalize weights
         W = tf.nn.l2_normalize(self.W, axis=0)
         # dot product
         logits = x @ W  # same as cos theta
-        theta = tf.acos(K.clip(logits, -1.0 + K.epsilon(), 1.0 - K.epsilon()))
 
         if training:
-            max_s_logits = tf.reduce_max(self.s * logits)
-            B_avg = tf.exp(self.s*logits-max_s_logits)
-            #B_avg = tf.where(y1 < 1, tf.exp(self.s * logits-max_s_logits), tf.zeros_like(logits)-max_s_logits)
-            B_avg = tf.reduce_mean(tf.reduce_sum(B_avg, axis=1))
-            theta_class = tf.reduce_sum(y1 * theta, axis=1) * tf.math.count_nonzero(y1_orig, axis=1, dtype=tf.dtypes.float32)  # take mix-upped angle of mix-upped classes
-            theta_med = tfp.stats.percentile(theta_class, q=50)  # computes median
-            self.s.assign(
-                (max_s_logits + tf.math.log(B_avg)) /
-                tf.math.cos(tf.minimum(math.pi / 4, theta_med)) + K.epsilon())
+            def new_s():
+                max_s_logits = tf.reduce_max(all_gather(tf.reduce_max(self.s * logits, axis=1)))
+                B_avg = tf.exp(self.s*logits-max_s_logits)
+                #B_avg = tf.where(y1 < 1, tf.exp(self.s * logits-max_s_logits), tf.zeros_like(logits)-max_s_logits)
+                B_avg = tf.reduce_mean(all_gather(tf.reduce_sum(B_avg, axis=1)))
+                theta_class = all_gather(target_angles(logits, y1_orig, self.n_subclusters) * tf.math.count_nonzero(y1_orig, axis=1, dtype=tf.dtypes.float32))  # take mix-upped angle of mix-upped classes
+                theta_med = median(theta_class)
+                return (max_s_logits + tf.math.log(B_avg)) / tf.math.cos(tf.minimum(math.pi / 4, theta_med)) + K.epsilon()
+            update_scale(self, new_s)
         logits *= self.s
         out = tf.keras.activations.softmax(logits)
         out = tf.reshape(out, (-1, self.n_classes, self.n_subclusters))
@@ -62,17 +103,27 @@ class SCAdaCos(tf.keras.layers.Layer):
             'n_classes': self.n_classes,
             'regularizer': self.regularizer,
             'n_subclusters': self.n_subclusters,
-            'trainable': self.trainable
+            'trainable': self.trainable,
+            's_update_interval': self.s_update_interval
         }
         base_config = super(SCAdaCos, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
 
 class AdaProj(tf.keras.layers.Layer):
-    def __init__(self, n_classes=10, n_subclusters=1, trainable=False, regularizer=None, **kwargs):
+    """
+    With memory_efficient=True the cosine similarity to the projection onto the subspace of each class is computed
+    from batched contractions instead of the batch x dim x classes x subclusters projection, see project_logits.
+    Both versions share the same weights and compute the same outputs.
+    """
+
+    def __init__(self, n_classes=10, n_subclusters=1, trainable=False, regularizer=None, memory_efficient=False,
+                 s_update_interval=1, **kwargs):
         super(AdaProj, self).__init__(**kwargs)
         self.n_classes = n_classes
         self.n_subclusters = n_subclusters
+        self.s_update_interval = s_update_interval
+        self.memory_efficient = memory_efficient
         self.s_init = math.sqrt(2) * math.log(n_classes*n_subclusters - 1)
         self.regularizer = tf.keras.regularizers.get(regularizer)
         self.trainable = trainable
@@ -89,33 +140,48 @@ class AdaProj(tf.keras.layers.Layer):
                                   initializer=tf.keras.initializers.Constant(self.s_init),
                                   trainable=False,
                                   aggregation=tf.VariableAggregation.MEAN)
+        # the step counter is only needed (and stored with the weights) if s is not updated in every step
+        if self.s_update_interval > 1:
+            self.step = self.add_weight(name='step' + str(self.n_classes) + '_' + str(self.n_subclusters),
+                                        shape=(), dtype=tf.int64, initializer='zeros', trainable=False,
+                                        aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
+    def project_logits(self, x, W):
+        # x_proj_c = W_c l_c with l_c = W_c^T x, so x^T x_proj_c = sum(l_c^2) and |x_proj_c|^2 = l_c^T (W_c^T W_c) l_c,
+        # clipped like tf.nn.l2_normalize
+        logits = tf.reshape(x @ W, (-1, self.n_classes, self.n_subclusters))
+        W = tf.reshape(W, (-1, self.n_classes, self.n_subclusters))
+        gram = tf.einsum('dcs,dct->cst', W, W)
+        norm_sq = tf.reduce_sum(tf.einsum('bcs,cst->bct', logits, gram) * logits, axis=-1)
+        return tf.reduce_sum(tf.square(logits), axis=-1) * tf.math.rsqrt(tf.maximum(norm_sq, 1e-12))
 
     def call(self, inputs, training=None):
         x, y1, y2 = inputs
         y1_orig = y1
-        y1 = tf.repeat(y1, repeats=self.n_subclusters, axis=-1)
         # normalize feature
         x = tf.nn.l2_normalize(x, axis=1)
         # normalize weights
         W = tf.nn.l2_normalize(self.W, axis=0)
-        # dot product
-        logits = x @ W  # same as cos theta
-        logits = tf.reshape(logits, (-1, 1, self.n_classes, self.n_subclusters))
-        x_proj = tf.reduce_sum(logits*tf.reshape(W, (1, -1, self.n_classes, self.n_subclusters)),axis=-1)
-        x_proj = tf.nn.l2_normalize(x_proj, axis=1)
-        logits = tf.reduce_sum(tf.expand_dims(x, axis=-1)*x_proj, axis=1)
-        theta = tf.acos(K.clip(logits, -1.0 + K.epsilon(), 1.0 - K.epsilon()))
+        if self.memory_efficient:
+            logits = self.project_logits(x, W)
+        else:
+            # dot product
+            logits = x @ W  # same as cos theta
+            logits = tf.reshape(logits, (-1, 1, self.n_classes, self.n_subclusters))
+            x_proj = tf.reduce_sum(logits*tf.reshape(W, (1, -1, self.n_classes, self.n_subclusters)),axis=-1)
+            x_proj = tf.nn.l2_normalize(x_proj, axis=1)
+            logits = tf.reduce_sum(tf.expand_dims(x, axis=-1)*x_proj, axis=1)
 
         if training:
-            max_s_logits = tf.reduce_max(self.s * logits)
-            #B_avg = tf.exp(self.s*logits-max_s_logits)
-            B_avg = tf.where(y1_orig < 1, tf.exp(self.s * logits-max_s_logits), tf.exp(tf.zeros_like(logits)-max_s_logits))
-            B_avg = tf.reduce_mean(tf.reduce_sum(B_avg, axis=1))
-            theta_class = tf.reduce_sum(y1_orig * theta, axis=1)  # take mix-upped angle of mix-upped classes
-            theta_med = tfp.stats.percentile(theta_class, q=50)  # computes median
-            self.s.assign(
-                (max_s_logits + tf.math.log(B_avg)) /
-                tf.math.cos(tf.minimum(math.pi / 4, theta_med)) + K.epsilon())
+            def new_s():
+                max_s_logits = tf.reduce_max(all_gather(tf.reduce_max(self.s * logits, axis=1)))
+                #B_avg = tf.exp(self.s*logits-max_s_logits)
+                B_avg = tf.where(y1_orig < 1, tf.exp(self.s * logits-max_s_logits), tf.exp(tf.zeros_like(logits)-max_s_logits))
+                B_avg = tf.reduce_mean(all_gather(tf.reduce_sum(B_avg, axis=1)))
+                theta_class = all_gather(target_angles(logits, y1_orig, 1))  # take mix-upped angle of mix-upped classes
+                theta_med = median(theta_class)
+                return (max_s_logits + tf.math.log(B_avg)) / tf.math.cos(tf.minimum(math.pi / 4, theta_med)) + K.epsilon()
+            update_scale(self, new_s)
         out = tf.keras.activations.softmax(logits*self.s)
         return out
 
@@ -127,7 +193,9 @@ class AdaProj(tf.keras.layers.Layer):
             'n_classes': self.n_classes,
             'regularizer': self.regularizer,
             'n_subclusters': self.n_subclusters,
-            'trainable': self.trainable
+            'trainable': self.trainable,
+            'memory_efficient': self.memory_efficient,
+            's_update_interval': self.s_update_interval
         }
         base_config = super(AdaProj, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
\ No newline at end of file
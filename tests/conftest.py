@@ -0,0 +1,4 @@
+import os
+
+# the models are built with tf-keras, which tensorflow only uses if this is set before it is imported
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
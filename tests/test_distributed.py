@@ -0,0 +1,8 @@
+import pytest
+from distributed import parity
+
+
+@pytest.mark.slow
+def test_two_workers_converge_like_a_single_process():
+    # trains the same member on tiny synthetic data in one process and with two local worker processes
+    assert parity(n_workers=2, n_train=64, raw_dim=32000, num_classes=4, epochs=3, batch_size=16, tolerance=0.1)